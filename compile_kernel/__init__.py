@@ -2,17 +2,29 @@
 isort:skip_file
 """
 
+from .compile_kernel import SERVE_SOCKET as SERVE_SOCKET
+from .compile_kernel import BuildOptions as BuildOptions
 from .compile_kernel import KernelBuild as KernelBuild
 from .compile_kernel import KernelFlags as KernelFlags
+from .compile_kernel import build_history as build_history
+from .compile_kernel import build_queue_status as build_queue_status
 from .compile_kernel import build_status as build_status
 from .compile_kernel import check_kernel_config as check_kernel_config
 from .compile_kernel import check_kernel_config_perf as check_kernel_config_perf
+from .compile_kernel import collect_module_usage as collect_module_usage
+from .compile_kernel import compile_heatmap as compile_heatmap
 from .compile_kernel import configure_kernel as configure_kernel
+from .compile_kernel import dedupe_module_trees as dedupe_module_trees
 from .compile_kernel import generate_module_config_dict as generate_module_config_dict
 from .compile_kernel import get_set_kernel_config_option as get_set_kernel_config_option
 from .compile_kernel import install_compiled_kernel as install_compiled_kernel
+from .compile_kernel import module_usage_report as module_usage_report
+from .compile_kernel import phase_log as phase_log
 from .compile_kernel import compile_and_install_kernel as compile_and_install_kernel
+from .compile_kernel import rebuild_impact as rebuild_impact
+from .compile_kernel import serve_build_queue as serve_build_queue
 from .compile_kernel import (
     read_content_of_kernel_config as read_content_of_kernel_config,
 )
 from .compile_kernel import set_grub_font as set_grub_font
+from .compile_kernel import submit_build_request as submit_build_request
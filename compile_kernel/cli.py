@@ -13,6 +13,7 @@ from pathlib import Path
 import click
 import hs
 from dataclasses import fields
+from dataclasses import replace
 from asserttool import ic
 from asserttool import icp
 from click_auto_help import AHGroup
@@ -22,17 +23,29 @@ from clicktool import tvicgvd
 from eprint import eprint
 from globalverbose import gvd
 
+from compile_kernel import SERVE_SOCKET
+from compile_kernel import BuildOptions
 from compile_kernel import KernelBuild
 from compile_kernel import KernelFlags
+from compile_kernel import build_history
+from compile_kernel import build_queue_status
 from compile_kernel import build_status
 from compile_kernel import check_kernel_config
 from compile_kernel import check_kernel_config_perf
+from compile_kernel import collect_module_usage
+from compile_kernel import compile_heatmap
 from compile_kernel import compile_and_install_kernel
 from compile_kernel import configure_kernel
+from compile_kernel import dedupe_module_trees
 from compile_kernel import generate_module_config_dict
 from compile_kernel import get_set_kernel_config_option
 from compile_kernel import install_compiled_kernel
+from compile_kernel import module_usage_report
+from compile_kernel import phase_log
+from compile_kernel import rebuild_impact
+from compile_kernel import serve_build_queue
 from compile_kernel import set_grub_font
+from compile_kernel import submit_build_request
 
 click_option_code_debug = click.option("--code-debug", is_flag=True)
 
@@ -75,6 +88,28 @@ _variant_option = click.option(
     help="Name this build: appends -VARIANT to CONFIG_LOCALVERSION so it installs alongside (not over) the plain build of the same source — its own vmlinuz, initramfs, /lib/modules tree, and grub entry",
 )
 
+_SOURCE_PATH = click.Path(exists=True, file_okay=False, path_type=Path)
+_source_option = click.option(
+    "--source",
+    type=_SOURCE_PATH,
+    default=Path("/usr/src/linux"),
+    show_default=True,
+    help="Kernel source tree to build, e.g. /usr/src/linux-6.12.8, instead of whatever /usr/src/linux points at",
+)
+
+_pair_option = click.option(
+    "--pair",
+    is_flag=True,
+    help="Also build a plain kernel with no debug groups, and make it the boot default. The flags given on this command line apply to the second (instrumented) kernel, which installs under --variant (default: debug). Both appear in the grub menu.",
+)
+_sources_option = click.option(
+    "--source",
+    "sources",
+    type=_SOURCE_PATH,
+    multiple=True,
+    help="Kernel source tree to build; repeat to build several versions concurrently, each in its own build dir. The first one's build is the boot default  [default: /usr/src/linux]",
+)
+
 # Groups that default ON are exposed as negative options, mapping the
 # KernelFlags field to the click kwarg that turns it off.
 _NEGATED_FLAGS = {
@@ -87,6 +122,83 @@ _FLAG_FIELDS = tuple(
 )
 
 
+# Pipeline options (BuildOptions fields). Each option's name is its
+# BuildOptions field. _INSTALL_OPTIONS shape what gets installed and apply to
+# every command that installs a kernel; _BUILD_OPTIONS only to compiling.
+_INSTALL_OPTIONS = [
+    click.option("--filter-firmware", is_flag=True, help="Pack only the firmware the initramfs modules declare (modinfo firmware:) instead of all of linux-firmware"),
+    click.option("--initramfs-modules", type=click.Choice(["all", "root"]), default="all", show_default=True, help="Modules to pack into the initramfs: every built module, or only the root device's driver chain plus zfs/spl and their modules.dep closure"),
+    click.option("--strip-modules", is_flag=True, help="Strip debug sections from installed modules (parallel, after modules_install)"),
+    click.option("--module-debuginfo", is_flag=True, help="With --strip-modules, keep each module's debug info under /usr/lib/debug/lib/modules"),
+    click.option("--compress-modules", is_flag=True, help="zstd-compress installed modules across a worker pool, then depmod once"),
+    click.option("--artifact-cache", is_flag=True, help="Keep bzImage, System.map, Module.symvers and the module tree in /var/lib/compile-kernel/artifacts keyed by source, .config and toolchain; restore instead of compiling on a hit"),
+]
+
+_BUILD_OPTIONS = [
+    click.option("--jobs", "-j", type=click.IntRange(min=1), default=None, help="Total make jobs shared by all builds of this run  [default: cpu count]"),
+    click.option("--jobserver/--no-jobserver", default=True, show_default=True, help="Share one GNU make jobserver of --jobs tokens across every make, genkernel and emerge (needs make >= 4.4)"),
+    click.option("--adaptive-jobs/--no-adaptive-jobs", default=True, show_default=True, help="Cap jobs so each fits in available memory (per-job peak learned from build history), and withhold jobserver tokens while /proc/pressure/memory is high"),
+    click.option("--ccache", is_flag=True, help="Compile through ccache, with a base dir that lets variant build dirs share objects; prints per-build hit rates"),
+    click.option("--cc-timing", is_flag=True, help="Time every kernel object through a compiler shim and save a per-kver heatmap by source directory and gating CONFIG symbol (see `heatmap`); recompiles everything once when toggled"),
+    click.option("--clone-build-dir", is_flag=True, help="Start a new variant's build dir as a reflink clone of the most similar existing build dir of the same source, so only the config delta recompiles"),
+    click.option("--schedule-builds", is_flag=True, help="With several builds, seed each from another build of this run once that one has compiled, where the impact index says that compiles fewer objects in total; the first build stays the boot default"),
+    click.option("--force-rebuild", is_flag=True, help="Rebuild even when the build stamp shows config, source, toolchain and out-of-tree modules unchanged since the last successful build"),
+    click.option("--resume", is_flag=True, help="Continue each build from the first phase its journal shows incomplete; refuses if the config, source or compiler changed since the interrupted run"),
+    click.option("--direct-kbuild", is_flag=True, help="Compile with make bzImage modules and install with Kbuild's modules_install/install; genkernel only builds the initramfs"),
+    click.option("--tmpfs-build", is_flag=True, help="Configure and compile in copies of the build dirs on a tmpfs mounted beside the build root (default /usr/src/linux-build-tmpfs), copied back to the build root afterwards, sized from each kver's last object dir and refused if that plus the job budget does not fit in available memory (build root: $COMPILE_KERNEL_BUILD_ROOT, default /usr/src/linux-build)"),
+    click.option("--prewarm-source", is_flag=True, help="Read the source tree into the page cache across parallel readers while configuring, so a cold-cache compile does not wait on the disk file by file"),
+    click.option("--phase-logs", is_flag=True, help="Also write each build phase's make, genkernel and emerge output to a zstd log under /var/lib/compile-kernel/logs/KVER, indexed by error and warning line (see `log`); genkernel and emerge then write to a pipe, not the terminal, so they lose colour and prompts"),
+    click.option("--serial-builds", is_flag=True, help="Compile multiple kernels (e.g. --pair) one after another instead of concurrently; each install still overlaps the next compile"),
+    click.option("--dedupe-modules", is_flag=True, help="After building, reflink modules that are byte-identical across /lib/modules trees"),
+]
+
+# Resource limits for everything a run spawns; apply wherever _INSTALL_OPTIONS do.
+_CGROUP_OPTIONS = [
+    click.option("--cgroup", is_flag=True, help="Run make, genkernel, emerge and grub-mkconfig in a cgroup v2 leaf under /sys/fs/cgroup/compile-kernel, and report its cpu, memory and io totals at the end; implied by any limit below"),
+    click.option("--cpu-weight", type=click.IntRange(1, 10000), default=None, help="cgroup cpu.weight (default 100); lower yields the cpu to other workloads under contention"),
+    click.option("--cpu-max", type=click.FloatRange(min=0, min_open=True), default=None, help="Cap the build at this many cpus' worth of time (cgroup cpu.max), e.g. 6 or 2.5"),
+    click.option("--io-weight", type=click.IntRange(1, 10000), default=None, help="cgroup io.weight (default 100), with the io.cost or bfq controller"),
+    click.option("--io-max", default=None, help="A cgroup io.max line, e.g. '259:0 rbps=209715200 wbps=104857600'"),
+    click.option("--memory-high", default=None, help="cgroup memory.high, e.g. 24G: above it the build is reclaimed and throttled rather than OOM-killed; also caps the memory-based job count"),
+]
+
+
+def _options_from_kwargs(kwargs: dict) -> BuildOptions:
+    """Consume whichever BuildOptions fields this command exposes."""
+    values = {
+        f.name: kwargs.pop(f.name) for f in fields(BuildOptions) if f.name in kwargs
+    }
+    return BuildOptions(**values)
+
+
+def _builds_from_cli(
+    *,
+    flags: KernelFlags,
+    variant: str | None,
+    pair: bool,
+    sources: tuple[Path, ...],
+) -> list[KernelBuild]:
+    """The builds --variant, --pair and --source ask for, boot default first."""
+    if pair:
+        if flags == KernelFlags():
+            raise click.UsageError(
+                "--pair with no debug groups would build the same kernel twice; "
+                "pass the groups you want in the instrumented build"
+            )
+        # builds[0] is the boot default: plain kernel, tool defaults only.
+        per_source = [
+            KernelBuild(flags=KernelFlags(), variant=None),
+            KernelBuild(flags=flags, variant=variant or "debug"),
+        ]
+    else:
+        per_source = [KernelBuild(flags=flags, variant=variant)]
+    return [
+        replace(build, source=source)
+        for source in sources or (Path("/usr/src/linux"),)
+        for build in per_source
+    ]
+
+
 def _flags_from_kwargs(kwargs: dict) -> KernelFlags:
     """Consume the shared kernel-flag options out of click's kwargs."""
     values = {name: kwargs.pop(name) for name in _FLAG_FIELDS}
@@ -116,6 +228,7 @@ def cli(
 @cli.command()
 @click.option("--no-fix", is_flag=True)
 @_variant_option
+@_source_option
 @click_add_options(_KERNEL_FLAG_OPTIONS)
 @click_option_code_debug
 @click_add_options(click_global_options)
@@ -124,6 +237,7 @@ def configure(
     ctx,
     no_fix: bool,
     variant: str | None,
+    source: Path,
     code_debug: bool,
     verbose_inf: bool,
     dict_output: bool,
@@ -157,6 +271,7 @@ def configure(
         interactive=True,
         flags=_flags_from_kwargs(kwargs),
         variant=variant,
+        source=source,
     )
 
 
@@ -273,6 +388,117 @@ def compare_loaded_modules_to_config(
                         # input("press enter to continue")
 
 
+_module_usage_state_option = click.option(
+    "--state-file",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=Path("/var/lib/compile-kernel/module-usage.json"),
+    show_default=True,
+    help="Where the union of observed modules is kept",
+)
+
+
+@cli.command("collect-module-usage")
+@_module_usage_state_option
+@click.option(
+    "--interval",
+    type=click.IntRange(min=1),
+    default=300,
+    show_default=True,
+    help="Seconds between /proc/modules samples",
+)
+@click.option("--no-udev", is_flag=True, help="Sample on the timer only; ignore udev module events")
+@click.option("--once", is_flag=True, help="Take one sample and exit (for cron or a systemd timer)")
+@click_add_options(click_global_options)
+@click.pass_context
+def _collect_module_usage(
+    ctx,
+    state_file: Path,
+    interval: int,
+    no_udev: bool,
+    once: bool,
+    verbose_inf: bool,
+    dict_output: bool,
+    verbose: bool = False,
+):
+    tty, verbose = tvicgvd(
+        ctx=ctx,
+        verbose=verbose,
+        verbose_inf=verbose_inf,
+        ic=ic,
+        gvd=gvd,
+    )
+    if not verbose:
+        ic.disable()
+    else:
+        ic.enable()
+    if verbose_inf:
+        gvd.enable()
+
+    collect_module_usage(
+        state_file=state_file,
+        interval=interval,
+        udev=not no_udev,
+        once=once,
+    )
+
+
+@cli.command("module-usage-report")
+@click.argument(
+    "kernel_dir",
+    type=click.Path(
+        exists=True,
+        dir_okay=True,
+        file_okay=False,
+        allow_dash=False,
+        path_type=Path,
+    ),
+    nargs=1,
+    default=Path("/usr/src/linux"),
+)
+@click.argument(
+    "dotconfig",
+    type=click.Path(
+        exists=True,
+        dir_okay=False,
+        file_okay=True,
+        allow_dash=False,
+        path_type=Path,
+    ),
+    nargs=1,
+)
+@_module_usage_state_option
+@click_add_options(click_global_options)
+@click.pass_context
+def _module_usage_report(
+    ctx,
+    kernel_dir: Path,
+    dotconfig: Path,
+    state_file: Path,
+    verbose_inf: bool,
+    dict_output: bool,
+    verbose: bool = False,
+):
+    tty, verbose = tvicgvd(
+        ctx=ctx,
+        verbose=verbose,
+        verbose_inf=verbose_inf,
+        ic=ic,
+        gvd=gvd,
+    )
+    if not verbose:
+        ic.disable()
+    else:
+        ic.enable()
+    if verbose_inf:
+        gvd.enable()
+
+    module_usage_report(
+        kernel_dir=kernel_dir,
+        dotconfig=dotconfig,
+        state_file=state_file,
+    )
+
+
 @cli.command()
 @click.option("--configure", "--config", is_flag=True)
 @click.option("--no-fix", is_flag=True)
@@ -283,11 +509,11 @@ def compare_loaded_modules_to_config(
     help="Run emerge zfs @module-rebuild before the kernel compile (only useful if pre-build modules need updating)",
 )
 @_variant_option
-@click.option(
-    "--pair",
-    is_flag=True,
-    help="Also build a plain kernel with no debug groups, and make it the boot default. The flags given on this command line apply to the second (instrumented) kernel, which installs under --variant (default: debug). Both appear in the grub menu.",
-)
+@_pair_option
+@_sources_option
+@click_add_options(_BUILD_OPTIONS)
+@click_add_options(_INSTALL_OPTIONS)
+@click_add_options(_CGROUP_OPTIONS)
 @click_add_options(_KERNEL_FLAG_OPTIONS)
 @click_option_code_debug
 @click_add_options(click_global_options)
@@ -300,6 +526,7 @@ def compile_and_install(
     pre_module_rebuild: bool,
     variant: str | None,
     pair: bool,
+    sources: tuple[Path, ...],
     code_debug: bool,
     verbose_inf: bool,
     dict_output: bool,
@@ -328,40 +555,32 @@ def compile_and_install(
         ic.enable()
 
     flags = _flags_from_kwargs(kwargs)
-
-    if pair:
-        if flags == KernelFlags():
-            raise click.UsageError(
-                "--pair with no debug groups would build the same kernel twice; "
-                "pass the groups you want in the instrumented build"
-            )
-        # builds[0] is the boot default: plain kernel, tool defaults only.
-        builds = [
-            KernelBuild(flags=KernelFlags(), variant=None),
-            KernelBuild(flags=flags, variant=variant or "debug"),
-        ]
-    else:
-        builds = [KernelBuild(flags=flags, variant=variant)]
+    options = _options_from_kwargs(kwargs)
 
     compile_and_install_kernel(
-        builds=builds,
+        builds=_builds_from_cli(flags=flags, variant=variant, pair=pair, sources=sources),
         configure=configure,
         fix=fix,
         warn_only=warn_only,
         no_check_boot=no_check_boot,
         pre_module_rebuild=pre_module_rebuild,
+        options=options,
     )
     eprint("DONT FORGET TO UMOUNT /boot")
 
 
 @cli.command("install-kernel")
 @_variant_option
+@_source_option
+@click_add_options(_INSTALL_OPTIONS)
+@click_add_options(_CGROUP_OPTIONS)
 @click_add_options(_KERNEL_FLAG_OPTIONS)
 @click_add_options(click_global_options)
 @click.pass_context
 def _install_kernel(
     ctx,
     variant: str | None,
+    source: Path,
     verbose_inf: bool,
     dict_output: bool,
     verbose: bool = False,
@@ -381,7 +600,328 @@ def _install_kernel(
     if verbose_inf:
         gvd.enable()
 
-    install_compiled_kernel(flags=_flags_from_kwargs(kwargs), variant=variant)
+    install_compiled_kernel(
+        flags=_flags_from_kwargs(kwargs),
+        variant=variant,
+        options=_options_from_kwargs(kwargs),
+        source=source,
+    )
+
+
+@cli.command("dedupe-modules")
+@click.argument("kvers", type=str, nargs=-1, metavar="[KVER]...")
+@click.option(
+    "--link",
+    type=click.Choice(["reflink", "hardlink"]),
+    default="reflink",
+    show_default=True,
+    help="reflink shares extents but keeps separate inodes; hardlink works on any filesystem",
+)
+@click.option("--dry-run", is_flag=True, help="Report what would be reclaimed; change nothing")
+@click_add_options(click_global_options)
+@click.pass_context
+def _dedupe_modules(
+    ctx,
+    kvers: tuple[str, ...],
+    link: str,
+    dry_run: bool,
+    verbose_inf: bool,
+    dict_output: bool,
+    verbose: bool = False,
+):
+    tty, verbose = tvicgvd(
+        ctx=ctx,
+        verbose=verbose,
+        verbose_inf=verbose_inf,
+        ic=ic,
+        gvd=gvd,
+    )
+    if not verbose:
+        ic.disable()
+    else:
+        ic.enable()
+    if verbose_inf:
+        gvd.enable()
+
+    dedupe_module_trees(kvers=list(kvers) or None, link=link, dry_run=dry_run)
+
+
+@cli.command()
+@click.argument("kver", type=str)
+@click.argument("symbols", type=str, nargs=-1, metavar="[CONFIG_SYMBOL]...")
+@click.option(
+    "--against",
+    type=click.Path(exists=True, dir_okay=False, file_okay=True, allow_dash=False, path_type=Path),
+    default=None,
+    metavar="DOTCONFIG",
+    help="Also count every symbol whose value differs between KVER's .config and this one",
+)
+@click.option("--top", type=int, default=10, show_default=True, help="Rows per table")
+@click_add_options(click_global_options)
+@click.pass_context
+def impact(
+    ctx,
+    kver: str,
+    symbols: tuple[str, ...],
+    against: Path | None,
+    top: int,
+    verbose_inf: bool,
+    dict_output: bool,
+    verbose: bool = False,
+):
+    """Count the objects of KVER's build dir a config change would recompile."""
+    tty, verbose = tvicgvd(
+        ctx=ctx,
+        verbose=verbose,
+        verbose_inf=verbose_inf,
+        ic=ic,
+        gvd=gvd,
+    )
+    if not verbose:
+        ic.disable()
+    else:
+        ic.enable()
+    if verbose_inf:
+        gvd.enable()
+
+    rebuild_impact(kver=kver, symbols=symbols, against=against, top=top)
+
+
+@cli.command()
+@click.argument("kver", type=str)
+@click.option("--compare", type=str, default=None, metavar="KVER", help="Show the difference from this kver's heatmap, e.g. the plain build of the same source")
+@click.option("--top", type=int, default=20, show_default=True, help="Rows per table")
+@click_add_options(click_global_options)
+@click.pass_context
+def heatmap(
+    ctx,
+    kver: str,
+    compare: str | None,
+    top: int,
+    verbose_inf: bool,
+    dict_output: bool,
+    verbose: bool = False,
+):
+    """Show where a --cc-timing build's compile time went."""
+    tty, verbose = tvicgvd(
+        ctx=ctx,
+        verbose=verbose,
+        verbose_inf=verbose_inf,
+        ic=ic,
+        gvd=gvd,
+    )
+    if not verbose:
+        ic.disable()
+    else:
+        ic.enable()
+    if verbose_inf:
+        gvd.enable()
+
+    compile_heatmap(kver=kver, compare=compare, top=top)
+
+
+@cli.command()
+@click.option("--kver", type=str, default=None, help="Only builds of this kernel release")
+@click.option("--limit", type=int, default=10, show_default=True, help="Successful builds per group to take medians over")
+@click_add_options(click_global_options)
+@click.pass_context
+def history(
+    ctx,
+    kver: str | None,
+    limit: int,
+    verbose_inf: bool,
+    dict_output: bool,
+    verbose: bool = False,
+):
+    """Summarise per-phase build timings per kver and per flag set."""
+    tty, verbose = tvicgvd(
+        ctx=ctx,
+        verbose=verbose,
+        verbose_inf=verbose_inf,
+        ic=ic,
+        gvd=gvd,
+    )
+    if not verbose:
+        ic.disable()
+    else:
+        ic.enable()
+    if verbose_inf:
+        gvd.enable()
+
+    build_history(kver=kver, limit=limit)
+
+
+@cli.command()
+@click.argument("kver", type=str)
+@click.argument("phase", type=str, required=False)
+@click.option("--errors", is_flag=True, help="Jump to the first error of the phase that failed (or of PHASE), from the log's index")
+@click.option("--context", type=int, default=20, show_default=True, help="Lines shown either side of that error")
+@click_add_options(click_global_options)
+@click.pass_context
+def log(
+    ctx,
+    kver: str,
+    phase: str | None,
+    errors: bool,
+    context: int,
+    verbose_inf: bool,
+    dict_output: bool,
+    verbose: bool = False,
+):
+    """List a kver's phase logs from its last build, or show one."""
+    tty, verbose = tvicgvd(
+        ctx=ctx,
+        verbose=verbose,
+        verbose_inf=verbose_inf,
+        ic=ic,
+        gvd=gvd,
+    )
+    if not verbose:
+        ic.disable()
+    else:
+        ic.enable()
+    if verbose_inf:
+        gvd.enable()
+
+    phase_log(kver=kver, phase=phase, errors=errors, context=context)
+
+
+_socket_option = click.option(
+    "--socket",
+    "socket_path",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=SERVE_SOCKET,
+    show_default=True,
+    help="Unix socket of the serve daemon",
+)
+
+
+@cli.command()
+@_socket_option
+@click_add_options(click_global_options)
+@click.pass_context
+def serve(
+    ctx,
+    socket_path: Path,
+    verbose_inf: bool,
+    dict_output: bool,
+    verbose: bool = False,
+):
+    """Run builds and installs submitted over a Unix socket, batches side by side.
+
+    Queued build requests with the same options are merged into one run, and
+    runs for different build dirs go in parallel, each in its own process.
+    Every compile draws from one shared job pool, while the emerges, /boot
+    and grub are handled one at a time. Identical pending requests are
+    merged outright.
+    """
+    tty, verbose = tvicgvd(
+        ctx=ctx,
+        verbose=verbose,
+        verbose_inf=verbose_inf,
+        ic=ic,
+        gvd=gvd,
+    )
+    if not verbose:
+        ic.disable()
+    else:
+        ic.enable()
+    if verbose_inf:
+        gvd.enable()
+
+    serve_build_queue(socket_path=socket_path)
+
+
+@cli.command()
+@click.option("--no-fix", is_flag=True)
+@click.option("--no-check-boot", is_flag=True)
+@click.option("--pre-module-rebuild", is_flag=True, help="Run emerge zfs @module-rebuild before the kernel compile")
+@click.option("--install-only", is_flag=True, help="Install an already compiled build dir, as install-kernel does, instead of building")
+@_variant_option
+@_pair_option
+@_sources_option
+@_socket_option
+@click_add_options(_BUILD_OPTIONS)
+@click_add_options(_INSTALL_OPTIONS)
+@click_add_options(_CGROUP_OPTIONS)
+@click_add_options(_KERNEL_FLAG_OPTIONS)
+@click_add_options(click_global_options)
+@click.pass_context
+def submit(
+    ctx,
+    no_fix: bool,
+    no_check_boot: bool,
+    pre_module_rebuild: bool,
+    install_only: bool,
+    variant: str | None,
+    pair: bool,
+    sources: tuple[Path, ...],
+    socket_path: Path,
+    verbose_inf: bool,
+    dict_output: bool,
+    verbose: bool = False,
+    **kwargs,
+):
+    """Queue a compile-and-install (or --install-only) with the serve daemon
+    and follow its output; exits with the build's status."""
+    tty, verbose = tvicgvd(
+        ctx=ctx,
+        verbose=verbose,
+        verbose_inf=verbose_inf,
+        ic=ic,
+        gvd=gvd,
+    )
+    if not verbose:
+        ic.disable()
+    else:
+        ic.enable()
+    if verbose_inf:
+        gvd.enable()
+
+    builds = _builds_from_cli(
+        flags=_flags_from_kwargs(kwargs), variant=variant, pair=pair, sources=sources
+    )
+    if install_only and len(builds) != 1:
+        raise click.UsageError("--install-only installs one build: no --pair, one --source")
+    status = submit_build_request(
+        action="install" if install_only else "build",
+        builds=builds,
+        options=_options_from_kwargs(kwargs),
+        fix=not no_fix,
+        no_check_boot=no_check_boot,
+        pre_module_rebuild=pre_module_rebuild,
+        socket_path=socket_path,
+    )
+    sys.exit(status)
+
+
+@cli.command("queue")
+@_socket_option
+@click_add_options(click_global_options)
+@click.pass_context
+def _queue(
+    ctx,
+    socket_path: Path,
+    verbose_inf: bool,
+    dict_output: bool,
+    verbose: bool = False,
+):
+    """Show what the serve daemon is running and has queued."""
+    tty, verbose = tvicgvd(
+        ctx=ctx,
+        verbose=verbose,
+        verbose_inf=verbose_inf,
+        ic=ic,
+        gvd=gvd,
+    )
+    if not verbose:
+        ic.disable()
+    else:
+        ic.enable()
+    if verbose_inf:
+        gvd.enable()
+
+    build_queue_status(socket_path=socket_path)
 
 
 @cli.command()
@@ -3,18 +3,38 @@
 
 from __future__ import annotations
 
+import contextlib
+import fcntl
+import grp
 import gzip
+import hashlib
+import json
 import logging
 import os
+import queue
 import re
+import resource
+import select
 import shutil
+import socket
+import socketserver
+import stat
+import statistics
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+from collections.abc import Callable
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from dataclasses import asdict
 from dataclasses import dataclass
+from dataclasses import field
 from dataclasses import fields
 from dataclasses import replace
+from functools import partial
 from pathlib import Path
 
 import hs
@@ -109,6 +129,102 @@ class KernelBuild:
     artifacts from colliding with any other build of the same source."""
     flags: KernelFlags
     variant: str | None = None
+    # the tree to build; builds of different versions get different kvers,
+    # and so build dirs of their own
+    source: Path = Path("/usr/src/linux")
+
+
+# How to build, as opposed to what: KernelFlags decide the kernel, these
+# decide the pipeline that produces and installs it. Shared by every build of
+# one invocation, and never part of a build's identity.
+@dataclass(frozen=True)
+class BuildOptions:
+    # pack only the firmware the initramfs modules declare, not all of
+    # linux-firmware
+    filter_firmware: bool = False
+    # "all": every built module goes into the initramfs. "root": only what
+    # mounting / and importing its pools needs, with modules.dep closure.
+    initramfs_modules: str = "all"
+    # after modules_install: strip debug sections from every module, keeping
+    # a separate .debug copy when module_debuginfo is set
+    strip_modules: bool = False
+    module_debuginfo: bool = False
+    # after modules_install: zstd-compress every module
+    compress_modules: bool = False
+    # after every build: reflink modules identical across /lib/modules trees
+    dedupe_modules: bool = False
+    # total make jobs across all concurrent builds (default: cpu count)
+    jobs: int | None = None
+    # compile the kernels one after another instead of concurrently; each
+    # install still overlaps the next compile
+    serial_builds: bool = False
+    # share one make jobserver of `jobs` tokens across every make, genkernel
+    # and emerge, instead of a fixed -j per build
+    jobserver: bool = True
+    # cap jobs by available memory over a per-job estimate learned from
+    # history, and hold jobserver tokens back under memory pressure
+    adaptive_jobs: bool = True
+    # wrap the kernel compiler in ccache, shared across variant build dirs
+    ccache: bool = False
+    # time every object through a compiler shim and write a per-kver heatmap
+    # by source directory and gating CONFIG symbol
+    cc_timing: bool = False
+    # start a new variant's object dir as a clone of the closest existing one
+    clone_build_dir: bool = False
+    # seed builds of this run from one another's object dirs where that
+    # compiles fewer objects in total than each building in its own
+    schedule_builds: bool = False
+    # continue each build from its journal, skipping the phases an
+    # interrupted run already completed
+    resume: bool = False
+    # rebuild even when the build stamp says nothing changed
+    force_rebuild: bool = False
+    # keep compile outputs in a store keyed by source, .config and
+    # toolchain, and restore them instead of compiling on a hit
+    artifact_cache: bool = False
+    # compile with `make bzImage modules`, install with Kbuild's
+    # modules_install and install, and run genkernel only for the initramfs
+    direct_kbuild: bool = False
+    # configure and compile in object dirs on a tmpfs, copied in from the
+    # build root and back again: the installed kernel's modules build
+    # against the build root's copy
+    tmpfs_build: bool = False
+    # read the source tree into the page cache in parallel while configuring
+    prewarm_source: bool = False
+    # write each phase's command output to a compressed log under LOG_DIR,
+    # indexed by error line, as well as to the terminal; genkernel and emerge
+    # then write to a pipe rather than the terminal
+    phase_logs: bool = False
+    # run every child process in a cgroup v2 leaf of this run's own, with
+    # these limits when set; any limit implies the cgroup
+    cgroup: bool = False
+    cpu_weight: int | None = None
+    # cpus' worth of time per period, e.g. 6 or 2.5
+    cpu_max: float | None = None
+    io_weight: int | None = None
+    # io.max line, e.g. "259:0 rbps=209715200 wbps=104857600"
+    io_max: str | None = None
+    # memory.high: reclaim and throttle above this (e.g. 24G) instead of OOM
+    memory_high: str | None = None
+
+    def __post_init__(self) -> None:
+        if self.initramfs_modules not in ("all", "root"):
+            raise ValueError(
+                f"initramfs_modules must be 'all' or 'root', not {self.initramfs_modules!r}"
+            )
+        if self.module_debuginfo and not self.strip_modules:
+            raise ValueError("module_debuginfo only applies with strip_modules")
+        for name in ("cpu_weight", "io_weight"):
+            weight = getattr(self, name)
+            if weight is not None and not 1 <= weight <= 10000:
+                raise ValueError(f"{name} must be between 1 and 10000, not {weight}")
+        if self.cpu_max is not None and self.cpu_max <= 0:
+            raise ValueError(f"cpu_max must be a positive number of cpus, not {self.cpu_max}")
+
+    @property
+    def wants_cgroup(self) -> bool:
+        limits = (self.cpu_weight, self.cpu_max, self.io_weight, self.io_max, self.memory_high)
+        return self.cgroup or any(limit is not None for limit in limits)
 
 
 @dataclass
@@ -184,7 +300,7 @@ def _int_spec_apply(
     """Apply integer config values via scripts/config --set-val."""
     if not ispec:
         return
-    script_path = Path("/usr/src/linux/scripts/config")
+    script_path = _source_of(path.parent) / "scripts" / "config"
     for define, value in ispec.items():
         current = hs.Command(script_path)(
             "--file", path.as_posix(), "--state", define
@@ -231,7 +347,7 @@ def _str_spec_apply(
     """Apply string config values via scripts/config --set-str."""
     if not sspec:
         return
-    script_path = Path("/usr/src/linux/scripts/config")
+    script_path = _source_of(path.parent) / "scripts" / "config"
     for define, value in sspec.items():
         current = hs.Command(script_path)(
             "--file", path.as_posix(), "--state", define
@@ -401,7 +517,14 @@ def _filter_value_spec[T](vspec: dict[str, T], src: Path) -> dict[str, T]:
 _SOURCE_DIR = Path("/usr/src/linux")
 # One object dir per kver. The source tree stays pristine and holds no .config,
 # so nothing about a build lives anywhere two builds could contend for it.
-_BUILD_ROOT = Path("/usr/src/linux-build")
+# COMPILE_KERNEL_BUILD_ROOT puts them on a faster device.
+_BUILD_ROOT = Path(os.environ.get("COMPILE_KERNEL_BUILD_ROOT", "/usr/src/linux-build"))
+# --tmpfs-build: every build dir of a run lives here instead, for that run.
+# A sibling of the build root, so an object dir in either reaches the source
+# by the same relative path and ccache hits carry across the two.
+_TMPFS_BUILD_ROOT = _BUILD_ROOT.with_name(f"{_BUILD_ROOT.name}-tmpfs")
+# Persistent state that outlives any one build dir or /boot.
+_STATE_DIR = Path("/var/lib/compile-kernel")
 
 _VARIANT_RE = re.compile(r"^[a-z0-9][a-z0-9._+-]*$")
 
@@ -433,14 +556,293 @@ def _desired_localversion(variant: str | None) -> str:
     return f"{base}-{_validate_variant(variant)}"
 
 
-def _make(*args: str, build_dir: Path, capture: bool = False) -> str:
-    """Kbuild always runs out-of-tree: -C source, O=build_dir."""
-    cmd = ["make", "-C", _SOURCE_DIR.as_posix(), f"O={build_dir.as_posix()}", *args]
-    result = subprocess.run(cmd, capture_output=capture, check=True)
+class _Jobserver:
+    """A GNU make jobserver this process owns and every make descends from.
+
+    Concurrent builds, genkernel and emerges each started with their own -jN
+    add up to N x cpu_count jobs. Instead they all join one named-FIFO
+    jobserver (make >= 4.4, --jobserver-auth=fifo:PATH) preloaded with
+    tokens - 1 tokens, as make -jN itself does. Each top-level client also
+    holds the one implicit token make grants itself, so with k clients in
+    flight at most tokens + k - 1 jobs run.
+
+    Both FIFO ends stay open here, so a client opening it never blocks and
+    never sees EOF between other clients' reads and writes.
+
+    With FEATURES=userpriv, portage builds out-of-tree modules as the
+    portage user; the FIFO and its directory are opened to the portage
+    group so those makes join the pool instead of dropping to -j1.
+
+    Given a path, joins another process's jobserver (the serve daemon's)
+    instead: its tokens are already in the FIFO, and it removes the FIFO.
+    """
+
+    def __init__(self, tokens: int, *, path: Path | None = None) -> None:
+        self.tokens = tokens
+        self.owned = path is None
+        self._dir: Path | None = None
+        if path is not None:
+            self.path = path
+        else:
+            self._dir = Path(tempfile.mkdtemp(prefix="compile-kernel-jobserver-"))
+            self.path = self._dir / "fifo"
+            os.mkfifo(self.path, 0o600)
+            try:
+                portage_gid = grp.getgrnam("portage").gr_gid
+            except KeyError:
+                portage_gid = None
+            if portage_gid is not None:
+                for owned_path, mode in ((self._dir, 0o710), (self.path, 0o660)):
+                    os.chown(owned_path, -1, portage_gid)
+                    os.chmod(owned_path, mode)
+        self._rfd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        self._wfd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+        if self.owned:
+            os.write(self._wfd, b"+" * (tokens - 1))
+
+    def spec(self) -> str:
+        """The _SHARED_JOBSERVER_ENV value that has a child join this."""
+        return f"{self.tokens}:{self.path}"
+
+    def auth(self) -> str:
+        return f"--jobserver-auth=fifo:{self.path}"
+
+    def withhold(self) -> bool:
+        """Take one token out of circulation. False when every token is in
+        use; the caller retries and so takes the next one returned."""
+        try:
+            return len(os.read(self._rfd, 1)) == 1
+        except BlockingIOError:
+            return False
+
+    def release(self) -> None:
+        """Put back a token taken by withhold()."""
+        os.write(self._wfd, b"+")
+
+    def close(self) -> None:
+        os.close(self._rfd)
+        os.close(self._wfd)
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+
+
+# Set while compile_and_install_kernel runs with a jobserver; every make,
+# genkernel and emerge it starts is pointed at it.
+_JOBSERVER: _Jobserver | None = None
+# TOKENS:PATH of a jobserver to join rather than start: the serve daemon's,
+# shared by the batches it runs side by side.
+_SHARED_JOBSERVER_ENV = "COMPILE_KERNEL_JOBSERVER"
+
+
+def _make_supports_fifo_jobserver() -> bool:
+    # "GNU Make 4.4.1"
+    version = subprocess.run(
+        ["make", "--version"], capture_output=True, check=True
+    ).stdout.decode("utf8").splitlines()[0].split()[-1]
+    major, minor = (int(part) for part in version.split(".")[:2])
+    return (major, minor) >= (4, 4)
+
+
+@contextlib.contextmanager
+def _jobserver(tokens: int):
+    """Run the body with a shared jobserver of `tokens` tokens installed, or
+    without one (yielding None) when make is too old for FIFO auth. With
+    _SHARED_JOBSERVER_ENV set, that jobserver is joined instead."""
+    global _JOBSERVER
+    shared = os.environ.get(_SHARED_JOBSERVER_ENV)
+    if shared:
+        shared_tokens, shared_path = shared.split(":", 1)
+        _JOBSERVER = _Jobserver(int(shared_tokens), path=Path(shared_path))
+        eprint(f"jobserver: joining {shared_tokens} shared tokens at {shared_path}")
+    elif not _make_supports_fifo_jobserver():
+        icp("make < 4.4 has no fifo jobserver; each build gets its own -j")
+        yield None
+        return
+    else:
+        _JOBSERVER = _Jobserver(tokens)
+        eprint(f"jobserver: {tokens} tokens at {_JOBSERVER.path}")
+    try:
+        yield _JOBSERVER
+    finally:
+        _JOBSERVER.close()
+        _JOBSERVER = None
+
+
+# Set while compile_and_install_kernel runs with --ccache.
+_CCACHE = False
+
+
+@contextlib.contextmanager
+def _ccache(enabled: bool):
+    """Run the body with every kernel compile wrapped in ccache."""
+    global _CCACHE
+    if enabled and shutil.which("ccache") is None:
+        raise FileNotFoundError("--ccache given but ccache is not installed (dev-util/ccache)")
+    _CCACHE = enabled
+    try:
+        yield
+    finally:
+        _CCACHE = False
+
+
+def _ccache_env(build_dir: Path) -> dict[str, str]:
+    """ccache settings that let variant build dirs share cache entries.
+
+    Kbuild compiles from inside the object dir, so with the base dir at the
+    common parent of source and both build roots, every variant sees the
+    same relative paths (../../linux-6.x.y/mm/slub.c), on tmpfs or not. Debug info names the cwd,
+    which ccache would otherwise hash; hash_dir off trades an exact
+    DW_AT_comp_dir for the cross-variant hits. The stats log is per build
+    dir, so each build's hit rate can be reported on its own.
+    """
+    return {
+        "CCACHE_BASEDIR": os.path.commonpath(
+            [
+                _source_of(build_dir).resolve().as_posix(),
+                _BUILD_ROOT.as_posix(),
+                _TMPFS_BUILD_ROOT.as_posix(),
+            ]
+        ),
+        "CCACHE_NOHASHDIR": "1",
+        "CCACHE_STATSLOG": (build_dir / "ccache-stats.log").as_posix(),
+    }
+
+
+# Set while compile_and_install_kernel runs with --cc-timing.
+_CC_TIMING = False
+_CC_TIMING_SHIM = _STATE_DIR / "cc-timing-shim"
+# per build dir: one line per compiled object, written by the shim
+_CC_TIMING_LOG = "cc-times.tsv"
+
+# Runs in place of the compiler for every kernel object: execs the rest of
+# its argv, then appends object, wall seconds and peak RSS (KiB) to the log.
+# -SI keeps interpreter startup to the bare minimum, as it is paid per
+# object. Lines are short, so O_APPEND writes from concurrent jobs do not
+# interleave.
+_CC_TIMING_SHIM_SOURCE = """\
+import os
+import sys
+import time
+
+argv = sys.argv[1:]
+start = time.monotonic()
+pid = os.posix_spawnp(argv[0], argv, os.environ)
+_, status, usage = os.wait4(pid, 0)
+wall = time.monotonic() - start
+out = argv[argv.index("-o") + 1] if "-o" in argv[:-1] else ""
+log = os.environ.get("COMPILE_KERNEL_CC_TIMING_LOG")
+if log and status == 0 and out.endswith(".o"):
+    with open(log, "a") as f:
+        f.write(f"{os.path.abspath(out)}\\t{wall:.3f}\\t{usage.ru_maxrss}\\n")
+sys.exit(os.waitstatus_to_exitcode(status))
+"""
+
+
+@contextlib.contextmanager
+def _cc_timing(enabled: bool):
+    """Run the body with every kernel compile going through the timing shim."""
+    global _CC_TIMING
+    if enabled:
+        _CC_TIMING_SHIM.parent.mkdir(parents=True, exist_ok=True)
+        _CC_TIMING_SHIM.write_text(
+            f"#!{sys.executable} -SI\n{_CC_TIMING_SHIM_SOURCE}", encoding="utf8"
+        )
+        _CC_TIMING_SHIM.chmod(0o755)
+    _CC_TIMING = enabled
+    try:
+        yield
+    finally:
+        _CC_TIMING = False
+
+
+def _kernel_cc() -> str | None:
+    """CC for kernel objects when something wraps gcc, else None for
+    Kbuild's own. The timing shim goes outermost, so it times ccache's
+    hits and misses as the build experienced them."""
+    wrappers = []
+    if _CC_TIMING:
+        wrappers.append(_CC_TIMING_SHIM.as_posix())
+    if _CCACHE:
+        wrappers.append("ccache")
+    return " ".join([*wrappers, "gcc"]) if wrappers else None
+
+
+def _cc_args() -> list[str]:
+    """Kbuild assigns CC in its Makefile, so only a command-line CC= reaches
+    it. HOSTCC is left alone: genkernel cannot be handed a matching one, and
+    a HOSTCC that differs between two makes of one object dir rebuilds
+    objtool, which every object depends on.
+
+    CC is in every object's saved command line, so switching a wrapper on
+    or off recompiles the whole build dir once."""
+    cc = _kernel_cc()
+    return [f"CC={cc}"] if cc is not None else []
+
+
+def _ccache_stats(build_dir: Path) -> tuple[int, int] | None:
+    """(hits, misses) ccache logged for build_dir, or None without a log."""
+    log = build_dir / "ccache-stats.log"
+    if not log.exists():
+        return None
+    result = subprocess.run(
+        ["ccache", "--print-log-stats"],
+        capture_output=True,
+        check=True,
+        env=os.environ | {"CCACHE_STATSLOG": log.as_posix()},
+    )
+    stats: dict[str, int] = {}
+    for line in result.stdout.decode("utf8").splitlines():
+        key, _, value = line.partition("\t")
+        if value.strip().isdigit():
+            stats[key] = int(value)
+    hits = stats.get("direct_cache_hit", 0) + stats.get("preprocessed_cache_hit", 0)
+    return hits, stats.get("cache_miss", 0)
+
+
+def _make_env(build_dir: Path | None = None) -> dict[str, str]:
+    """Environment for make and genkernel: joins the jobserver when there is
+    one. Anything make starts inherits MAKEFLAGS, down to Kbuild's submakes."""
+    env = os.environ.copy()
+    if _JOBSERVER is not None:
+        env["MAKEFLAGS"] = f"-j{_JOBSERVER.tokens} {_JOBSERVER.auth()}"
+    if _CCACHE and build_dir is not None:
+        env.update(_ccache_env(build_dir))
+    if _CC_TIMING and build_dir is not None:
+        env["COMPILE_KERNEL_CC_TIMING_LOG"] = (build_dir / _CC_TIMING_LOG).as_posix()
+    return env
+
+
+def _jobs_args(jobs: int) -> list[str]:
+    """make arguments for a build's parallelism. An explicit -j would make
+    a client leave the jobserver, so with one there is none."""
+    return [] if _JOBSERVER is not None else [f"-j{jobs}"]
+
+
+def _makeopts(jobs: int) -> str:
+    """MAKEOPTS for genkernel and ebuilds, which put it on make's command
+    line: the jobserver auth itself, or a plain -j without one."""
+    return _JOBSERVER.auth() if _JOBSERVER is not None else f"-j{jobs}"
+
+
+def _make(
+    *args: str, build_dir: Path, source: Path | None = None, capture: bool = False
+) -> str:
+    """Kbuild always runs out-of-tree: -C source, O=build_dir. The source is
+    the one build_dir was set up against unless given."""
+    cmd = [
+        "make",
+        "-C",
+        (source or _source_of(build_dir)).as_posix(),
+        f"O={build_dir.as_posix()}",
+        *_cc_args(),
+        *args,
+    ]
+    output = {"capture_output": True} if capture else _log_output()
+    result = subprocess.run(cmd, check=True, env=_make_env(build_dir), **output)
     return result.stdout.decode("utf8").strip() if capture else ""
 
 
-def _ensure_pristine_source() -> None:
+def _ensure_pristine_source(source: Path = _SOURCE_DIR) -> None:
     """Clear generated files out of the source tree so O= builds can run.
 
     Kbuild's outputmakefile target refuses an out-of-tree build while the
@@ -452,40 +854,40 @@ def _ensure_pristine_source() -> None:
     untouched, and /boot and /lib/modules are not involved.
     """
     markers = [
-        _SOURCE_DIR / ".config",
-        _SOURCE_DIR / "include" / "config",
+        source / ".config",
+        source / "include" / "config",
     ]
     # kbuild only checks the current SRCARCH, but any arch's generated dir
     # means a prior in-tree build, so treat them all as dirty.
-    markers.extend((_SOURCE_DIR / "arch").glob("*/include/generated"))
+    markers.extend((source / "arch").glob("*/include/generated"))
     dirty = [m for m in markers if m.exists()]
     if not dirty:
         return
 
     eprint(f"source tree is not clean: {[str(d) for d in dirty]}")
-    eprint(f"running make mrproper in {_SOURCE_DIR}")
-    subprocess.run(["make", "-C", _SOURCE_DIR.as_posix(), "mrproper"], check=True)
+    eprint(f"running make mrproper in {source}")
+    subprocess.run(["make", "-C", source.as_posix(), "mrproper"], check=True)
 
     still = [m for m in markers if m.exists()]
     if still:
         raise RuntimeError(
-            f"mrproper left generated files in {_SOURCE_DIR}: "
+            f"mrproper left generated files in {source}: "
             f"{[str(s) for s in still]} — remove them before building"
         )
 
 
-def _source_kernelversion() -> str:
+def _source_kernelversion(source: Path = _SOURCE_DIR) -> str:
     """VERSION.PATCHLEVEL.SUBLEVEL + EXTRAVERSION from the source Makefile.
     Needs no .config, so it is available before a build dir exists."""
     result = subprocess.run(
-        ["make", "-s", "-C", _SOURCE_DIR.as_posix(), "kernelversion"],
+        ["make", "-s", "-C", source.as_posix(), "kernelversion"],
         capture_output=True,
         check=True,
     )
     return result.stdout.decode("utf8").strip()
 
 
-def _kver_for_variant(variant: str | None) -> str:
+def _kver_for_variant(variant: str | None, source: Path = _SOURCE_DIR) -> str:
     """Predict kernel.release for a variant before its build dir exists.
 
     Holds because production base pins CONFIG_LOCALVERSION_AUTO=n; the
@@ -493,27 +895,48 @@ def _kver_for_variant(variant: str | None) -> str:
     resolved, so a drift here fails loudly rather than silently naming a
     directory wrong.
     """
-    return _source_kernelversion() + _desired_localversion(variant)
+    return _source_kernelversion(source) + _desired_localversion(variant)
 
 
 def _build_dir(kver: str) -> Path:
-    return _BUILD_ROOT / kver
+    return (_TMPFS_BUILD_ROOT if _BUILD_IN_TMPFS else _BUILD_ROOT) / kver
 
 
 def _kernelrelease(build_dir: Path) -> str:
     return _make("-s", "kernelrelease", build_dir=build_dir, capture=True)
 
 
-def _ensure_build_dir(kver: str) -> Path:
+def _ensure_build_dir(
+    kver: str,
+    *,
+    source: Path = _SOURCE_DIR,
+    flags: KernelFlags | None = None,
+    clone_closest: bool = False,
+) -> Path:
     """Create this kver's object dir and seed a .config to start from.
 
     Seeds from the running kernel's config when available so a new variant
     inherits the current hardware setup rather than a bare defconfig; the
     spec layers then assert everything that matters on top.
+
+    With clone_closest, a new object dir is instead cloned whole from the
+    most similar existing build of the same source (_closest_build_dir), so
+    Kbuild only recompiles what the config delta touches.
+
+    Either way the object dir's Makefile names `source`, which is how every
+    later make, genkernel and emerge against it finds its source tree.
     """
     build_dir = _build_dir(kver)
-    build_dir.mkdir(parents=True, exist_ok=True)
     config = build_dir / ".config"
+    if clone_closest and not config.exists():
+        closest = _closest_build_dir(kver, flags or KernelFlags(), source)
+        if closest is not None:
+            with _reading_build_dir(closest.name) as readable:
+                if readable:
+                    _clone_build_dir(closest, build_dir)
+                    return build_dir
+            eprint(f"{closest} started building meanwhile; not cloning it")
+    build_dir.mkdir(parents=True, exist_ok=True)
     if not config.exists():
         running_config = Path("/proc/config.gz")
         if running_config.exists():
@@ -522,10 +945,148 @@ def _ensure_build_dir(kver: str) -> Path:
                 config.write_bytes(f_in.read())
         else:
             eprint(f"seeding {config} from make defconfig")
-            _make("defconfig", build_dir=build_dir)
+            _make("defconfig", build_dir=build_dir, source=source)
+    _make("outputmakefile", build_dir=build_dir, source=source)
     return build_dir
 
 
+def _build_dir_source(build_dir: Path) -> Path | None:
+    """The source tree an object dir was configured against. Kbuild's
+    generated Makefile in the object dir includes the source Makefile by its
+    resolved path."""
+    makefile = build_dir / "Makefile"
+    if not makefile.exists():
+        return None
+    for line in makefile.read_text(encoding="utf8").splitlines():
+        if line.startswith("include ") and line.endswith("/Makefile"):
+            return Path(line[len("include "):]).parent
+    return None
+
+
+def _source_of(build_dir: Path) -> Path:
+    """The source tree build_dir was set up against, or _SOURCE_DIR for a
+    dir not set up yet (or not an object dir at all)."""
+    source = _build_dir_source(build_dir)
+    return source if source is not None and source.is_absolute() else _SOURCE_DIR
+
+
+_BUILD_DIR_LOCKS = _STATE_DIR / "build-dir-locks"
+# kvers whose object dirs this process holds with _writing_build_dirs
+_WRITING: set[str] = set()
+
+
+@contextlib.contextmanager
+def _writing_build_dirs(kvers: list[str]):
+    """Run the body holding an exclusive flock per kver, marking its object
+    dir as being written: another compile-kernel process (a serve daemon
+    worker running beside this one) then never clones it half-built."""
+    _BUILD_DIR_LOCKS.mkdir(parents=True, exist_ok=True)
+    with contextlib.ExitStack() as stack:
+        for kver in sorted(kvers):
+            fd = os.open(_BUILD_DIR_LOCKS / kver, os.O_RDWR | os.O_CREAT, 0o600)
+            stack.callback(os.close, fd)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            _WRITING.add(kver)
+            stack.callback(_WRITING.discard, kver)
+        yield
+
+
+@contextlib.contextmanager
+def _reading_build_dir(kver: str):
+    """Run the body holding a shared flock on kver's object dir, yielding
+    whether it could be had without waiting: False while another process
+    writes it. This process's own dirs are readable; it reads them only
+    before it compiles them."""
+    if kver in _WRITING:
+        yield True
+        return
+    _BUILD_DIR_LOCKS.mkdir(parents=True, exist_ok=True)
+    fd = os.open(_BUILD_DIR_LOCKS / kver, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+        else:
+            yield True
+    finally:
+        os.close(fd)
+
+
+def _closest_build_dir(kver: str, flags: KernelFlags, source: Path) -> Path | None:
+    """The existing object dir of the same source closest to a new build.
+
+    Closest first by debug groups (the flags recorded for each kver), since
+    those are what variants differ in, then by how many symbols its .config
+    differs from the running kernel's, which is what a fresh dir would be
+    seeded from. Dirs holding other source versions are never considered:
+    none of their objects could be reused.
+    """
+    if not _BUILD_ROOT.is_dir():
+        return None
+    version = _source_kernelversion(source)
+    source = source.resolve()
+    seed: dict[str, str] = {}
+    if Path("/proc/config.gz").exists():
+        seed = _parse_config_state(read_content_of_kernel_config(Path("/proc/config.gz")))
+    wanted = set(flags.labels())
+
+    scored: list[tuple[int, int, str, Path]] = []
+    for candidate in _BUILD_ROOT.iterdir():
+        if candidate.name == kver or not candidate.name.startswith(f"{version}-"):
+            continue
+        if not (candidate / ".config").exists() or not (candidate / "vmlinux").exists():
+            continue  # never compiled: nothing to reuse
+        with _reading_build_dir(candidate.name) as readable:
+            if not readable:
+                continue  # mid-build in another process
+        if _build_dir_source(candidate) != source:
+            continue
+        recorded = set(_read_kernel_flags(candidate.name) or [])
+        config = _parse_config_state((candidate / ".config").read_text(encoding="utf8"))
+        config_distance = sum(
+            1 for sym in seed.keys() | config.keys() if seed.get(sym, "n") != config.get(sym, "n")
+        )
+        scored.append((len(wanted ^ recorded), config_distance, candidate.name, candidate))
+    if not scored:
+        return None
+    return min(scored)[-1]
+
+
+# Per-build bookkeeping kept in an object dir that a clone must not inherit.
+_BUILD_DIR_PRIVATE = (
+    "ccache-stats.log",
+    "initramfs-overlay",
+    "compile-kernel.stamp",
+    "compile-kernel.journal",
+    "compile-kernel.restored",
+    "cc-times.tsv",
+)
+
+
+def _clone_build_dir(source: Path, build_dir: Path) -> None:
+    """Copy source's object dir to build_dir, sharing extents where the
+    filesystem can (btrfs, xfs, zfs with block cloning), so the clone is
+    nearly free. Every file gets its own inode: Kbuild rewrites objects in
+    place, so hardlinks would leak one variant's rebuild into the other."""
+    eprint(f"cloning {source} -> {build_dir} (reflink where supported)")
+    build_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp = build_dir.with_name(f".{build_dir.name}.clone")
+    shutil.rmtree(tmp, ignore_errors=True)
+    subprocess.run(
+        ["cp", "-a", "--reflink=auto", source.as_posix(), tmp.as_posix()],
+        check=True,
+    )
+    for name in _BUILD_DIR_PRIVATE:
+        private = tmp / name
+        if private.is_dir():
+            shutil.rmtree(private)
+        else:
+            private.unlink(missing_ok=True)
+    # rename last, so an interrupted clone never looks like a build dir
+    tmp.rename(build_dir)
+
+
 def _link_module_build_dir(kver: str, build_dir: Path) -> None:
     """Point /lib/modules/{kver}/{build,source} at this kver's object dir and
     the source tree.
@@ -536,7 +1097,10 @@ def _link_module_build_dir(kver: str, build_dir: Path) -> None:
     """
     mod_dir = Path("/lib/modules") / kver
     mod_dir.mkdir(parents=True, exist_ok=True)
-    for name, target in (("build", build_dir), ("source", _SOURCE_DIR)):
+    source = _source_of(build_dir)
+    # where the object dir lives once this run is over, not its tmpfs copy
+    build_dir = _BUILD_ROOT / build_dir.name
+    for name, target in (("build", build_dir), ("source", source)):
         link = mod_dir / name
         if link.is_symlink() and Path(os.readlink(link)) == target:
             continue
@@ -633,8 +1197,14 @@ def _emerge_env(build_dir: Path) -> dict[str, str]:
     against. It is the highest-priority source the eclass consults, and the
     eclass dies if it points nowhere, so an emerge can never silently target
     the wrong kernel."""
-    env = os.environ.copy()
+    env = _make_env()
     env["KBUILD_OUTPUT"] = build_dir.as_posix()
+    # the eclass takes the source from KERNEL_DIR, /usr/src/linux by default
+    env["KERNEL_DIR"] = _source_of(build_dir).as_posix()
+    if _JOBSERVER is not None:
+        # emake passes MAKEOPTS on the command line, where make.conf's -jN
+        # would otherwise take the package build out of the jobserver
+        env["MAKEOPTS"] = _JOBSERVER.auth()
     return env
 
 
@@ -652,18 +1222,11 @@ def _resolve_and_verify_config(
     symbol nor resolve choice blocks, so e.g. UNWINDER_FRAME_POINTER=y exists
     in .config while FRAME_POINTER does not until olddefconfig runs.
     """
-    _make("olddefconfig", build_dir=build_dir)
+    with _phase("olddefconfig"):
+        _make("olddefconfig", build_dir=build_dir)
 
     path = build_dir / ".config"
-    content = path.read_text(encoding="utf8", errors="replace")
-    state: dict[str, str] = {}
-    for line in content.splitlines():
-        line = line.strip()
-        if line.startswith("# CONFIG_") and line.endswith(" is not set"):
-            state[line[2:].split(" ", 1)[0]] = "n"
-        elif line.startswith("CONFIG_") and "=" in line:
-            sym, val = line.split("=", 1)
-            state[sym] = val.strip().strip('"')
+    state = _parse_config_state(path.read_text(encoding="utf8", errors="replace"))
 
     missing: list[tuple[str, str, str]] = []
     for define, opt in spec.items():
@@ -683,7 +1246,7 @@ def _resolve_and_verify_config(
             missing.append((define, str(ivalue), got))
 
     if missing:
-        index = _kconfig_index(_SOURCE_DIR)
+        index = _kconfig_index(_source_of(build_dir))
         eprint("WARNING: the following required symbols did not survive olddefconfig:")
         for sym, want, got in missing:
             meta = _kmeta(sym, index)
@@ -780,6 +1343,197 @@ def read_content_of_kernel_config(path: Path):
     return content
 
 
+def _parse_config_state(content: str) -> dict[str, str]:
+    """{CONFIG_X: value} for every symbol a .config mentions. `# ... is not
+    set` lines map to "n"; string values are unquoted."""
+    state: dict[str, str] = {}
+    for line in content.splitlines():
+        line = line.strip()
+        if line.startswith("# CONFIG_") and line.endswith(" is not set"):
+            state[line[2:].split(" ", 1)[0]] = "n"
+        elif line.startswith("CONFIG_") and "=" in line:
+            sym, val = line.split("=", 1)
+            state[sym] = val.strip().strip('"')
+    return state
+
+
+MODULE_USAGE_FILE = _STATE_DIR / "module-usage.json"
+
+
+def _loaded_modules() -> set[str]:
+    """Names of the modules loaded right now, straight from /proc/modules
+    (what lsmod formats). Names use underscores, as the kernel reports them."""
+    text = Path("/proc/modules").read_text(encoding="utf8")
+    return {line.split(" ", 1)[0] for line in text.splitlines() if line}
+
+
+def _read_module_usage(state_file: Path) -> dict:
+    """The collector's state: when collection started, how many samples were
+    taken, and {module: [first_seen, last_seen]} as unix seconds."""
+    if not state_file.exists():
+        return {"since": int(time.time()), "samples": 0, "modules": {}}
+    return json.loads(state_file.read_text(encoding="utf8"))
+
+
+def _write_module_usage(state_file: Path, usage: dict) -> None:
+    # write-then-rename so a collector killed mid-write never truncates days
+    # of history
+    state_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = state_file.with_name(state_file.name + ".tmp")
+    tmp.write_text(json.dumps(usage, sort_keys=True) + "\n", encoding="utf8")
+    tmp.rename(state_file)
+
+
+def _merge_module_usage(usage: dict, names: set[str]) -> list[str]:
+    """Fold one observation into usage. Returns the names never seen before."""
+    now = int(time.time())
+    modules = usage["modules"]
+    new = sorted(name for name in names if name not in modules)
+    for name in names:
+        first = modules.get(name, [now, now])[0]
+        modules[name] = [first, now]
+    usage["samples"] += 1
+    return new
+
+
+def collect_module_usage(
+    *,
+    state_file: Path = MODULE_USAGE_FILE,
+    interval: int = 300,
+    udev: bool = True,
+    once: bool = False,
+) -> None:
+    """Record the union of every module ever seen loaded into state_file.
+
+    A single lsmod is a snapshot: a USB driver, a filesystem or a netfilter
+    match that loads once a week is absent from it, and a config trimmed from
+    that snapshot breaks the rare path. Run this for days and the union
+    approaches what the host actually uses.
+
+    /proc/modules is sampled every `interval` seconds. With `udev`, module
+    add events from `udevadm monitor` are also recorded as they happen, which
+    catches modules that load and unload between two samples.
+    """
+    usage = _read_module_usage(state_file)
+    new = _merge_module_usage(usage, _loaded_modules())
+    _write_module_usage(state_file, usage)
+    eprint(f"module usage: {len(usage['modules'])} modules known, {len(new)} new")
+    if once:
+        return
+
+    monitor: subprocess.Popen | None = None
+    if udev and shutil.which("udevadm"):
+        monitor = subprocess.Popen(
+            ["udevadm", "monitor", "--kernel", "--subsystem-match=module"],
+            stdout=subprocess.PIPE,
+            # unbuffered: select() sees the pipe, not lines Python has
+            # already read ahead into a buffer
+            bufsize=0,
+        )
+    elif udev:
+        eprint("udevadm not found; sampling /proc/modules on the timer only")
+
+    next_sample = time.monotonic() + interval
+    pending = b""
+    try:
+        while True:
+            timeout = max(next_sample - time.monotonic(), 0)
+            names: set[str] = set()
+            if monitor is not None:
+                ready, _, _ = select.select([monitor.stdout], [], [], timeout)
+                if ready:
+                    chunk = os.read(monitor.stdout.fileno(), 2**16)
+                    if not chunk:
+                        raise RuntimeError("udevadm monitor exited")
+                    *lines, pending = (pending + chunk).split(b"\n")
+                    for line in lines:
+                        # KERNEL[1234.5678] add      /module/xhci_pci (module)
+                        parts = line.decode("utf8", "replace").split()
+                        if len(parts) >= 3 and parts[1] == "add" and parts[2].startswith("/module/"):
+                            names.add(parts[2][len("/module/"):])
+            else:
+                time.sleep(timeout)
+            if time.monotonic() >= next_sample:
+                names |= _loaded_modules()
+                next_sample = time.monotonic() + interval
+            if not names:
+                continue
+            new = _merge_module_usage(usage, names)
+            _write_module_usage(state_file, usage)
+            if new:
+                eprint(f"module usage: first seen {new}")
+    finally:
+        if monitor is not None:
+            monitor.terminate()
+
+
+def module_usage_report(
+    *,
+    kernel_dir: Path,
+    dotconfig: Path,
+    state_file: Path = MODULE_USAGE_FILE,
+) -> tuple[list[str], list[str]]:
+    """Split dotconfig's =m symbols into (keep, candidates to disable) using
+    the collected module union. Prints both lists and returns them.
+
+    Only modular symbols are judged: a built-in driver never appears in
+    /proc/modules, so its absence there says nothing about whether it is used.
+    Symbols whose objects the Makefile scan cannot map are kept.
+    """
+    usage = _read_module_usage(state_file)
+    if not usage["samples"]:
+        raise ValueError(f"no module usage recorded in {state_file}")
+    used = set(usage["modules"])
+    days = (int(time.time()) - usage["since"]) / 86400
+    eprint(
+        f"module usage: {len(used)} modules over {usage['samples']} samples "
+        f"and {days:.1f} days"
+    )
+    if days < 7:
+        eprint("WARNING: under a week of history; rarely loaded modules are likely missing")
+
+    state = _parse_config_state(read_content_of_kernel_config(dotconfig))
+    config_objects = generate_module_config_dict(path=kernel_dir)
+
+    keep: list[str] = []
+    candidates: list[str] = []
+    unmapped: list[str] = []
+    for define, value in sorted(state.items()):
+        if value != "m":
+            continue
+        objects = config_objects.get(define[len("CONFIG_"):])
+        if not objects:
+            unmapped.append(define)
+            continue
+        modules = {o[: -len(".o")].replace("-", "_") for o in objects}
+        if modules & used:
+            keep.append(define)
+        else:
+            candidates.append(define)
+
+    # the converse: a module seen loaded whose symbol this config drops
+    missing = [
+        f"CONFIG_{symbol}"
+        for symbol, objects in config_objects.items()
+        if {o[: -len(".o")].replace("-", "_") for o in objects} & used
+        and state.get(f"CONFIG_{symbol}", "n") == "n"
+    ]
+
+    print(f"keep ({len(keep)}):")
+    for define in keep:
+        print(f"  {define}")
+    print(f"candidate to disable ({len(candidates)}):")
+    for define in candidates:
+        print(f"  {define}")
+    if unmapped:
+        print(f"kept, no module mapping ({len(unmapped)}):")
+        for define in unmapped:
+            print(f"  {define}")
+    for define in sorted(missing):
+        print(f"WARNING: {define} is not enabled but its module was seen loaded")
+    return keep, candidates
+
+
 def _detect_cpu_march_symbol() -> str:
     """Inspect /proc/cpuinfo and return the most specific CONFIG_M* march
     symbol the running CPU should be compiled for, or "CONFIG_GENERIC_CPU"
@@ -1238,7 +1992,7 @@ def get_set_kernel_config_option(
         USED_SYMBOL_SET.add(define)
     if not state:
         assert not module
-    script_path = Path("/usr/src/linux/scripts/config")
+    script_path = _source_of(path.parent) / "scripts" / "config"
     config_command = hs.Command(script_path)
     config_command.bake("--file", path.as_posix())
 
@@ -4987,9 +5741,10 @@ def check_kernel_config(
     )
 
     if build_dir is not None:
-        spec = _filter_spec_for_kernel(spec, _SOURCE_DIR)
-        ispec = _filter_value_spec(ispec, _SOURCE_DIR)
-        sspec = _filter_value_spec(sspec, _SOURCE_DIR)
+        source = _source_of(build_dir)
+        spec = _filter_spec_for_kernel(spec, source)
+        ispec = _filter_value_spec(ispec, source)
+        sspec = _filter_value_spec(sspec, source)
 
     # --- apply merged spec — each symbol written exactly once ---
     _spec_apply(
@@ -5088,8 +5843,7 @@ def _ensure_nvidia_or_fallback(
             "--quiet-build=y",
             "x11-drivers/nvidia-drivers",
             _env=env,
-            _out=sys.stdout,
-            _err=sys.stderr,
+            **_hs_output(_out=sys.stdout, _err=sys.stderr),
         )
         _assert_modules_landed(kver=kver, since=since)
         icp("nvidia-drivers built; staying on nvidia")
@@ -5105,7 +5859,7 @@ def _ensure_nvidia_or_fallback(
     if _package_is_installed("x11-drivers/nvidia-drivers"):
         hs.Command("emerge")(
             "--unmerge", "--quiet=y", "x11-drivers/nvidia-drivers",
-            _env=env, _out=sys.stdout, _err=sys.stderr,
+            _env=env, **_hs_output(_out=sys.stdout, _err=sys.stderr),
         )
     else:
         icp("nvidia-drivers not installed; nothing to unmerge")
@@ -5115,9 +5869,9 @@ def _ensure_nvidia_or_fallback(
 def _set_video_group(cfg_layer: str, group: str) -> None:
     # selecting a dimension records the choice; sync is what materializes it
     hs.Command(cfg_layer)(
-        "dimension", "set", "video", group, _out=sys.stdout, _err=sys.stderr
+        "dimension", "set", "video", group, **_hs_output(_out=sys.stdout, _err=sys.stderr)
     )
-    hs.Command(cfg_layer)("sync", _out=sys.stdout, _err=sys.stderr)
+    hs.Command(cfg_layer)("sync", **_hs_output(_out=sys.stdout, _err=sys.stderr))
 
 
 def _emerge_zfs_module_rebuild(*, build_dir: Path, kver: str) -> None:
@@ -5127,13 +5881,114 @@ def _emerge_zfs_module_rebuild(*, build_dir: Path, kver: str) -> None:
         "zfs",
         "@module-rebuild",
         _env=_emerge_env(build_dir),
-        _out=sys.stdout,
-        _err=sys.stderr,
+        **_hs_output(_out=sys.stdout, _err=sys.stderr),
     )
     _assert_modules_landed(kver=kver, since=since)
 
 
+# Make variables from the environment that change what the tools produce.
+_TOOLCHAIN_MAKE_VARS = (
+    "ARCH",
+    "CROSS_COMPILE",
+    "LLVM",
+    "KCFLAGS",
+    "KCPPFLAGS",
+    "KAFLAGS",
+    "KRUSTFLAGS",
+    "HOSTCFLAGS",
+    "HOSTLDFLAGS",
+)
+# the toolchain a build dir's objects were made with
+_TOOLCHAIN_RECORD = "compile-kernel.toolchain"
+
+
+def _tool_version(*cmd: str) -> str:
+    """First line of a tool's version output, or "" if it is not installed."""
+    try:
+        result = subprocess.run(cmd, capture_output=True, check=True)
+    except (FileNotFoundError, subprocess.CalledProcessError):
+        return ""
+    lines = result.stdout.decode("utf8").splitlines()
+    return lines[0] if lines else ""
+
+
+def _toolchain_fingerprint() -> dict[str, str]:
+    """Everything outside the source and .config that the kernel's objects
+    are a function of: each tool's exact version, the gcc plugin ABI, and
+    the make variables passed down through the environment."""
+    plugin_dir = Path(_tool_version("gcc", "-print-file-name=plugin"))
+    plugin_header = plugin_dir / "include" / "plugin-version.h"
+    return {
+        "gcc": _tool_version("gcc", "--version"),
+        "ld": _tool_version("ld", "--version"),
+        "as": _tool_version("as", "--version"),
+        "pahole": _tool_version("pahole", "--version"),
+        "plugin": f"{plugin_dir}:{_file_sha256(plugin_header) if plugin_header.exists() else ''}",
+        **{f"make:{var}": os.environ.get(var, "") for var in _TOOLCHAIN_MAKE_VARS},
+    }
+
+
+def _relink_outputs(build_dir: Path) -> list[Path]:
+    """What ld and pahole produce: vmlinux and its intermediate links, BTF,
+    the boot image, and every module's final .ko link. Kbuild would not
+    redo these by itself, as their command lines name the tools, not their
+    versions."""
+    outputs: list[Path] = []
+    for pattern in ("vmlinux*", ".tmp_vmlinux*", ".vmlinux*", "System.map"):
+        outputs.extend(build_dir.glob(pattern))
+    boot = build_dir / "arch" / "x86" / "boot"
+    outputs.extend(boot.glob("bzImage"))
+    outputs.extend(boot.glob("compressed/vmlinux*"))
+    outputs.extend(build_dir.rglob("*.ko"))
+    return outputs
+
+
 def gcc_check(*, build_dir: Path) -> None:
+    """Invalidate what a toolchain change left stale in the build dir, and
+    no more.
+
+    The fingerprint the objects were made with is recorded in the build
+    dir. Against it:
+
+    - gcc itself needs nothing here: every object force-includes
+      compiler-version.h, which depends on CONFIG_CC_VERSION_TEXT, so Kbuild
+      rebuilds them all once olddefconfig has updated it. The gcc plugins
+      are host objects built against gcc's plugin headers and are not
+      covered, so a new gcc or plugin ABI drops scripts/gcc-plugins.
+    - ld or pahole: the link outputs and BTF are dropped, so vmlinux and
+      the modules relink against unchanged objects.
+    - as, or a different target (ARCH, CROSS_COMPILE, LLVM): every object
+      is suspect, so make clean.
+    - flag variables (KCFLAGS, ...) need nothing: they are in each object's
+      saved command line, and Kbuild rebuilds on a changed command line.
+
+    A build dir from before fingerprints were recorded falls back to
+    comparing the gcc major with CONFIG_GCC_VERSION.
+    """
+    current = _toolchain_fingerprint()
+    record = build_dir / _TOOLCHAIN_RECORD
+    if not record.exists():
+        _gcc_major_check(build_dir=build_dir)
+    else:
+        recorded = json.loads(record.read_text(encoding="utf8"))
+        changed = {key for key in current if current[key] != recorded.get(key)}
+        icp(f"toolchain changes in {build_dir}: {sorted(changed)}")
+        if changed & {"as", "make:ARCH", "make:CROSS_COMPILE", "make:LLVM"}:
+            eprint(f"toolchain changed ({', '.join(sorted(changed))}); cleaning {build_dir}")
+            _make("clean", build_dir=build_dir)
+        else:
+            if changed & {"gcc", "plugin"}:
+                eprint(f"gcc changed; dropping gcc plugins in {build_dir}")
+                shutil.rmtree(build_dir / "scripts" / "gcc-plugins", ignore_errors=True)
+            if changed & {"ld", "pahole"}:
+                stale = _relink_outputs(build_dir)
+                eprint(f"ld/pahole changed; dropping {len(stale)} link and BTF outputs in {build_dir}")
+                for path in stale:
+                    path.unlink(missing_ok=True)
+    record.write_text(json.dumps(current, indent=2, sort_keys=True) + "\n", encoding="utf8")
+
+
+def _gcc_major_check(*, build_dir: Path) -> None:
     """Force a clean when the compiler changed under an existing build dir.
     Objects from a different gcc major cannot be linked against new ones."""
     version_line = hs.Command("gcc")("--version").splitlines()[0]
@@ -5151,106 +6006,807 @@ def gcc_check(*, build_dir: Path) -> None:
         _make("clean", build_dir=build_dir)
 
 
-KERNEL_FLAGS_DIR = Path("/boot/compile-kernel-flags")
+# Out-of-tree modules built against each kernel; a new version of any of them
+# means the installed /lib/modules tree is stale.
+_EXTERNAL_MODULE_ATOMS = ("sys-fs/zfs", "sys-fs/zfs-kmod", "x11-drivers/nvidia-drivers")
 
 
-def _write_kernel_flags(kver: str, labels: list[str]) -> None:
-    """Write active debug groups for kver to /boot/compile-kernel-flags/{kver}.
-    Empty list writes an empty file (clean kernel — no flags).
+def _installed_versions(atoms: tuple[str, ...]) -> dict[str, list[str]]:
+    import portage
+
+    vardb = portage.db[portage.root]["vartree"].dbapi
+    return {atom: sorted(vardb.match(atom)) for atom in atoms}
+
+
+def _build_stamp_path(build_dir: Path) -> Path:
+    return build_dir / "compile-kernel.stamp"
+
+
+def _build_inputs(*, build_dir: Path, flags: KernelFlags, options: BuildOptions) -> dict:
+    """Everything the installed kernel, modules and initramfs are a function
+    of. Equal inputs mean a rebuild would reproduce what is installed."""
+    return {
+        "config_sha256": _file_sha256(build_dir / ".config"),
+        "source": _source_kernelversion(_source_of(build_dir)),
+        "toolchain": _toolchain_fingerprint(),
+        "external_modules": _installed_versions(_EXTERNAL_MODULE_ATOMS),
+        "flags": flags.labels(),
+        "cmdline": flags.cmdline(),
+        # the install-shaping options; how the compile is scheduled does not
+        # change its output
+        "install": {
+            "filter_firmware": options.filter_firmware,
+            "initramfs_modules": options.initramfs_modules,
+            "strip_modules": options.strip_modules,
+            "module_debuginfo": options.module_debuginfo,
+            "compress_modules": options.compress_modules,
+        },
+    }
+
+
+def _unchanged_since_last_build(
+    *, build_dir: Path, kver: str, inputs: dict
+) -> str | None:
+    """Why a rebuild of kver can be skipped, or None if it cannot.
+
+    Skippable when the stamp of its last successful build records the same
+    inputs and that build's artifacts are still in /boot and /lib/modules.
     """
-    KERNEL_FLAGS_DIR.mkdir(parents=True, exist_ok=True)
-    flag_file = KERNEL_FLAGS_DIR / kver
-    flag_file.write_text(" ".join(labels) + "\n" if labels else "\n", encoding="utf8")
-    eprint(f"wrote kernel flags for {kver}: {labels}")
+    stamp = _build_stamp_path(build_dir)
+    if not stamp.exists():
+        icp(f"no build stamp for {kver}")
+        return None
+    recorded = json.loads(stamp.read_text(encoding="utf8"))
+    changed = sorted(key for key in inputs.keys() | recorded.keys() if inputs.get(key) != recorded.get(key))
+    if changed:
+        eprint(f"{kver}: rebuilding, changed since last build: {', '.join(changed)}")
+        return None
+    if not boot_is_correct(kver=kver) or not _modules_dir(kver).is_dir():
+        eprint(f"{kver}: inputs unchanged but installed artifacts are incomplete; rebuilding")
+        return None
+    return "config, source, toolchain, out-of-tree modules, flags and install options match its last successful build"
 
 
-def _read_kernel_flags(kver: str) -> list[str] | None:
-    """Return flags list for kver, or None if no record exists."""
-    flag_file = KERNEL_FLAGS_DIR / kver
-    if not flag_file.exists():
-        return None
-    content = flag_file.read_text(encoding="utf8").strip()
-    return content.split() if content else []
+def _write_build_stamp(build_dir: Path, inputs: dict) -> None:
+    stamp = _build_stamp_path(build_dir)
+    tmp = stamp.with_suffix(".tmp")
+    tmp.write_text(json.dumps(inputs, indent=2, sort_keys=True) + "\n", encoding="utf8")
+    tmp.rename(stamp)
 
 
-KERNEL_CMDLINE_DIR = Path("/boot/compile-kernel-cmdline")
+ARTIFACT_CACHE_DIR = _STATE_DIR / "artifacts"
+# entries kept, newest first; each is a kernel image plus a module tree
+ARTIFACT_CACHE_KEEP = 8
+# build-dir-relative paths of the stored compile outputs, besides modules
+_CACHED_BUILD_FILES = ("arch/x86/boot/bzImage", "System.map", "Module.symvers")
+_MODULES_TARBALL = "modules.tar.zst"
+# in a build dir whose compile outputs were restored rather than built;
+# holds the cache key
+_RESTORED_MARKER = "compile-kernel.restored"
 
 
-def _write_kernel_cmdline(kver: str, params: list[str]) -> None:
-    """Record the boot params this kver needs to arm its compiled-in debug
-    facilities. _postprocess_grub_cfg appends them to that kernel's linux
-    line, so each menuentry carries exactly the params its build needs —
-    GRUB_CMDLINE_LINUX is global and cannot do per-kernel.
+def _artifact_key(build_dir: Path) -> str:
+    """What the compile outputs are a function of. The .config carries the
+    LOCALVERSION, so a key also pins the kver."""
+    inputs = {
+        "config_sha256": _file_sha256(build_dir / ".config"),
+        "source": _source_kernelversion(_source_of(build_dir)),
+        "toolchain": _toolchain_fingerprint(),
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf8")).hexdigest()
+
+
+def _store_artifacts(*, key: str, build_dir: Path, kver: str) -> None:
+    """Add a compiled build dir's outputs to the cache under `key`.
+
+    The module tree is a private modules_install into a staging dir, so the
+    cache holds Kbuild's own output, before out-of-tree modules, stripping
+    or compression alter the installed one.
     """
-    KERNEL_CMDLINE_DIR.mkdir(parents=True, exist_ok=True)
-    cmdline_file = KERNEL_CMDLINE_DIR / kver
-    cmdline_file.write_text(" ".join(params) + "\n" if params else "\n", encoding="utf8")
-    eprint(f"wrote kernel cmdline for {kver}: {params}")
+    entry = ARTIFACT_CACHE_DIR / key
+    if entry.is_dir():
+        return
+    tmp = ARTIFACT_CACHE_DIR / f".{key}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    for name in _CACHED_BUILD_FILES:
+        shutil.copy2(build_dir / name, tmp / Path(name).name)
+    shutil.copy2(build_dir / ".config", tmp / "config")
+    with tempfile.TemporaryDirectory(prefix="compile-kernel-modules-") as staging:
+        _make("modules_install", f"INSTALL_MOD_PATH={staging}", build_dir=build_dir)
+        subprocess.run(
+            [
+                "tar",
+                "--zstd",
+                "-C",
+                f"{staging}/lib/modules",
+                f"--exclude={kver}/build",
+                f"--exclude={kver}/source",
+                "-cf",
+                (tmp / _MODULES_TARBALL).as_posix(),
+                kver,
+            ],
+            check=True,
+        )
+    (tmp / "kver").write_text(kver + "\n", encoding="utf8")
+    # rename last, so a half-written entry is never a hit
+    tmp.rename(entry)
+    eprint(f"cached {kver} artifacts as {key[:12]}")
+    _prune_artifact_cache()
 
 
-def _read_kernel_cmdline(kver: str) -> list[str]:
-    """Params recorded for kver; empty when none recorded."""
-    cmdline_file = KERNEL_CMDLINE_DIR / kver
-    if not cmdline_file.exists():
-        return []
-    return cmdline_file.read_text(encoding="utf8").split()
+def _prune_artifact_cache() -> None:
+    entries = sorted(
+        (p for p in ARTIFACT_CACHE_DIR.iterdir() if p.is_dir() and not p.name.startswith(".")),
+        key=lambda p: p.stat().st_mtime,
+        reverse=True,
+    )
+    for stale in entries[ARTIFACT_CACHE_KEEP:]:
+        icp(f"pruning cached artifacts {stale.name}")
+        shutil.rmtree(stale)
 
 
-_BOOT_FILE_PREFIXES = ("vmlinuz", "System.map", "config", "initramfs")
-_SNAPSHOT_DIR = Path("/boot/snapshots")
+def _cached_artifacts(key: str) -> Path | None:
+    entry = ARTIFACT_CACHE_DIR / key
+    if not entry.is_dir():
+        return None
+    # a hit counts as a use for pruning
+    os.utime(entry)
+    return entry
+
+
+def _restore_build_artifacts(*, entry: Path, build_dir: Path) -> None:
+    """Put a cache entry's compile outputs where Kbuild's `install` and
+    out-of-tree module builds look for them, and mark the build dir as
+    restored rather than compiled."""
+    for name in _CACHED_BUILD_FILES:
+        target = build_dir / name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(entry / Path(name).name, target)
+    (build_dir / _RESTORED_MARKER).write_text(entry.name + "\n", encoding="utf8")
+
+
+def _restored_entry(build_dir: Path) -> Path | None:
+    """The cache entry a build dir's compile outputs came from, if any."""
+    marker = build_dir / _RESTORED_MARKER
+    if not marker.exists():
+        return None
+    return ARTIFACT_CACHE_DIR / marker.read_text(encoding="utf8").strip()
 
 
-def _snapshot_existing_kernel_files(kver: str) -> None:
-    """Move existing /boot files for kver into /boot/snapshots/{kver}/ as
-    {basename}.{mtime}.
+def _restore_modules(*, entry: Path, kver: str) -> None:
+    """Replace /lib/modules/{kver}'s in-tree modules with a cache entry's,
+    as modules_install would."""
+    shutil.rmtree(_modules_dir(kver) / "kernel", ignore_errors=True)
+    _modules_dir(kver).mkdir(parents=True, exist_ok=True)
+    subprocess.run(
+        ["tar", "--zstd", "-C", "/lib/modules", "-xf", (entry / _MODULES_TARBALL).as_posix()],
+        check=True,
+    )
+    subprocess.run(["depmod", "-a", kver], check=True)
 
-    The subdir is what keeps them out of the boot menu. grub-mkconfig builds
-    menuentries from /boot/vmlinuz-* and sorts version-aware, so a file named
-    vmlinuz-6.19.6-gentoo-x86_64.1777158198 sorts after the real one and gets
-    picked as newest. Booting it gives MODVERSIONS-mismatched modules, because
-    /lib/modules/{kver}/ holds modules from a different build sharing that
-    uname -r. Hiding snapshots from the scan removes the failure entirely.
-    """
-    boot = Path("/boot")
-    if not boot.is_dir():
-        return
 
-    candidates: list[Path] = []
-    for prefix in _BOOT_FILE_PREFIXES:
-        base = f"{prefix}-{kver}.img" if prefix == "initramfs" else f"{prefix}-{kver}"
-        for name in (base, f"{base}.old"):
-            path = boot / name
-            if path.exists():
-                candidates.append(path)
-    if not candidates:
-        return
+def _genkernel_command(action: str, *, build_dir: Path, variant: str | None) -> hs.Command:
+    """genkernel aimed at this variant's object dir, never at the source tree."""
+    genkernel_command = hs.Command("genkernel")
+    genkernel_command.bake(action)
+    genkernel_command.bake("--no-clean")
+    genkernel_command.bake("--no-mrproper")
+    genkernel_command.bake(f"--kerneldir={_source_of(build_dir)}")
+    # Keep objects out of the source tree so each variant owns its own.
+    genkernel_command.bake(f"--kernel-outputdir={build_dir}")
+    # Pin LOCALVERSION: genkernel defaults to -${ARCH} and would otherwise
+    # rename every artifact away from the variant written into .config.
+    genkernel_command.bake(f"--kernel-localversion={_desired_localversion(variant)}")
+    cc = _kernel_cc()
+    if cc is not None:
+        # the same CC as _make, or genkernel's pass would see every object's
+        # command line changed and recompile the lot
+        genkernel_command.bake(f"--kernel-cc={cc}")
+    return genkernel_command
 
-    dest_dir = _SNAPSHOT_DIR / kver
-    dest_dir.mkdir(parents=True, exist_ok=True)
 
-    for src in candidates:
-        ts = int(src.stat().st_mtime)
-        base_name = src.name[:-4] if src.name.endswith(".old") else src.name
-        target = dest_dir / f"{base_name}.{ts}"
-        while target.exists():
-            ts += 1
-            target = dest_dir / f"{base_name}.{ts}"
-        eprint(f"snapshot: {src} -> {target}")
-        src.rename(target)
-        # Repoint any /boot symlink that referenced the moved file, relative so
-        # the link stays valid regardless of how /boot is mounted.
-        for entry in boot.iterdir():
-            if not entry.is_symlink():
-                continue
-            if Path(os.readlink(entry)).name != src.name:
-                continue
-            entry.unlink()
-            new_target = f"snapshots/{kver}/{target.name}"
-            entry.symlink_to(new_target)
-            eprint(f"snapshot: repointed {entry} -> {new_target}")
+_FIRMWARE_DIR = Path("/lib/firmware")
+# linux-firmware may install blobs compressed; the loader tries these in turn
+_FIRMWARE_SUFFIXES = ("", ".zst", ".xz")
 
 
-def _kver_from_vmlinuz(vmlinuz_path: str) -> str:
+def _module_name(path: Path | str) -> str:
+    """Kernel module name of a .ko path: no suffixes, dashes as underscores."""
+    return Path(path).name.split(".ko", 1)[0].replace("-", "_")
+
+
+def _builtin_modules(kver: str) -> set[str]:
+    """Names of the modules compiled into kver, from modules.builtin."""
+    builtin = _modules_dir(kver) / "modules.builtin"
+    if not builtin.exists():
+        return set()
+    return {_module_name(line) for line in builtin.read_text(encoding="utf8").split()}
+
+
+def _read_modules_dep(kver: str) -> dict[str, list[str]]:
+    """{name: [dependency names]} from kver's modules.dep, plus the pre:/post:
+    soft dependencies from modules.softdep (e.g. ext4 -> crc32c), which modprobe
+    also pulls in and which are therefore just as needed at boot."""
+    mod_dir = _modules_dir(kver)
+    deps: dict[str, list[str]] = {}
+    for line in (mod_dir / "modules.dep").read_text(encoding="utf8").splitlines():
+        if ":" not in line:
+            continue
+        module, requires = line.split(":", 1)
+        deps[_module_name(module)] = [_module_name(r) for r in requires.split()]
+    softdep = mod_dir / "modules.softdep"
+    if softdep.exists():
+        for line in softdep.read_text(encoding="utf8").splitlines():
+            words = line.split()
+            if len(words) < 3 or words[0] != "softdep":
+                continue
+            module = words[1].replace("-", "_")
+            soft = [w.replace("-", "_") for w in words[2:] if w not in ("pre:", "post:")]
+            deps.setdefault(module, []).extend(soft)
+    return deps
+
+
+def _module_paths(kver: str) -> dict[str, Path]:
+    """{name: installed path} for every module in kver's tree."""
+    return {_module_name(p): p for p in _modules_dir(kver).rglob("*.ko*")}
+
+
+def _root_mount() -> tuple[str, str]:
+    """(source, fstype) of the mounted root filesystem."""
+    root: tuple[str, str] | None = None
+    for line in Path("/proc/self/mounts").read_text(encoding="utf8").splitlines():
+        source, mountpoint, fstype = line.split()[:3]
+        if mountpoint == "/":
+            root = (source, fstype)  # last one wins: it is what / resolves to
+    if root is None:
+        raise RuntimeError("no / entry in /proc/self/mounts")
+    return root
+
+
+def _zpool_block_devices(pool: str) -> list[str]:
+    """Leaf block devices of a pool, as /dev paths."""
+    result = subprocess.run(
+        ["zpool", "list", "-v", "-H", "-P", "-L", pool],
+        capture_output=True,
+        check=True,
+    )
+    devices = []
+    for line in result.stdout.decode("utf8").splitlines():
+        name = line.strip().split("\t", 1)[0]
+        if name.startswith("/dev/"):
+            devices.append(name)
+    return devices
+
+
+def _block_device_modules(device: str) -> set[str]:
+    """Modules on the path from /dev/{device} down to hardware: stacked
+    devices (dm, md) through their slaves, then every driver bound to the
+    disk's ancestors in /sys/devices (e.g. sd_mod -> ahci, or nvme). Built-in
+    drivers have no module link and contribute nothing."""
+    modules: set[str] = set()
+    name = Path(os.path.realpath(device)).name
+    sys_block = Path("/sys/class/block") / name
+    if not sys_block.exists():
+        return modules
+    node = Path(os.path.realpath(sys_block))
+    if (node / "partition").exists():
+        node = node.parent
+
+    if node.name.startswith("dm-"):
+        modules.add("dm_mod")
+        uuid = node / "dm" / "uuid"
+        if uuid.exists() and uuid.read_text(encoding="utf8").startswith("CRYPT-"):
+            modules.add("dm_crypt")
+    if node.name.startswith("md"):
+        modules.add("md_mod")
+        level_file = node / "md" / "level"
+        if level_file.exists():
+            level = level_file.read_text(encoding="utf8").strip()
+            modules.add("raid456" if level in ("raid4", "raid5", "raid6") else level)
+    slaves = node / "slaves"
+    if slaves.is_dir():
+        for slave in slaves.iterdir():
+            modules |= _block_device_modules(f"/dev/{slave.name}")
+
+    device_link = node / "device"
+    if not device_link.exists():
+        return modules
+    ancestor = Path(os.path.realpath(device_link))
+    while ancestor != Path("/sys/devices") and ancestor != ancestor.parent:
+        driver_module = ancestor / "driver" / "module"
+        if driver_module.exists():
+            modules.add(Path(os.path.realpath(driver_module)).name)
+        ancestor = ancestor.parent
+    return modules
+
+
+def _root_path_modules(kver: str) -> set[str]:
+    """Names of the modules kver needs to mount this host's root and import
+    its pools, closed over modules.dep. Read from the running system's /sys,
+    which is the hardware the new kernel will boot on."""
+    source, fstype = _root_mount()
+    if fstype == "zfs":
+        wanted = {"spl", "zfs"}
+        devices = _zpool_block_devices(source.split("/", 1)[0])
+    else:
+        wanted = {fstype}
+        devices = [source]
+    # the filesystem, and whatever the running kernel loaded as a module on
+    # the way to it, must exist in kver too; a driver built into the running
+    # kernel may have no module of that name anywhere
+    required = wanted.copy()
+    for device in devices:
+        wanted |= _block_device_modules(device)
+    required |= wanted & _loaded_modules()
+
+    deps = _read_modules_dep(kver)
+    builtin = _builtin_modules(kver)
+    # a root-path module kver lacks is an initramfs that cannot mount root
+    missing = sorted(name for name in required if name not in deps and name not in builtin)
+    if missing:
+        raise RuntimeError(
+            f"{kver} has no module for {missing}, which this host needs to mount its root; "
+            "an initramfs without them would not boot"
+        )
+    closure: set[str] = set()
+    todo = [name for name in wanted if name in deps]
+    while todo:
+        name = todo.pop()
+        if name in closure:
+            continue
+        closure.add(name)
+        todo.extend(d for d in deps.get(name, []) if d in deps)
+    icp(f"root path modules for {kver}: {sorted(closure)}")
+    return closure
+
+
+def _initramfs_modules(kver: str, options: BuildOptions) -> list[Path]:
+    """Every module genkernel will pack into kver's initramfs."""
+    if options.initramfs_modules == "all":
+        return sorted(_modules_dir(kver).rglob("*.ko*"))
+    paths = _module_paths(kver)
+    return sorted(paths[name] for name in _root_path_modules(kver))
+
+
+def _stage_initramfs_modules(kver: str, build_dir: Path, modules: list[Path]) -> Path:
+    """Lay `modules` out as an initramfs overlay tree under build_dir and
+    return its root.
+
+    The overlay carries its own depmod output so modprobe and udev's modalias
+    autoloading work inside the initramfs, and a genkernel module group file
+    so the init script loads zfs itself before importing pools.
+    """
+    overlay = build_dir / "initramfs-overlay"
+    shutil.rmtree(overlay, ignore_errors=True)
+    src = _modules_dir(kver)
+    dest = overlay / "lib" / "modules" / kver
+    dest.mkdir(parents=True)
+    for module in modules:
+        target = dest / module.relative_to(src)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(module, target)
+    # depmod -b wants these to tell built-in modules from missing ones
+    for name in ("modules.order", "modules.builtin", "modules.builtin.modinfo"):
+        if (src / name).exists():
+            shutil.copy2(src / name, dest / name)
+    subprocess.run(["depmod", "-b", overlay.as_posix(), kver], check=True)
+
+    names = {_module_name(m) for m in modules}
+    groups = overlay / "etc" / "modules"
+    groups.mkdir(parents=True)
+    if "zfs" in names:
+        (groups / "zfs").write_text("spl\nzfs\n", encoding="utf8")
+    eprint(f"initramfs modules for {kver}: {len(modules)} staged in {overlay}")
+    return overlay
+
+
+def _initramfs_module_args(kver: str, build_dir: Path, options: BuildOptions) -> list[str]:
+    """genkernel module options for kver's initramfs."""
+    if options.initramfs_modules == "all":
+        return ["--all-ramdisk-modules"]
+    overlay = _stage_initramfs_modules(kver, build_dir, _initramfs_modules(kver, options))
+    return [
+        "--no-all-ramdisk-modules",
+        "--no-ramdisk-modules",
+        f"--initramfs-overlay={overlay}",
+    ]
+
+
+def _initramfs_needs_installed_modules(options: BuildOptions) -> bool:
+    """True when the initramfs is assembled from the installed module tree,
+    which genkernel `all` only produces partway through its own run."""
+    return (
+        options.filter_firmware
+        or options.initramfs_modules != "all"
+        or options.strip_modules
+        or options.compress_modules
+    )
+
+
+# Detached module debug info, where gdb and crash look for it by default.
+_MODULE_DEBUG_ROOT = Path("/usr/lib/debug/lib/modules")
+
+
+def _kmod_reads_zstd(build_dir: Path) -> bool:
+    """True if kver can load a .ko.zst: either kmod decompresses it in
+    userspace, or the kernel was built to decompress modules itself."""
+    result = subprocess.run(["kmod", "--version"], capture_output=True, check=False)
+    if b"+ZSTD" in result.stdout:
+        return True
+    state = _parse_config_state((build_dir / ".config").read_text(encoding="utf8"))
+    return state.get("CONFIG_MODULE_DECOMPRESS") == "y" and state.get("CONFIG_MODULE_COMPRESS_ZSTD") == "y"
+
+
+def _has_debuglink(module: Path) -> bool:
+    """True if module carries a .gnu_debuglink section, i.e. its debug info
+    was already split off."""
+    sections = subprocess.run(
+        ["readelf", "-S", "-W", module.as_posix()], capture_output=True, check=True
+    ).stdout
+    return b".gnu_debuglink" in sections
+
+
+def _postprocess_module(
+    module: Path,
+    *,
+    kver: str,
+    strip: bool,
+    debuginfo: bool,
+    compress: bool,
+) -> tuple[int, int]:
+    """Strip and/or compress one installed .ko. Returns (size before, after)."""
+    before = module.stat().st_size
+    if strip and debuginfo and _has_debuglink(module):
+        # an earlier pass stripped it: its DWARF is only in the .debug file
+        # now, and --only-keep-debug again would overwrite that with nothing
+        strip = False
+    if strip:
+        if debuginfo:
+            debug = _MODULE_DEBUG_ROOT / kver / f"{module.relative_to(_modules_dir(kver))}.debug"
+            debug.parent.mkdir(parents=True, exist_ok=True)
+            subprocess.run(
+                ["objcopy", "--only-keep-debug", module.as_posix(), debug.as_posix()],
+                check=True,
+            )
+        # --strip-debug is what INSTALL_MOD_STRIP=1 does: symbols modpost and
+        # the loader need are kept, only DWARF goes
+        subprocess.run(["strip", "--strip-debug", module.as_posix()], check=True)
+        if debuginfo:
+            subprocess.run(
+                ["objcopy", f"--add-gnu-debuglink={debug.as_posix()}", module.as_posix()],
+                check=True,
+            )
+    if not compress:
+        return before, module.stat().st_size
+    # one thread per file: the pool already keeps every core busy
+    subprocess.run(["zstd", "-q", "-f", "--rm", "-T1", module.as_posix()], check=True)
+    return before, Path(f"{module}.zst").stat().st_size
+
+
+def _postprocess_modules(*, kver: str, build_dir: Path, options: BuildOptions) -> None:
+    """Strip and compress kver's freshly installed modules across a worker
+    pool, then rebuild modules.dep once.
+
+    Kbuild's modules_install handles one module at a time, and debug variants
+    install hundreds of MB of DWARF. Only plain .ko files are touched, and
+    with module_debuginfo only those without a debuglink, so this is safe to
+    rerun over a tree an earlier pass (or an interrupted run) already
+    processed: what it compressed or split is left alone.
+    """
+    if not (options.strip_modules or options.compress_modules):
+        return
+    # strip rewrites a multiply-linked file in place to preserve the links,
+    # which would strip the sibling tree's copy too
+    _break_module_hardlinks(kver)
+    modules = sorted(_modules_dir(kver).rglob("*.ko"))
+    if not modules:
+        return
+
+    strip = options.strip_modules
+    if strip:
+        state = _parse_config_state((build_dir / ".config").read_text(encoding="utf8"))
+        if state.get("CONFIG_MODULE_SIG") == "y":
+            # the signature is appended to the file; strip would cut it off
+            eprint(f"{kver} signs its modules; not stripping them")
+            strip = False
+    if options.compress_modules and not _kmod_reads_zstd(build_dir):
+        raise RuntimeError(
+            f"cannot compress modules for {kver}: kmod lacks zstd support and the "
+            f"kernel has no CONFIG_MODULE_DECOMPRESS with CONFIG_MODULE_COMPRESS_ZSTD"
+        )
+
+    def _one(module: Path) -> tuple[int, int]:
+        return _postprocess_module(
+            module,
+            kver=kver,
+            strip=strip,
+            debuginfo=options.module_debuginfo,
+            compress=options.compress_modules,
+        )
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        sizes = list(pool.map(_one, modules))
+    before = sum(b for b, _ in sizes)
+    after = sum(a for _, a in sizes)
+    eprint(
+        f"postprocessed {len(modules)} modules for {kver}: "
+        f"{before / 2**20:.0f} MiB -> {after / 2**20:.0f} MiB"
+    )
+    # file names changed (.ko -> .ko.zst); modules.dep has to follow
+    subprocess.run(["depmod", "-a", kver], check=True)
+
+
+def _file_sha256(path: Path) -> str:
+    with path.open("rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def _replace_with_link(duplicate: Path, original: Path, *, link: str) -> bool:
+    """Swap duplicate for a hardlink or reflink to original, atomically.
+    Returns False if the filesystem cannot do it."""
+    tmp = duplicate.with_name(f".{duplicate.name}.dedupe")
+    tmp.unlink(missing_ok=True)
+    if link == "hardlink":
+        try:
+            os.link(original, tmp)
+        except OSError:
+            return False
+    else:
+        result = subprocess.run(
+            ["cp", "--reflink=always", "--preserve=all", original.as_posix(), tmp.as_posix()],
+            capture_output=True,
+            check=False,
+        )
+        if result.returncode != 0:
+            tmp.unlink(missing_ok=True)
+            return False
+    os.replace(tmp, duplicate)
+    return True
+
+
+def dedupe_module_trees(
+    *,
+    kvers: list[str] | None = None,
+    link: str = "reflink",
+    dry_run: bool = False,
+) -> int:
+    """Replace byte-identical modules across /lib/modules trees with links to
+    one copy. Returns the bytes reclaimed.
+
+    Variants of one source share most modules verbatim: the flags of an
+    instrumented build leave whole subsystems untouched, and --pair installs
+    two full trees. `kvers` limits the pass to those trees (default: all).
+
+    reflink (the default) gives each file its own inode sharing the extents,
+    so a later in-place write cannot reach another tree. hardlinks work on
+    any filesystem but share the inode, so every step that installs into a
+    tree first breaks them (_break_module_hardlinks).
+    """
+    if link not in ("reflink", "hardlink"):
+        raise ValueError(f"link must be 'reflink' or 'hardlink', not {link!r}")
+    modules_root = Path("/lib/modules")
+    trees = sorted(
+        d for d in modules_root.iterdir()
+        if d.is_dir() and (kvers is None or d.name in kvers)
+    )
+    by_size: dict[int, list[Path]] = {}
+    for tree in trees:
+        for module in tree.rglob("*.ko*"):
+            if module.is_file() and not module.is_symlink():
+                by_size.setdefault(module.stat().st_size, []).append(module)
+    # only a size collision can be a duplicate; hash nothing else
+    candidates = [m for group in by_size.values() if len(group) > 1 for m in group]
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        digests = dict(zip(candidates, pool.map(_file_sha256, candidates)))
+
+    groups: dict[tuple[int, str], list[Path]] = {}
+    for module, digest in digests.items():
+        groups.setdefault((module.stat().st_size, digest), []).append(module)
+
+    reclaimed: dict[str, int] = {}
+    failed = 0
+    for (size, _digest), paths in groups.items():
+        if len(paths) < 2:
+            continue
+        original, *duplicates = sorted(paths)
+        ostat = original.stat()
+        for duplicate in duplicates:
+            dstat = duplicate.stat()
+            if (dstat.st_dev, dstat.st_ino) == (ostat.st_dev, ostat.st_ino):
+                continue  # already one file
+            if link == "hardlink" and dstat.st_dev != ostat.st_dev:
+                continue
+            if not dry_run and not _replace_with_link(duplicate, original, link=link):
+                failed += 1
+                continue
+            tree = duplicate.relative_to(modules_root).parts[0]
+            reclaimed[tree] = reclaimed.get(tree, 0) + size
+
+    verb = "would reclaim" if dry_run else "reclaimed"
+    for tree, nbytes in sorted(reclaimed.items()):
+        print(f"  {tree}: {verb} {nbytes / 2**20:.1f} MiB")
+    total = sum(reclaimed.values())
+    print(f"dedupe ({link}) over {len(trees)} trees: {verb} {total / 2**20:.1f} MiB")
+    if failed:
+        eprint(
+            f"WARNING: {failed} duplicates left in place; the filesystem refused "
+            f"the {link} (try --link hardlink, or a filesystem with block cloning)"
+        )
+    return total
+
+
+def _break_module_hardlinks(kver: str) -> None:
+    """Give every multiply-linked module in kver's tree its own inode again.
+
+    Kbuild's modules_install and strip both write into an existing file, so
+    after a hardlink dedupe they would rewrite the copy every other tree
+    shares. Run before anything installs into or modifies the tree.
+    """
+    mod_dir = _modules_dir(kver)
+    if not mod_dir.is_dir():
+        return
+    broken = 0
+    for module in mod_dir.rglob("*.ko*"):
+        if module.is_symlink() or module.stat().st_nlink < 2:
+            continue
+        tmp = module.with_name(f".{module.name}.unlink")
+        shutil.copy2(module, tmp)
+        os.replace(tmp, module)
+        broken += 1
+    if broken:
+        icp(f"broke {broken} module hardlinks in {mod_dir}")
+
+
+def _module_firmware(kver: str, modules: list[Path]) -> list[str]:
+    """The firmware: fields of `modules`, as paths relative to /lib/firmware.
+
+    modinfo reads each module's .modinfo section, so nothing is loaded. Names
+    the modules declare but linux-firmware does not ship (older or newer
+    revisions a driver would also accept) are dropped, not treated as errors.
+    """
+    declared: set[str] = set()
+    # modinfo takes any number of modules; chunk to stay well under ARG_MAX
+    for start in range(0, len(modules), 256):
+        chunk = [m.as_posix() for m in modules[start : start + 256]]
+        result = subprocess.run(
+            ["modinfo", "-k", kver, "-F", "firmware", *chunk],
+            capture_output=True,
+            check=True,
+        )
+        declared.update(result.stdout.decode("utf8").split())
+
+    found: set[str] = set()
+    missing = 0
+    for name in sorted(declared):
+        if any(ch in name for ch in "*?["):
+            matches = [p for p in _FIRMWARE_DIR.glob(name) if p.is_file()]
+        else:
+            matches = [
+                _FIRMWARE_DIR / f"{name}{suffix}"
+                for suffix in _FIRMWARE_SUFFIXES
+                if (_FIRMWARE_DIR / f"{name}{suffix}").is_file()
+            ]
+        if not matches:
+            missing += 1
+            continue
+        found.update(m.relative_to(_FIRMWARE_DIR).as_posix() for m in matches)
+    icp(f"firmware: {len(declared)} declared, {len(found)} files found, {missing} not shipped")
+    return sorted(found)
+
+
+def _firmware_args(kver: str, options: BuildOptions) -> list[str]:
+    """genkernel firmware options for kver's initramfs."""
+    if not options.filter_firmware:
+        return ["--firmware"]
+    files = _module_firmware(kver, _initramfs_modules(kver, options))
+    eprint(f"initramfs firmware for {kver}: {len(files)} files")
+    if not files:
+        # an empty --firmware-files would fall back to the whole tree
+        return ["--no-firmware"]
+    return ["--firmware", f"--firmware-files={','.join(files)}"]
+
+
+KERNEL_FLAGS_DIR = Path("/boot/compile-kernel-flags")
+
+
+def _write_kernel_flags(kver: str, labels: list[str]) -> None:
+    """Write active debug groups for kver to /boot/compile-kernel-flags/{kver}.
+    Empty list writes an empty file (clean kernel — no flags).
+    """
+    KERNEL_FLAGS_DIR.mkdir(parents=True, exist_ok=True)
+    flag_file = KERNEL_FLAGS_DIR / kver
+    flag_file.write_text(" ".join(labels) + "\n" if labels else "\n", encoding="utf8")
+    eprint(f"wrote kernel flags for {kver}: {labels}")
+
+
+def _read_kernel_flags(kver: str) -> list[str] | None:
+    """Return flags list for kver, or None if no record exists."""
+    flag_file = KERNEL_FLAGS_DIR / kver
+    if not flag_file.exists():
+        return None
+    content = flag_file.read_text(encoding="utf8").strip()
+    return content.split() if content else []
+
+
+KERNEL_CMDLINE_DIR = Path("/boot/compile-kernel-cmdline")
+
+
+def _write_kernel_cmdline(kver: str, params: list[str]) -> None:
+    """Record the boot params this kver needs to arm its compiled-in debug
+    facilities. _postprocess_grub_cfg appends them to that kernel's linux
+    line, so each menuentry carries exactly the params its build needs —
+    GRUB_CMDLINE_LINUX is global and cannot do per-kernel.
+    """
+    KERNEL_CMDLINE_DIR.mkdir(parents=True, exist_ok=True)
+    cmdline_file = KERNEL_CMDLINE_DIR / kver
+    cmdline_file.write_text(" ".join(params) + "\n" if params else "\n", encoding="utf8")
+    eprint(f"wrote kernel cmdline for {kver}: {params}")
+
+
+def _read_kernel_cmdline(kver: str) -> list[str]:
+    """Params recorded for kver; empty when none recorded."""
+    cmdline_file = KERNEL_CMDLINE_DIR / kver
+    if not cmdline_file.exists():
+        return []
+    return cmdline_file.read_text(encoding="utf8").split()
+
+
+_BOOT_FILE_PREFIXES = ("vmlinuz", "System.map", "config", "initramfs")
+_SNAPSHOT_DIR = Path("/boot/snapshots")
+
+
+def _snapshot_existing_kernel_files(kver: str) -> None:
+    """Move existing /boot files for kver into /boot/snapshots/{kver}/ as
+    {basename}.{mtime}.
+
+    The subdir is what keeps them out of the boot menu. grub-mkconfig builds
+    menuentries from /boot/vmlinuz-* and sorts version-aware, so a file named
+    vmlinuz-6.19.6-gentoo-x86_64.1777158198 sorts after the real one and gets
+    picked as newest. Booting it gives MODVERSIONS-mismatched modules, because
+    /lib/modules/{kver}/ holds modules from a different build sharing that
+    uname -r. Hiding snapshots from the scan removes the failure entirely.
+    """
+    boot = Path("/boot")
+    if not boot.is_dir():
+        return
+
+    candidates: list[Path] = []
+    for prefix in _BOOT_FILE_PREFIXES:
+        base = f"{prefix}-{kver}.img" if prefix == "initramfs" else f"{prefix}-{kver}"
+        for name in (base, f"{base}.old"):
+            path = boot / name
+            if path.exists():
+                candidates.append(path)
+    if not candidates:
+        return
+
+    dest_dir = _SNAPSHOT_DIR / kver
+    dest_dir.mkdir(parents=True, exist_ok=True)
+
+    for src in candidates:
+        ts = int(src.stat().st_mtime)
+        base_name = src.name[:-4] if src.name.endswith(".old") else src.name
+        target = dest_dir / f"{base_name}.{ts}"
+        while target.exists():
+            ts += 1
+            target = dest_dir / f"{base_name}.{ts}"
+        eprint(f"snapshot: {src} -> {target}")
+        src.rename(target)
+        # Repoint any /boot symlink that referenced the moved file, relative so
+        # the link stays valid regardless of how /boot is mounted.
+        for entry in boot.iterdir():
+            if not entry.is_symlink():
+                continue
+            if Path(os.readlink(entry)).name != src.name:
+                continue
+            entry.unlink()
+            new_target = f"snapshots/{kver}/{target.name}"
+            entry.symlink_to(new_target)
+            eprint(f"snapshot: repointed {entry} -> {new_target}")
+
+
+def _kver_from_vmlinuz(vmlinuz_path: str) -> str:
     """Extract kver from a vmlinuz path like /boot/vmlinuz-6.19.6-gentoo-x86_64."""
     name = Path(vmlinuz_path).name
     # strip vmlinuz- prefix
@@ -5534,27 +7090,41 @@ def build_status() -> None:
         print(f"      cmdline: {' '.join(_read_kernel_cmdline(build_dir.name)) or '(none)'}")
 
 
-def install_compiled_kernel(*, flags: KernelFlags, variant: str | None = None):
-    _ensure_pristine_source()
-    kver = _kver_for_variant(variant)
-    build_dir = _build_dir(kver)
-    if not (build_dir / ".config").exists():
-        raise ValueError(f"no configured build dir for {kver} at {build_dir}")
-    _snapshot_existing_kernel_files(kver)
-    _make("install", build_dir=build_dir)
-
-    genkernel_command = hs.Command("genkernel")
-    genkernel_command.bake("initramfs")
-    genkernel_command.bake("--no-clean")
-    genkernel_command.bake("--no-mrproper")
-    genkernel_command.bake(f"--kerneldir={_SOURCE_DIR}")
-    genkernel_command.bake(f"--kernel-outputdir={build_dir}")
-    genkernel_command.bake(f"--kernel-localversion={_desired_localversion(variant)}")
-    genkernel_command(_fg=True)
-
-    _link_module_build_dir(kver, build_dir)
-    _record_build(kver, flags)
-    _regenerate_grub(default_kver=None)
+def install_compiled_kernel(
+    *,
+    flags: KernelFlags,
+    variant: str | None = None,
+    options: BuildOptions = BuildOptions(),
+    source: Path = _SOURCE_DIR,
+):
+    with _build_cgroup(options):
+        _ensure_pristine_source(source)
+        kver = _kver_for_variant(variant, source)
+        build_dir = _build_dir(kver)
+        if not (build_dir / ".config").exists():
+            raise ValueError(f"no configured build dir for {kver} at {build_dir}")
+        # every step from here writes /boot, /lib/modules or the build dir
+        with _writing_build_dirs([kver]), _SYSTEM_LOCK:
+            _snapshot_existing_kernel_files(kver)
+            entry = _cached_artifacts(_artifact_key(build_dir)) if options.artifact_cache else None
+            if entry is not None:
+                eprint(f"installing {kver} from cached artifacts {entry.name[:12]}")
+                _restore_build_artifacts(entry=entry, build_dir=build_dir)
+                _break_module_hardlinks(kver)
+                _restore_modules(entry=entry, kver=kver)
+            _make("install", build_dir=build_dir)
+            _postprocess_modules(kver=kver, build_dir=build_dir, options=options)
+
+            genkernel_command = _genkernel_command("initramfs", build_dir=build_dir, variant=variant)
+            if options.initramfs_modules != "all":
+                genkernel_command.bake(*_initramfs_module_args(kver, build_dir, options))
+            if options.filter_firmware:
+                genkernel_command.bake(*_firmware_args(kver, options))
+            genkernel_command(**_hs_output(_fg=True), _env=_make_env(build_dir))
+
+            _link_module_build_dir(kver, build_dir)
+            _record_build(kver, flags)
+            _regenerate_grub(default_kver=None)
 
 
 def configure_kernel(
@@ -5564,13 +7134,20 @@ def configure_kernel(
     interactive: bool,
     flags: KernelFlags,
     variant: str | None = None,
+    clone_closest: bool = False,
+    source: Path = _SOURCE_DIR,
 ) -> Path:
-    """Configure this variant's build dir and return it."""
-    _ensure_pristine_source()
-    kver = _kver_for_variant(variant)
-    build_dir = _ensure_build_dir(kver)
+    """Configure this variant's build dir for `source` and return it. A new
+    build dir is cloned from the closest existing one when clone_closest is
+    set."""
+    _ensure_pristine_source(source)
+    kver = _kver_for_variant(variant, source)
+    build_dir = _ensure_build_dir(
+        kver, source=source, flags=flags, clone_closest=clone_closest
+    )
     if interactive:
-        _make("nconfig", build_dir=build_dir)
+        with _to_terminal():
+            _make("nconfig", build_dir=build_dir)
     check_kernel_config(
         path=build_dir / ".config",
         fix=fix,
@@ -5583,103 +7160,2148 @@ def configure_kernel(
     if actual != kver:
         raise RuntimeError(
             f"kernel.release is {actual!r} but this build dir is named {kver!r}; "
-            f"CONFIG_LOCALVERSION_AUTO or a localversion* file in {_SOURCE_DIR} "
+            f"CONFIG_LOCALVERSION_AUTO or a localversion* file in {source} "
             f"is adding to the release string"
         )
     return build_dir
 
 
-def _build_one(
-    *,
-    build: KernelBuild,
-    fix: bool,
-    warn_only: bool,
-    interactive_configure: bool,
-    pre_module_rebuild: bool,
-) -> str:
-    """Configure, compile, and install one kernel. Returns its kver.
+HISTORY_FILE = _STATE_DIR / "build-history.jsonl"
 
-    Every artifact is keyed by kver — the object dir, /boot files,
-    /lib/modules tree, initramfs, flags, cmdline, snapshots, grub entry — so
-    two variants of one source share nothing they could contend for.
+# The record phases on this thread are timed into; see _recording.
+_THREAD = threading.local()
+
+
+def _exit_status(exc: BaseException) -> int:
+    """A failed phase's exit status: the failing child's, when there was one."""
+    for attr in ("exit_code", "returncode"):
+        code = getattr(exc, attr, None)
+        if isinstance(code, int):
+            return code
+    return 1
+
+
+class _BuildRecord:
+    """Timings of one build's phases, appended to HISTORY_FILE as one line.
+
+    CPU time and peak RSS come from getrusage(RUSAGE_CHILDREN), which is
+    process-wide: while builds run concurrently, a phase's CPU time includes
+    whatever the other builds' children finished meanwhile. `concurrent` is
+    recorded so history readers can tell such records apart.
     """
-    flags = build.flags
-    variant = build.variant
-    eprint(f"=== building variant={variant!r} flags={flags.labels()} ===")
 
-    build_dir = configure_kernel(
-        fix=fix,
-        warn_only=warn_only,
-        interactive=interactive_configure,
-        flags=flags,
-        variant=variant,
-    )
-    kver = _kernelrelease(build_dir)
+    def __init__(self, *, kver: str, flags: KernelFlags, concurrent: int) -> None:
+        self.kver = kver
+        self.flags = flags.labels()
+        self.concurrent = concurrent
+        self.started = time.time()
+        self.phases: list[dict] = []
+        self.status = 0
+        # totals of the run's cgroup, when it ran in one
+        self.cgroup: dict[str, int] | None = None
+        # mean peak RSS of one compile job, when --cc-timing measured it
+        self.job_rss_kb: int | None = None
+        # per thread: the shared post-build steps time into builds[0]'s
+        # record while its own compile is still running
+        self._stacks: dict[int, list[str]] = {}
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        stack = self._stacks.setdefault(threading.get_ident(), [])
+        stack.append(name)
+        full_name = "/".join(stack)
+        wall_start = time.monotonic()
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_start = usage.ru_utime + usage.ru_stime
+        maxrss_start = usage.ru_maxrss
+        status = 0
+        try:
+            yield full_name
+        except BaseException as exc:
+            status = _exit_status(exc)
+            self.status = self.status or status
+            raise
+        finally:
+            stack.pop()
+            usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            self.phases.append(
+                {
+                    "name": full_name,
+                    "wall": round(time.monotonic() - wall_start, 3),
+                    "cpu": round(usage.ru_utime + usage.ru_stime - cpu_start, 3),
+                    "maxrss_kb": usage.ru_maxrss,
+                    # ru_maxrss is the largest child over the process's life;
+                    # it only describes this phase if it grew during it
+                    "maxrss_in_phase": usage.ru_maxrss > maxrss_start,
+                    "status": status,
+                }
+            )
 
-    # Prepare before any emerge: an unprepared tree is the only reason the zfs
-    # emerge below could fail for a reason that is not a real error, so doing
-    # this first means every failure past this point is worth crashing on.
-    _make("modules_prepare", build_dir=build_dir)
-    _link_module_build_dir(kver, build_dir)
+    def as_dict(self) -> dict:
+        return {
+            "kver": self.kver,
+            "flags": self.flags,
+            "started": int(self.started),
+            "wall": round(time.time() - self.started, 3),
+            "status": self.status,
+            "concurrent": self.concurrent,
+            "phases": self.phases,
+            **({"cgroup": self.cgroup} if self.cgroup is not None else {}),
+            **({"job_rss_kb": self.job_rss_kb} if self.job_rss_kb is not None else {}),
+        }
 
-    env = _emerge_env(build_dir)
-    icp("upgrading sys-fs/zfs before genkernel's own external-module step")
-    hs.Command("emerge")(
-        "sys-fs/zfs", "-u", _env=env, _out=sys.stdout, _err=sys.stderr
-    )
 
-    if pre_module_rebuild:
-        _emerge_zfs_module_rebuild(build_dir=build_dir, kver=kver)
+@contextlib.contextmanager
+def _recording(record: _BuildRecord | None):
+    """Make `record` the one _phase() times into on this thread. Phases run
+    deep inside configure and install helpers; a thread-local keeps the
+    record out of every signature in between."""
+    previous = getattr(_THREAD, "record", None)
+    _THREAD.record = record
+    try:
+        yield record
+    finally:
+        _THREAD.record = previous
+
+
+@contextlib.contextmanager
+def _phase(name: str):
+    """Time the body as phase `name` of this thread's build, if one is being
+    recorded, log its commands' output with --phase-logs, and journal it as
+    completed if it succeeds. Nested phases are named parent/child."""
+    record = getattr(_THREAD, "record", None)
+    with record.phase(name) if record is not None else contextlib.nullcontext() as full_name:
+        logging_to = (
+            _logging_to(record.kver, full_name, _PHASE_LOG_RUN)
+            if _PHASE_LOG_RUN is not None and record is not None
+            else contextlib.nullcontext()
+        )
+        with logging_to:
+            yield
+    journal = getattr(_THREAD, "journal", None)
+    if journal is not None:
+        journal.complete(name)
 
-    gcc_check(build_dir=build_dir)
 
-    _snapshot_existing_kernel_files(kver)
+def _append_history(records: list[_BuildRecord]) -> None:
+    HISTORY_FILE.parent.mkdir(parents=True, exist_ok=True)
+    with HISTORY_FILE.open("a", encoding="utf8") as f:
+        for record in records:
+            f.write(json.dumps(record.as_dict(), sort_keys=True) + "\n")
 
-    genkernel_command = hs.Command("genkernel")
-    genkernel_command.bake("all")
-    genkernel_command.bake("--no-clean")
-    genkernel_command.bake("--no-mrproper")
-    genkernel_command.bake("--symlink")
-    genkernel_command.bake("--all-ramdisk-modules")
-    genkernel_command.bake("--firmware")
-    genkernel_command.bake("--microcode=all")
-    genkernel_command.bake("--microcode-initramfs")
-    genkernel_command.bake(f"--makeopts=-j{os.cpu_count()}")
-    genkernel_command.bake(f"--kerneldir={_SOURCE_DIR}")
-    # Keep objects out of the source tree so each variant owns its own.
-    genkernel_command.bake(f"--kernel-outputdir={build_dir}")
-    # Pin LOCALVERSION: genkernel defaults to -${ARCH} and would otherwise
-    # rename every artifact away from the variant written into .config.
-    genkernel_command.bake(f"--kernel-localversion={_desired_localversion(variant)}")
 
-    _ensure_nvidia_or_fallback(build_dir=build_dir, kver=kver)
-    icp(genkernel_command)
-    genkernel_command(_fg=True)
+def _read_history() -> list[dict]:
+    if not HISTORY_FILE.exists():
+        return []
+    records = []
+    for line in HISTORY_FILE.read_text(encoding="utf8").splitlines():
+        if line.strip():
+            records.append(json.loads(line))
+    return records
 
-    _emerge_zfs_module_rebuild(build_dir=build_dir, kver=kver)
 
-    if _kernelrelease(build_dir) != kver:
-        raise RuntimeError(f"kernel.release changed during build of {kver}")
-    if not boot_is_correct(kver=kver):
-        raise RuntimeError(f"/boot is missing artifacts for {kver} after genkernel")
-    _link_module_build_dir(kver, build_dir)
-    _record_build(kver, flags)
-    eprint(f"=== finished {kver} ===")
-    return kver
+def _format_seconds(seconds: float) -> str:
+    minutes, secs = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{secs:02d}" if hours else f"{minutes}:{secs:02d}"
 
 
-def compile_and_install_kernel(
-    *,
-    builds: list[KernelBuild],
-    configure: bool,
-    fix: bool,
-    warn_only: bool,
-    no_check_boot: bool,
-    pre_module_rebuild: bool,
-):
-    """Build every kernel in `builds`, then regenerate grub once.
+def build_history(*, kver: str | None = None, limit: int = 10) -> None:
+    """Summarise recorded build timings per kver and per flag set.
 
-    builds[0] is the boot default and gets GRUB_TOP_LEVEL. That is load-bearing
+    For each group: how many builds, the last and median total wall time,
+    and the median wall and CPU time of each top-level phase over the last
+    `limit` successful builds, with the last build's figure beside it so a
+    phase that got slower stands out.
+    """
+    records = [r for r in _read_history() if kver is None or r["kver"] == kver]
+    if not records:
+        print(f"no build history in {HISTORY_FILE}")
+        return
+
+    def _summarise(title: str, group: list[dict]) -> None:
+        ok = [r for r in group if r["status"] == 0][-limit:]
+        failed = len(group) - len([r for r in group if r["status"] == 0])
+        print(f"{title}: {len(group)} builds, {failed} failed")
+        if not ok:
+            return
+        walls = [r["wall"] for r in ok]
+        print(
+            f"  total: last {_format_seconds(walls[-1])}, "
+            f"median {_format_seconds(statistics.median(walls))} over {len(ok)}"
+        )
+        names: list[str] = []
+        for r in ok:
+            for p in r["phases"]:
+                if "/" not in p["name"] and p["name"] not in names:
+                    names.append(p["name"])
+        for name in names:
+            samples = [p for r in ok for p in r["phases"] if p["name"] == name]
+            last = [p for p in ok[-1]["phases"] if p["name"] == name]
+            last_wall = _format_seconds(last[0]["wall"]) if last else "-"
+            print(
+                f"  {name:24} wall median {_format_seconds(statistics.median(p['wall'] for p in samples)):>8}"
+                f" (last {last_wall:>8})"
+                f"  cpu median {_format_seconds(statistics.median(p['cpu'] for p in samples)):>8}"
+            )
+
+    by_kver: dict[str, list[dict]] = {}
+    by_flags: dict[str, list[dict]] = {}
+    for r in records:
+        by_kver.setdefault(r["kver"], []).append(r)
+        by_flags.setdefault(" ".join(r["flags"]) or "(no flags)", []).append(r)
+    print("per kver:")
+    for name, group in sorted(by_kver.items()):
+        _summarise(name, group)
+    print("\nper flag set:")
+    for name, group in sorted(by_flags.items()):
+        _summarise(f"[{name}]", group)
+
+
+class _Journal:
+    """The phases of one build that have completed, and the inputs they
+    completed against, kept in its build dir. A --resume run skips the
+    phases recorded here; a plain run starts the journal afresh, and a
+    build that finishes removes it, its build stamp taking over."""
+
+    def __init__(self, *, kver: str, path: Path, inputs: dict, completed: list[str]) -> None:
+        self.kver = kver
+        self.path = path
+        self.inputs = inputs
+        self.completed = completed
+        self._lock = threading.Lock()
+
+    @classmethod
+    def start(cls, *, kver: str, build_dir: Path, flags: KernelFlags) -> _Journal:
+        journal = cls(
+            kver=kver,
+            path=_journal_path(build_dir),
+            inputs=_journal_inputs(build_dir, flags),
+            completed=[],
+        )
+        journal._save()
+        return journal
+
+    @classmethod
+    def resume(cls, *, kver: str, build_dir: Path, flags: KernelFlags) -> _Journal | None:
+        """The interrupted build's journal, or None if there is nothing to
+        resume. Refuses when an input changed since: a phase completed
+        against other flags, config, source or compiler is not complete."""
+        path = _journal_path(build_dir)
+        if not path.exists() or not (build_dir / ".config").exists():
+            return None
+        saved = json.loads(path.read_text(encoding="utf8"))
+        inputs = _journal_inputs(build_dir, flags)
+        changed = sorted(key for key in inputs if inputs[key] != saved["inputs"].get(key))
+        if changed:
+            raise RuntimeError(
+                f"refusing to resume {kver}: {', '.join(changed)} changed since the "
+                f"interrupted build; rerun without --resume"
+            )
+        return cls(kver=kver, path=path, inputs=inputs, completed=saved["completed"])
+
+    def done(self, name: str) -> bool:
+        return name in self.completed
+
+    def complete(self, name: str) -> None:
+        with self._lock:
+            if name not in self.completed:
+                self.completed.append(name)
+                self._save()
+
+    def finish(self) -> None:
+        self.path.unlink(missing_ok=True)
+
+    def _save(self) -> None:
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(
+            json.dumps({"inputs": self.inputs, "completed": self.completed}, indent=2) + "\n",
+            encoding="utf8",
+        )
+        tmp.rename(self.path)
+
+
+def _journal_path(build_dir: Path) -> Path:
+    return build_dir / "compile-kernel.journal"
+
+
+def _journal_inputs(build_dir: Path, flags: KernelFlags) -> dict:
+    """What every phase after configure depends on. The flags are checked
+    as given, not through the .config: a resume skips configure, so the old
+    .config would match itself."""
+    return {
+        "flags": flags.labels(),
+        "cmdline": flags.cmdline(),
+        "config_sha256": _file_sha256(build_dir / ".config"),
+        "source": _source_kernelversion(_source_of(build_dir)),
+        "toolchain": _toolchain_fingerprint(),
+    }
+
+
+@contextlib.contextmanager
+def _journaling(journal: _Journal | None):
+    """Make `journal` the one _phase() and _pending() use on this thread."""
+    previous = getattr(_THREAD, "journal", None)
+    _THREAD.journal = journal
+    try:
+        yield journal
+    finally:
+        _THREAD.journal = previous
+
+
+def _pending(name: str) -> bool:
+    """False when this thread's build is resuming past phase `name`."""
+    journal = getattr(_THREAD, "journal", None)
+    if journal is not None and journal.done(name):
+        eprint(f"{journal.kver}: {name} completed before the interruption; skipping it")
+        return False
+    return True
+
+
+LOG_DIR = _STATE_DIR / "logs"
+# While compile_and_install_kernel runs with --phase-logs: when the run
+# started, which tells its logs from those an earlier run left behind.
+_PHASE_LOG_RUN: float | None = None
+# Uncompressed size of one zstd frame: finding a line decompresses the
+# frame holding it, never the frames before it.
+_LOG_FRAME_BYTES = 2**20
+# Indexed lines, by kind. "error" is what actually went wrong (compiler,
+# linker, modpost, genkernel, portage); "make" is make's `*** [target]
+# Error N`, repeated once per make level on the way out.
+_LOG_PATTERNS = (
+    ("error", re.compile(rb"\berror:|\bERROR:|^!!! |undefined reference to|\bfatal:")),
+    ("make", re.compile(rb"\*\*\* \[.*\] Error \d+")),
+    ("warning", re.compile(rb"\bwarning:")),
+)
+# per kind: any more are counted but not indexed
+_LOG_INDEX_LIMIT = 1000
+
+
+def _log_paths(kver: str, phase: str) -> tuple[Path, Path]:
+    """A phase's log and its index. Each run of a phase replaces both."""
+    stem = phase.replace("/", ".")
+    return LOG_DIR / kver / f"{stem}.log.zst", LOG_DIR / kver / f"{stem}.index.json"
+
+
+def _zstd(data: bytes, *, decompress: bool = False) -> bytes:
+    args = ["zstd", "-q", "-dc"] if decompress else ["zstd", "-q", "-c", "-3"]
+    return subprocess.run(args, input=data, capture_output=True, check=True).stdout
+
+
+class _PhaseLog:
+    """The output of one phase's commands, teed to the terminal and written
+    as a series of independent zstd frames, which zstdcat reads as one
+    stream. Alongside goes an index of the frames' compressed and
+    uncompressed offsets and of every error, make failure and warning
+    line's uncompressed offset, built while the output goes by."""
+
+    def __init__(self, *, kver: str, phase: str, run: float) -> None:
+        self.kver = kver
+        self.phase = phase
+        self.run = run
+        self.path, self.index_path = _log_paths(kver, phase)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._log = self.path.open("wb")
+        read_fd, write_fd = os.pipe()
+        # what the phase's commands write to
+        self.stream = os.fdopen(write_fd, "wb", buffering=0)
+        self._frames: list[tuple[int, int]] = []
+        self._entries: dict[str, list[dict]] = {kind: [] for kind, _pattern in _LOG_PATTERNS}
+        self._counts = dict.fromkeys(self._entries, 0)
+        self._frame = bytearray()
+        self._offset = 0
+        self._lines = 0
+        self._pump = threading.Thread(
+            target=self._read, args=(read_fd,), name=f"log-{kver}-{phase}", daemon=True
+        )
+        self._pump.start()
+
+    def _read(self, read_fd: int) -> None:
+        carry = b""
+        with open(read_fd, "rb", buffering=0) as pipe:
+            while chunk := pipe.read(2**16):
+                sys.stdout.buffer.write(chunk)
+                sys.stdout.buffer.flush()
+                *lines, carry = (carry + chunk).split(b"\n")
+                for line in lines:
+                    self._add(line + b"\n")
+        if carry:
+            self._add(carry)
+        self._write_frame()
+
+    def _add(self, line: bytes) -> None:
+        self._lines += 1
+        for kind, pattern in _LOG_PATTERNS:
+            if pattern.search(line):
+                self._counts[kind] += 1
+                if len(self._entries[kind]) < _LOG_INDEX_LIMIT:
+                    self._entries[kind].append(
+                        {
+                            "offset": self._offset,
+                            "line": self._lines,
+                            "text": line.decode("utf8", "replace").rstrip()[:400],
+                        }
+                    )
+                break
+        self._frame += line
+        self._offset += len(line)
+        # frames end on line boundaries, so no line spans two
+        if len(self._frame) >= _LOG_FRAME_BYTES:
+            self._write_frame()
+
+    def _write_frame(self) -> None:
+        if not self._frame:
+            return
+        self._frames.append((self._log.tell(), self._offset - len(self._frame)))
+        self._log.write(_zstd(bytes(self._frame)))
+        self._frame.clear()
+
+    def close(self, status: int) -> dict | None:
+        """Finish the log once the phase's commands are done with it, and
+        write its index; an empty log of a phase that succeeded is removed."""
+        self.stream.close()
+        # EOF once nothing holds the write end; a daemon some command left
+        # behind may, and is not worth hanging the build for
+        self._pump.join(timeout=30)
+        if self._pump.is_alive():
+            eprint(f"{self.kver}: {self.phase} log still held open; index not written")
+            return None
+        self._log.close()
+        if not self._offset and not status:
+            self.path.unlink()
+            self.index_path.unlink(missing_ok=True)
+            return None
+        index = {
+            "kver": self.kver,
+            "phase": self.phase,
+            "run": self.run,
+            "status": status,
+            "finished": time.time(),
+            "bytes": self._offset,
+            "lines": self._lines,
+            "frames": self._frames,
+            "counts": self._counts,
+            "entries": self._entries,
+        }
+        tmp = self.index_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(index), encoding="utf8")
+        tmp.rename(self.index_path)
+        return index
+
+
+@contextlib.contextmanager
+def _phase_logging(enabled: bool):
+    """Run the body with every recorded phase's commands logged."""
+    global _PHASE_LOG_RUN
+    _PHASE_LOG_RUN = time.time() if enabled else None
+    try:
+        yield
+    finally:
+        _PHASE_LOG_RUN = None
+
+
+@contextlib.contextmanager
+def _logging_to(kver: str, phase: str, run: float):
+    """Send this thread's commands' output to phase's log for the body, and
+    point at the first error if the phase fails."""
+    log = _PhaseLog(kver=kver, phase=phase, run=run)
+    previous = getattr(_THREAD, "log", None)
+    _THREAD.log = log
+    status = 0
+    reported = False
+    try:
+        yield
+    except BaseException as exc:
+        status = _exit_status(exc)
+        # nested phases fail together; point at the innermost one's log
+        reported = getattr(exc, "_log_reported", False)
+        with contextlib.suppress(AttributeError):
+            exc._log_reported = True
+        raise
+    finally:
+        _THREAD.log = previous
+        index = log.close(status)
+        if status and not reported and index is not None:
+            first = _first_failure(index)
+            if first is not None:
+                eprint(f"{kver}: {phase} failed; line {first['line']}: {first['text']}")
+            eprint(f"full log: compile-kernel log --errors {kver}")
+
+
+@contextlib.contextmanager
+def _to_terminal():
+    """Give the body's commands the terminal, not the phase log: nconfig."""
+    previous = getattr(_THREAD, "log", None)
+    _THREAD.log = None
+    try:
+        yield
+    finally:
+        _THREAD.log = previous
+
+
+def _log_output() -> dict:
+    """subprocess.run arguments sending a command's output to this thread's
+    phase log, if it has one."""
+    log = getattr(_THREAD, "log", None)
+    if log is None:
+        return {}
+    return {"stdout": log.stream, "stderr": subprocess.STDOUT}
+
+
+def _hs_output(**default) -> dict:
+    """hs command arguments sending its output to this thread's phase log,
+    or `default` (_fg, or sys.stdout and sys.stderr) without one."""
+    log = getattr(_THREAD, "log", None)
+    if log is None:
+        return default
+    return {"_out": log.stream, "_err_to_out": True}
+
+
+def _first_failure(index: dict) -> dict | None:
+    """The line most worth reading first: the first error, else the first
+    make failure."""
+    for kind in ("error", "make"):
+        if index["entries"][kind]:
+            return index["entries"][kind][0]
+    return None
+
+
+def _read_log_indexes(kver: str) -> list[dict]:
+    """The index of every phase of kver's last run that logged, oldest
+    first. Phases that did not run this time (resumed past, skipped by the
+    build stamp, or named for the other install path) keep an earlier run's
+    index; those are left out."""
+    indexes = [
+        json.loads(path.read_text(encoding="utf8"))
+        for path in (LOG_DIR / kver).glob("*.index.json")
+    ]
+    if not indexes:
+        return []
+    last = max(index["run"] for index in indexes)
+    return sorted(
+        (index for index in indexes if index["run"] == last), key=lambda index: index["finished"]
+    )
+
+
+def _log_lines_around(index: dict, offset: int, *, before: int, after: int) -> list[str]:
+    """The lines around uncompressed `offset`, decompressing only the frames
+    they fall in: the one holding the offset and its neighbours."""
+    frames = index["frames"]
+    if not frames:
+        return []
+    holding = max(i for i, (_start, plain) in enumerate(frames) if plain <= offset)
+    first, last = max(holding - 1, 0), min(holding + 1, len(frames) - 1)
+    path, _index_path = _log_paths(index["kver"], index["phase"])
+    with path.open("rb") as log:
+        log.seek(frames[first][0])
+        end = frames[last + 1][0] if last + 1 < len(frames) else None
+        data = _zstd(log.read(end - frames[first][0]) if end else log.read(), decompress=True)
+    relative = offset - frames[first][1]
+    at = data.count(b"\n", 0, relative)
+    lines = data.decode("utf8", "replace").splitlines()
+    return lines[max(at - before, 0) : at + after + 1]
+
+
+def phase_log(
+    *,
+    kver: str,
+    phase: str | None = None,
+    errors: bool = False,
+    context: int = 20,
+) -> None:
+    """Show kver's phase logs from its last build.
+
+    With errors: the first real failure of the phase that failed (or of
+    `phase`), with `context` lines either side, then its other error lines,
+    all from the index and the one or two frames around the failure. With
+    a phase alone: that whole log. Otherwise: one line per phase.
+    """
+    indexes = _read_log_indexes(kver)
+    if not indexes:
+        raise ValueError(f"no logs for {kver} in {LOG_DIR}; build it with --phase-logs")
+    if phase is not None:
+        indexes = [index for index in indexes if index["phase"] == phase]
+        if not indexes:
+            raise ValueError(f"no {phase} log from the last run of {kver}")
+
+    if errors:
+        failed = [index for index in indexes if index["status"]]
+        if not failed and phase is None:
+            eprint(f"{kver}: no phase failed in its last build")
+            for index in indexes:
+                if index["counts"]["error"]:
+                    print(f"  {index['phase']}: {index['counts']['error']} error lines")
+            return
+        # the innermost failed phase finished first, and has the output;
+        # the phases around it failed with it
+        with_errors = [index for index in failed if _first_failure(index) is not None]
+        with_output = [index for index in failed if index["bytes"]]
+        index = (with_errors or with_output or failed or indexes)[0 if failed else -1]
+        first = _first_failure(index)
+        offset = first["offset"] if first is not None else index["bytes"]
+        where = f"line {first['line']}" if first is not None else "end of log (no error line found)"
+        print(
+            f"{kver} {index['phase']}: exit {index['status']}, "
+            f"{index['counts']['error']} errors, {index['counts']['warning']} warnings; {where}"
+        )
+        print()
+        for line in _log_lines_around(index, offset, before=context, after=context):
+            print(line)
+        others = [entry for entry in index["entries"]["error"] if entry is not first]
+        if others:
+            print(f"\nother error lines ({index['counts']['error'] - 1}):")
+            for entry in others[:20]:
+                print(f"  {entry['line']}: {entry['text']}")
+        return
+
+    if phase is not None:
+        path, _index_path = _log_paths(kver, phase)
+        subprocess.run(["zstd", "-q", "-dc", path.as_posix()], check=True)
+        return
+
+    print(f"{'phase':<36} {'exit':>4} {'MiB':>7} {'errors':>7} {'warnings':>8}")
+    for index in indexes:
+        print(
+            f"{index['phase']:<36} {index['status']:>4} {index['bytes'] / 2**20:>7.1f} "
+            f"{index['counts']['error']:>7} {index['counts']['warning']:>8}"
+        )
+
+
+HEATMAP_DIR = _STATE_DIR / "heatmaps"
+
+# obj-$(CONFIG_FOO) += a.o dir/   btrfs-y += ctree.o   foo-objs := a.o b.o
+_KBUILD_ASSIGN_RE = re.compile(
+    r"^\s*([A-Za-z0-9_.-]+?)-(\$\((CONFIG_[A-Za-z0-9_]+)\)|y|objs)\s*[:+]?=\s*(.*)$"
+)
+# Kbuild list variables whose -y members are not parts of a composite object
+_KBUILD_LISTS = frozenset(
+    {"obj", "lib", "subdir", "always", "targets", "extra", "hostprogs", "userprogs", "core", "drivers", "libs"}
+)
+
+
+def _kbuild_gates(src: Path, directory: str) -> tuple[dict[str, str], dict[str, str]]:
+    """Parse directory's Kbuild makefile into (gates, parts): the CONFIG
+    symbol each object or subdir entry is built under, and the composite
+    object each part of one is linked into."""
+    gates: dict[str, str] = {}
+    parts: dict[str, str] = {}
+    for name in ("Kbuild", "Makefile"):
+        makefile = src / directory / name
+        if makefile.exists():
+            break
+    else:
+        return gates, parts
+    text = makefile.read_text(encoding="utf8", errors="replace").replace("\\\n", " ")
+    for line in text.splitlines():
+        match = _KBUILD_ASSIGN_RE.match(line)
+        if match is None:
+            continue
+        prefix, _selector, symbol, rhs = match.groups()
+        for token in rhs.split():
+            if not token.endswith((".o", "/")):
+                continue
+            if symbol is not None:
+                gates.setdefault(token, symbol)
+            elif prefix not in _KBUILD_LISTS:
+                parts.setdefault(token, f"{prefix}.o")
+    return gates, parts
+
+
+def _gating_symbol(
+    src: Path, obj: str, cache: dict[str, tuple[dict[str, str], dict[str, str]]]
+) -> str | None:
+    """The innermost CONFIG symbol an object is built under: its own entry,
+    the composite it is part of, or else the nearest enclosing directory's
+    entry in its parent makefile. None for objects built unconditionally."""
+    directory, _, name = obj.rpartition("/")
+    while True:
+        if directory not in cache:
+            cache[directory] = _kbuild_gates(src, directory)
+        gates, parts = cache[directory]
+        seen = set()
+        while name not in gates and name in parts and name not in seen:
+            seen.add(name)
+            name = parts[name]
+        if name in gates:
+            return gates[name]
+        if not directory:
+            return None
+        parent, _, leaf = directory.rpartition("/")
+        directory, name = parent, f"{leaf}/"
+
+
+def _read_cc_times(build_dir: Path) -> list[tuple[str, float, int]]:
+    """(object relative to build_dir, wall seconds, peak RSS KiB) per
+    compiled object, as the timing shim logged them."""
+    log = build_dir / _CC_TIMING_LOG
+    if not log.exists():
+        return []
+    root = build_dir.resolve().as_posix()
+    times = []
+    for line in log.read_text(encoding="utf8").splitlines():
+        path, wall, rss = line.split("\t")
+        rel = os.path.relpath(path, root)
+        if not rel.startswith(".."):
+            times.append((rel, float(wall), int(rss)))
+    return times
+
+
+def _write_heatmap(*, kver: str, build_dir: Path, flags: KernelFlags) -> Path | None:
+    """Aggregate this build's per-object compile times by source directory
+    and by gating CONFIG symbol, into HEATMAP_DIR/{kver}.json."""
+    times = _read_cc_times(build_dir)
+    if not times:
+        eprint(f"{kver}: nothing was compiled; no heatmap")
+        return None
+    source = _source_of(build_dir)
+    cache: dict[str, tuple[dict[str, str], dict[str, str]]] = {}
+    by_dir: dict[str, list[float]] = {}
+    by_config: dict[str, list[float]] = {}
+    for obj, wall, rss in times:
+        directory = os.path.dirname(obj) or "."
+        symbol = _gating_symbol(source, obj, cache) or "(unconditional)"
+        for table, key in ((by_dir, directory), (by_config, symbol)):
+            entry = table.setdefault(key, [0.0, 0, 0])
+            entry[0] += wall
+            entry[1] += 1
+            entry[2] = max(entry[2], rss)
+    report = {
+        "kver": kver,
+        "flags": flags.labels(),
+        "created": int(time.time()),
+        "objects": len(times),
+        "wall": round(sum(wall for _obj, wall, _rss in times), 3),
+        "max_rss_kb": max(rss for _obj, _wall, rss in times),
+        "by_dir": {k: [round(w, 3), n, r] for k, (w, n, r) in by_dir.items()},
+        "by_config": {k: [round(w, 3), n, r] for k, (w, n, r) in by_config.items()},
+    }
+    HEATMAP_DIR.mkdir(parents=True, exist_ok=True)
+    path = HEATMAP_DIR / f"{kver}.json"
+    path.write_text(json.dumps(report, indent=2, sort_keys=True) + "\n", encoding="utf8")
+    eprint(f"{kver}: compile heatmap of {len(times)} objects written to {path}")
+    return path
+
+
+def _read_heatmap(kver: str) -> dict:
+    path = HEATMAP_DIR / f"{kver}.json"
+    if not path.exists():
+        raise ValueError(f"no heatmap for {kver} in {HEATMAP_DIR}; build it with --cc-timing")
+    return json.loads(path.read_text(encoding="utf8"))
+
+
+def compile_heatmap(*, kver: str, compare: str | None = None, top: int = 20) -> None:
+    """Print where kver's compile time went, by source directory and by the
+    CONFIG symbol gating each object. With `compare`, print the difference
+    from that kver's heatmap instead, largest first: between two variants of
+    one source, that is what their differing debug groups cost to build.
+
+    Times are summed per object across parallel jobs, so they are CPU-bound
+    wall time, not elapsed build time; ccache hits count as what they cost.
+    """
+    report = _read_heatmap(kver)
+    if compare is None:
+        print(
+            f"{kver} [{' '.join(report['flags'])}]: {report['objects']} objects, "
+            f"{_format_seconds(report['wall'])} compile time, "
+            f"largest job {report['max_rss_kb'] // 1024} MiB"
+        )
+        for title, table in (("directory", report["by_dir"]), ("config", report["by_config"])):
+            print(f"\nby {title}:")
+            ranked = sorted(table.items(), key=lambda item: item[1][0], reverse=True)
+            for key, (wall, count, rss) in ranked[:top]:
+                share = 100 * wall / report["wall"]
+                print(
+                    f"  {_format_seconds(wall):>8} {share:5.1f}%  {count:6} objs  "
+                    f"{rss // 1024:6} MiB  {key}"
+                )
+        return
+
+    other = _read_heatmap(compare)
+    print(
+        f"{kver} [{' '.join(report['flags'])}] vs {compare} [{' '.join(other['flags'])}]: "
+        f"{report['wall'] - other['wall']:+.0f}s compile time, "
+        f"{report['objects'] - other['objects']:+} objects"
+    )
+    for title, key in (("directory", "by_dir"), ("config", "by_config")):
+        ours, theirs = report[key], other[key]
+        deltas = {
+            name: (ours.get(name, [0.0, 0, 0])[0] - theirs.get(name, [0.0, 0, 0])[0],
+                   ours.get(name, [0.0, 0, 0])[1] - theirs.get(name, [0.0, 0, 0])[1])
+            for name in ours.keys() | theirs.keys()
+        }
+        print(f"\nby {title}:")
+        ranked = sorted(deltas.items(), key=lambda item: abs(item[1][0]), reverse=True)
+        for name, (wall, count) in ranked[:top]:
+            print(f"  {wall:+9.1f}s  {count:+6} objs  {name}")
+
+
+# per build dir: CONFIG symbol -> objects, from fixdep's .cmd files
+_IMPACT_INDEX = "compile-kernel.impact.json.gz"
+# $(wildcard include/config/DEBUG_LIST), or include/config/debug/list.h
+# before Linux 5.13
+_FIXDEP_CONFIG_RE = re.compile(r"\$\(wildcard include/config/([A-Za-z0-9_/]+?)(?:\.h)?\)")
+
+
+def _cmd_file_symbols(path: Path) -> list[str]:
+    text = path.read_text(encoding="utf8", errors="replace")
+    return sorted(
+        {"CONFIG_" + m.replace("/", "_").upper() for m in _FIXDEP_CONFIG_RE.findall(text)}
+    )
+
+
+def _impact_index(build_dir: Path) -> dict[str, set[str]]:
+    """{CONFIG symbol: objects whose compile reads it} for build_dir.
+
+    fixdep writes .<obj>.cmd beside every object with the config symbols
+    its sources and headers test. The index keeps each .cmd file's mtime,
+    so a refresh only rereads the ones rebuilt since. Stored with the
+    symbols interned, as a few thousand symbols span tens of thousands of
+    objects.
+    """
+    path = build_dir / _IMPACT_INDEX
+    symbols: list[str] = []
+    files: dict[str, list] = {}
+    if path.exists():
+        with gzip.open(path, "rt", encoding="utf8") as f:
+            saved = json.load(f)
+        symbols, files = saved["symbols"], saved["files"]
+    symbol_ids = {symbol: i for i, symbol in enumerate(symbols)}
+
+    seen: set[str] = set()
+    reread = 0
+    for dirpath, _dirnames, filenames in os.walk(build_dir):
+        for name in filenames:
+            if not (name.startswith(".") and name.endswith(".o.cmd")):
+                continue
+            cmd = os.path.join(dirpath, name)
+            rel = os.path.relpath(cmd, build_dir)
+            seen.add(rel)
+            mtime = os.stat(cmd).st_mtime_ns
+            if rel in files and files[rel][0] == mtime:
+                continue
+            ids = []
+            for symbol in _cmd_file_symbols(Path(cmd)):
+                if symbol not in symbol_ids:
+                    symbol_ids[symbol] = len(symbols)
+                    symbols.append(symbol)
+                ids.append(symbol_ids[symbol])
+            files[rel] = [mtime, ids]
+            reread += 1
+    for gone in files.keys() - seen:
+        del files[gone]
+    icp(f"impact index for {build_dir}: {len(files)} objects, {reread} reread")
+
+    tmp = path.with_name(path.name + ".tmp")
+    with gzip.open(tmp, "wt", encoding="utf8") as f:
+        json.dump({"symbols": symbols, "files": files}, f, separators=(",", ":"))
+    tmp.rename(path)
+
+    index: dict[str, set[str]] = {}
+    for rel, (_mtime, ids) in files.items():
+        directory, _, name = rel.rpartition("/")
+        # .foo.o.cmd -> foo.o
+        obj = f"{directory}/{name[1:-4]}" if directory else name[1:-4]
+        for i in ids:
+            index.setdefault(symbols[i], set()).add(obj)
+    return index
+
+
+def _changed_symbols(config: Path, other: Path) -> set[str]:
+    """Symbols whose value differs between two .config (or auto.conf)
+    files. Unset and `is not set` are the same to Kbuild."""
+    ours = _parse_config_state(config.read_text(encoding="utf8"))
+    theirs = _parse_config_state(other.read_text(encoding="utf8"))
+    return {
+        sym for sym in ours.keys() | theirs.keys() if ours.get(sym, "n") != theirs.get(sym, "n")
+    }
+
+
+def _indexed_objects(index: dict[str, set[str]]) -> set[str]:
+    return {obj for objs in index.values() for obj in objs}
+
+
+def _affected_objects(index: dict[str, set[str]], symbols: set[str]) -> set[str]:
+    objects: set[str] = set()
+    for symbol in symbols:
+        objects |= index.get(symbol, set())
+    return objects
+
+
+def rebuild_impact(
+    *,
+    kver: str,
+    symbols: list[str] | tuple[str, ...] = (),
+    against: Path | None = None,
+    top: int = 10,
+) -> int:
+    """Print how many of kver's objects a config change would recompile,
+    and where they are. Returns the count.
+
+    The change is `symbols`, and/or every symbol whose value differs
+    between kver's .config and `against` (e.g. the config a debug flag would
+    produce). Symbols olddefconfig would flip in turn (selects, defaults)
+    are only counted when they are named or differ in `against`; objects
+    the change would newly build are not in the index and not counted.
+    """
+    build_dir = _build_dir(kver)
+    if not (build_dir / ".config").exists():
+        raise ValueError(f"no configured build dir for {kver} at {build_dir}")
+    changed = {s if s.startswith("CONFIG_") else f"CONFIG_{s}" for s in symbols}
+    if against is not None:
+        changed |= _changed_symbols(build_dir / ".config", against)
+    if not changed:
+        raise ValueError("no symbols given and no difference from --against")
+
+    index = _impact_index(build_dir)
+    total = len(_indexed_objects(index))
+    objects = _affected_objects(index, changed)
+    per_symbol = [(len(index.get(symbol, ())), symbol) for symbol in changed]
+    print(
+        f"toggling {', '.join(sorted(changed)) if len(changed) <= 5 else f'{len(changed)} symbols'} "
+        f"would recompile {len(objects):,} of {total:,} objects in {kver}"
+    )
+    if len(changed) > 1:
+        print("\nby symbol:")
+        for count, symbol in sorted(per_symbol, reverse=True)[:top]:
+            print(f"  {count:8,}  {symbol}")
+    by_dir: dict[str, int] = {}
+    for obj in objects:
+        top_dir = "/".join(obj.split("/")[:-1][:2]) or "."
+        by_dir[top_dir] = by_dir.get(top_dir, 0) + 1
+    if by_dir:
+        print("\nby directory:")
+        for directory, count in sorted(by_dir.items(), key=lambda item: item[1], reverse=True)[:top]:
+            print(f"  {count:8,}  {directory}")
+    return len(objects)
+
+
+class _SystemLock:
+    """A reentrant lock that also excludes other compile-kernel processes:
+    a thread lock within this one, plus an flock on `path` held while any
+    thread here holds the lock at all. The serve daemon's batch workers
+    and a CLI run beside them so take turns at the shared steps only."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd: int | None = None
+
+    def __enter__(self) -> _SystemLock:
+        self._lock.acquire()
+        if self._depth == 0:
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except BaseException:
+                if self._fd is not None:
+                    os.close(self._fd)
+                    self._fd = None
+                self._lock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._depth -= 1
+        if self._depth == 0:
+            os.close(self._fd)  # drops the flock
+            self._fd = None
+        self._lock.release()
+
+
+# Everything builds share: portage's installed package DB, cfg-layer's
+# video dimension, /boot and its symlinks, grub's defaults. Compiles run in
+# parallel, here and in other compile-kernel processes; any step touching
+# these holds this.
+_SYSTEM_LOCK = _SystemLock(_STATE_DIR / "system.lock")
+
+
+# Peak RSS of one compile job before history has measured it: one cc1 on
+# one object, more with DWARF5 debug info or KASAN's instrumentation.
+_DEFAULT_MB_PER_JOB = 256
+_FLAG_MB_PER_JOB = {
+    "perf-profile": 512,
+    "kasan": 512,
+    "bpftrace": 512,
+    "gcov": 384,
+}
+# Peak RSS of the serial tail of a compile before history has measured it:
+# the vmlinux link and pahole's BTF pass, which run alone but far exceed
+# any one object's compile.
+_DEFAULT_LINK_MB = 2048
+_FLAG_LINK_MB = {
+    "perf-profile": 6144,
+    "bpftrace": 6144,
+    "kasan": 3072,
+    "gcov": 3072,
+}
+
+
+def _mem_available_mb() -> int:
+    for line in Path("/proc/meminfo").read_text(encoding="utf8").splitlines():
+        if line.startswith("MemAvailable:"):
+            return int(line.split()[1]) // 1024
+    raise RuntimeError("no MemAvailable in /proc/meminfo")
+
+
+def _mb_per_job(flags: KernelFlags) -> int:
+    """Memory one make job of this flag set needs, learned from history.
+
+    A successful --cc-timing build records the mean of its objects' peak
+    RSS, as the shim measured each compile. Nothing else is a per-job
+    figure: a cgroup's memory.peak counts page cache, and with --tmpfs-build
+    the object dirs. The median of the recent ones, plus a quarter for
+    headroom.
+    """
+    labels = flags.labels()
+    measured = [
+        record["job_rss_kb"]
+        for record in _read_history()
+        if record["flags"] == labels and record["status"] == 0 and record.get("job_rss_kb")
+    ]
+    if measured:
+        return int(statistics.median(measured[-5:]) / 1024 * 1.25)
+    return max(
+        [_DEFAULT_MB_PER_JOB]
+        + [_FLAG_MB_PER_JOB[label] for label in labels if label in _FLAG_MB_PER_JOB]
+    )
+
+
+def _link_mb(flags: KernelFlags) -> int:
+    """Memory the serial end of this flag set's compile needs on top of the
+    jobs: the largest child of a compile phase, the vmlinux link or pahole.
+
+    Only phases whose children raised the process's ru_maxrss measured
+    themselves; in a long-lived process (serve) most do not. The smallest
+    recent one is the tightest bound, plus a quarter for headroom.
+    """
+    labels = flags.labels()
+    measured = [
+        phase["maxrss_kb"]
+        for record in _read_history()
+        if record["flags"] == labels and record["status"] == 0
+        for phase in record["phases"]
+        if phase["name"] == "compile" and phase.get("maxrss_in_phase")
+    ]
+    if measured:
+        return int(min(measured[-5:]) / 1024 * 1.25)
+    return max(
+        [_DEFAULT_LINK_MB]
+        + [_FLAG_LINK_MB[label] for label in labels if label in _FLAG_LINK_MB]
+    )
+
+
+def _job_budget(options: BuildOptions, flag_sets: list[KernelFlags]) -> int:
+    """Total make jobs for one invocation: --jobs or the cpu count, capped
+    so that many jobs of the hungriest flag set fit in available memory
+    next to each build's serial link."""
+    budget = options.jobs or os.cpu_count() or 1
+    if not options.adaptive_jobs:
+        return budget
+    per_job = max(_mb_per_job(flags) for flags in flag_sets)
+    # concurrent builds may link at once
+    reserved = sum(_link_mb(flags) for flags in flag_sets)
+    available = _mem_available_mb()
+    high = _parse_size(options.memory_high) if options.memory_high is not None else None
+    if high is not None:
+        # past memory.high the cgroup is throttled into reclaim, not OOM-killed
+        available = min(available, high // 2**20)
+    fits = max(1, (available - reserved) // per_job)
+    if fits < budget:
+        eprint(
+            f"memory: {available} MiB available, {reserved} MiB kept for linking, "
+            f"~{per_job} MiB per job; running {fits} jobs instead of {budget}"
+        )
+        return fits
+    return budget
+
+
+def _build_jobs(budget: int, concurrent: int) -> int:
+    """make -j for each of `concurrent` builds, out of one job budget, so a
+    pair build does not run 2 x cpu_count jobs."""
+    return max(1, budget // concurrent)
+
+
+_PSI_MEMORY = Path("/proc/pressure/memory")
+# "some" avg10: the share of the last 10s in which any task stalled on memory
+_PSI_WITHHOLD = 10.0
+_PSI_RELEASE = 2.0
+_PSI_INTERVAL = 5.0
+
+
+def _memory_pressure() -> float:
+    """Memory stall share of the build's own cgroup when it has one, so
+    memory.high throttling shows up here; otherwise of the whole system."""
+    psi = _CGROUP / "memory.pressure" if _CGROUP is not None else _PSI_MEMORY
+    # some avg10=0.00 avg60=0.00 avg300=0.00 total=0
+    for line in psi.read_text(encoding="utf8").splitlines():
+        if line.startswith("some "):
+            return float(line.split()[1].split("=", 1)[1])
+    return 0.0
+
+
+def _govern_jobserver(jobserver: _Jobserver, stop: threading.Event) -> None:
+    """While memory pressure is high, take jobserver tokens out of
+    circulation one at a time, and hand them back once it has eased. At
+    least one token stays in circulation, beside each make's implicit one."""
+    held = 0
+    try:
+        while not stop.wait(_PSI_INTERVAL):
+            pressure = _memory_pressure()
+            if pressure > _PSI_WITHHOLD and held < jobserver.tokens - 2:
+                if jobserver.withhold():
+                    held += 1
+                    eprint(f"memory pressure {pressure:.1f}%: holding back {held} jobserver token(s)")
+            elif pressure < _PSI_RELEASE and held:
+                jobserver.release()
+                held -= 1
+                eprint(f"memory pressure {pressure:.1f}%: {held} jobserver token(s) still held back")
+    finally:
+        for _ in range(held):
+            jobserver.release()
+
+
+@contextlib.contextmanager
+def _memory_governor(enabled: bool):
+    """Run the body with _govern_jobserver watching PSI, when there is a
+    jobserver to govern and the kernel reports memory pressure. A joined
+    jobserver is left to the process that owns it."""
+    if _JOBSERVER is not None and not _JOBSERVER.owned:
+        yield
+        return
+    if not enabled or _JOBSERVER is None or not _PSI_MEMORY.exists():
+        if enabled:
+            icp("no jobserver or no PSI; job count fixed at its starting value")
+        yield
+        return
+    stop = threading.Event()
+    governor = threading.Thread(
+        target=_govern_jobserver, args=(_JOBSERVER, stop), name="memory-governor", daemon=True
+    )
+    governor.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        governor.join()
+
+
+_CGROUP_ROOT = Path("/sys/fs/cgroup")
+# one leaf per run under this, so concurrent invocations do not share limits
+_CGROUP_PARENT = _CGROUP_ROOT / "compile-kernel"
+_CGROUP_CONTROLLERS = ("cpu", "io", "memory")
+_CPU_MAX_PERIOD_USEC = 100_000
+
+# The leaf this process and every child it spawns run in, while set.
+_CGROUP: Path | None = None
+
+
+def _parse_size(text: str) -> int | None:
+    """Bytes in a memory.high style size (16G, 512M, max); None for max."""
+    text = text.strip()
+    if text == "max":
+        return None
+    units = {"K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+    if text[-1:].upper() in units:
+        return int(float(text[:-1]) * units[text[-1].upper()])
+    return int(text)
+
+
+def _cgroup_knobs(options: BuildOptions) -> dict[str, str]:
+    """Interface file -> value for the limits set in `options`."""
+    knobs = {}
+    if options.cpu_weight is not None:
+        knobs["cpu.weight"] = str(options.cpu_weight)
+    if options.cpu_max is not None:
+        quota = int(options.cpu_max * _CPU_MAX_PERIOD_USEC)
+        knobs["cpu.max"] = f"{quota} {_CPU_MAX_PERIOD_USEC}"
+    if options.io_weight is not None:
+        knobs["io.weight"] = f"default {options.io_weight}"
+    if options.io_max is not None:
+        knobs["io.max"] = options.io_max
+    if options.memory_high is not None:
+        knobs["memory.high"] = options.memory_high
+    return knobs
+
+
+def _own_cgroup() -> Path:
+    # 0::/user.slice/user-0.slice/session-1.scope
+    for line in Path("/proc/self/cgroup").read_text(encoding="utf8").splitlines():
+        if line.startswith("0::"):
+            return _CGROUP_ROOT / line[3:].lstrip("/")
+    raise RuntimeError("this process is not in a cgroup v2 hierarchy")
+
+
+def _read_keyed(path: Path) -> dict[str, int]:
+    """A flat-keyed cgroup file (cpu.stat, memory.events) as a dict."""
+    if not path.exists():
+        return {}
+    return {
+        key: int(value)
+        for key, value in (line.split() for line in path.read_text(encoding="utf8").splitlines())
+    }
+
+
+def _cgroup_stats(leaf: Path) -> dict[str, int]:
+    """CPU, memory and IO totals of everything that ran in `leaf`."""
+    cpu = _read_keyed(leaf / "cpu.stat")
+    events = _read_keyed(leaf / "memory.events")
+    stats = {
+        "cpu_usec": cpu.get("usage_usec", 0),
+        "user_usec": cpu.get("user_usec", 0),
+        "system_usec": cpu.get("system_usec", 0),
+        "throttled_usec": cpu.get("throttled_usec", 0),
+        "memory_high_events": events.get("high", 0),
+        "oom_kills": events.get("oom_kill", 0),
+    }
+    peak = leaf / "memory.peak"
+    if peak.exists():
+        stats["memory_peak"] = int(peak.read_text(encoding="utf8"))
+    io_stat = leaf / "io.stat"
+    if io_stat.exists():
+        # 259:0 rbytes=180224 wbytes=0 rios=22 wios=0 dbytes=0 dios=0
+        for line in io_stat.read_text(encoding="utf8").splitlines():
+            for entry in line.split()[1:]:
+                key, value = entry.split("=", 1)
+                if key in ("rbytes", "wbytes"):
+                    stats[key] = stats.get(key, 0) + int(value)
+    return stats
+
+
+def _report_cgroup(stats: dict[str, int]) -> None:
+    cpu = (
+        f"cgroup cpu: {_format_seconds(stats['cpu_usec'] / 1e6)} "
+        f"(user {_format_seconds(stats['user_usec'] / 1e6)}, "
+        f"system {_format_seconds(stats['system_usec'] / 1e6)})"
+    )
+    if stats["throttled_usec"]:
+        cpu += f", throttled {_format_seconds(stats['throttled_usec'] / 1e6)}"
+    eprint(cpu)
+    memory = "cgroup memory:"
+    if "memory_peak" in stats:
+        memory += f" peak {stats['memory_peak'] / 2**20:.0f} MiB,"
+    eprint(
+        f"{memory} memory.high reached {stats['memory_high_events']} times, "
+        f"{stats['oom_kills']} OOM kills"
+    )
+    if "rbytes" in stats:
+        eprint(
+            f"cgroup io: read {stats['rbytes'] / 2**20:.0f} MiB, "
+            f"wrote {stats.get('wbytes', 0) / 2**20:.0f} MiB"
+        )
+
+
+def _enable_controllers(group: Path, wanted: list[str]) -> list[str]:
+    """Delegate `wanted` controllers to group's children; returns the ones
+    that were not delegated already."""
+    subtree_control = group / "cgroup.subtree_control"
+    current = set(subtree_control.read_text(encoding="utf8").split())
+    added = [c for c in wanted if c not in current]
+    if added:
+        subtree_control.write_text(" ".join(f"+{c}" for c in added), encoding="utf8")
+    return added
+
+
+def _release_cgroup_parent(enabled_at_root: list[str]) -> None:
+    """Remove _CGROUP_PARENT once no run's leaf is left in it, then undo
+    what this run delegated at the root. Another run still holding a leaf
+    keeps both; the controllers cannot be taken back from under it."""
+    try:
+        _CGROUP_PARENT.rmdir()
+    except OSError:
+        return
+    if not enabled_at_root:
+        return
+    try:
+        (_CGROUP_ROOT / "cgroup.subtree_control").write_text(
+            " ".join(f"-{c}" for c in enabled_at_root), encoding="utf8"
+        )
+    except OSError as exc:
+        eprint(f"could not undo {enabled_at_root} in {_CGROUP_ROOT}/cgroup.subtree_control: {exc}")
+
+
+@contextlib.contextmanager
+def _build_cgroup(options: BuildOptions):
+    """Run the body, and every process it spawns, in a cgroup v2 leaf of its
+    own carrying the limits set in `options`; yields the leaf, or None when
+    no cgroup was asked for.
+
+    This process moves into the leaf rather than each child being placed
+    there, so make, genkernel, emerge and grub-mkconfig, and anything they
+    fork, are covered without touching how any of them is started. The
+    parent only holds leaves: cgroup v2 lets a group delegate controllers to
+    its children only while it has no processes of its own. On the way out
+    the process moves back, the totals are reported, and the leaf goes,
+    then the parent and whatever this run had the root delegate.
+    """
+    global _CGROUP
+    if not options.wants_cgroup:
+        yield None
+        return
+    available = _CGROUP_ROOT / "cgroup.controllers"
+    if not available.exists():
+        raise RuntimeError(f"--cgroup needs the cgroup v2 hierarchy mounted at {_CGROUP_ROOT}")
+    controllers = set(available.read_text(encoding="utf8").split())
+    knobs = _cgroup_knobs(options)
+    missing = {knob.split(".")[0] for knob in knobs} - controllers
+    if missing:
+        raise RuntimeError(f"cgroup controllers not available: {', '.join(sorted(missing))}")
+    wanted = [c for c in _CGROUP_CONTROLLERS if c in controllers]
+    # the root's delegation is system-wide: only add what it lacks, and take
+    # exactly that back once nothing of ours is left under it
+    enabled_at_root = _enable_controllers(_CGROUP_ROOT, wanted)
+    leaf = _CGROUP_PARENT / f"run-{os.getpid()}"
+    try:
+        _CGROUP_PARENT.mkdir(exist_ok=True)
+        _enable_controllers(_CGROUP_PARENT, wanted)
+        leaf.mkdir()
+        try:
+            for knob, value in knobs.items():
+                icp(leaf / knob, value)
+                try:
+                    (leaf / knob).write_text(value, encoding="utf8")
+                except OSError as exc:
+                    raise RuntimeError(f"cgroup rejected {knob}={value!r}: {exc}") from exc
+            origin = _own_cgroup()
+            (leaf / "cgroup.procs").write_text(str(os.getpid()), encoding="utf8")
+            _CGROUP = leaf
+            eprint(f"running in {leaf} {' '.join(f'{k}={v!r}' for k, v in knobs.items())}".rstrip())
+            try:
+                yield leaf
+            finally:
+                _CGROUP = None
+                try:
+                    (origin / "cgroup.procs").write_text(str(os.getpid()), encoding="utf8")
+                except OSError as exc:
+                    eprint(f"could not move back to {origin}: {exc}")
+                _report_cgroup(_cgroup_stats(leaf))
+        finally:
+            try:
+                leaf.rmdir()
+            except OSError as exc:
+                # a daemon some child started is still in it
+                eprint(f"leaving {leaf} in place: {exc}")
+    finally:
+        _release_cgroup_parent(enabled_at_root)
+
+
+_BUILD_IN_TMPFS = False
+# Object dir size assumed for a kver with no compiled dir to measure yet.
+_DEFAULT_BUILD_DIR_BYTES = 6 * 2**30
+
+
+def _tree_bytes(path: Path) -> int:
+    """Space a tree takes up, by allocated blocks rather than file sizes."""
+    total = 0
+    for dirpath, _dirnames, filenames in os.walk(path):
+        for name in filenames:
+            with contextlib.suppress(OSError):
+                total += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+    return total
+
+
+def _expected_build_dir_bytes(kver: str) -> int:
+    """How large kver's object dir will get: its own last build's size, else
+    the largest compiled dir under the build root, else a guess."""
+    own = _BUILD_ROOT / kver
+    if (own / "vmlinux").exists():
+        return _tree_bytes(own)
+    compiled = (
+        [d for d in _BUILD_ROOT.iterdir() if (d / "vmlinux").exists()]
+        if _BUILD_ROOT.is_dir()
+        else []
+    )
+    return max((_tree_bytes(d) for d in compiled), default=_DEFAULT_BUILD_DIR_BYTES)
+
+
+def _persist_build_dir(work: Path, build_dir: Path) -> None:
+    """Copy a tmpfs object dir over its build dir under the build root. The
+    old dir is only replaced once the copy is whole, so an interrupted copy
+    leaves the previous build, stamp included, as it was."""
+    eprint(f"persisting {work} -> {build_dir}")
+    build_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp = build_dir.with_name(f".{build_dir.name}.persist")
+    old = build_dir.with_name(f".{build_dir.name}.old")
+    for stale in (tmp, old):
+        shutil.rmtree(stale, ignore_errors=True)
+    subprocess.run(["cp", "-a", work.as_posix(), tmp.as_posix()], check=True)
+    if build_dir.exists():
+        build_dir.rename(old)
+    tmp.rename(build_dir)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def _tmpfs_build_dirs(
+    *,
+    enabled: bool,
+    kvers: list[str],
+    flag_sets: list[KernelFlags],
+    options: BuildOptions,
+):
+    """Run the body with _build_dir() pointing into a tmpfs holding a copy
+    of each kver's object dir, then copy them back, whether or not the body
+    succeeded. The body installs kernels, and /lib/modules/KVER/build of
+    each points into the build root: out-of-tree module rebuilds (zfs,
+    nvidia) need the objects of the kernel that was actually installed
+    there, even when a later build of the same run failed.
+
+    The tmpfs pages are memory the compile jobs cannot have, so the object
+    dirs' expected size plus one full job budget must fit in what is
+    available (below memory.high too: tmpfs pages are charged to the
+    cgroup that writes them). The mount's size= is only a cap; pages are
+    allocated as they are written, and MemAvailable falls with them, which
+    _job_budget sees later on.
+    """
+    global _BUILD_IN_TMPFS
+    if not enabled:
+        yield
+        return
+    expected = {kver: _expected_build_dir_bytes(kver) for kver in kvers}
+    needed = sum(expected.values())
+    jobs = options.jobs or os.cpu_count() or 1
+    jobs_bytes = (
+        jobs * max(_mb_per_job(flags) for flags in flag_sets)
+        + sum(_link_mb(flags) for flags in flag_sets)
+    ) * 2**20
+    available = _mem_available_mb() * 2**20
+    if options.memory_high is not None:
+        available = min(available, _parse_size(options.memory_high) or available)
+    if needed + jobs_bytes > available:
+        raise RuntimeError(
+            f"--tmpfs-build: object dirs need ~{needed // 2**20} MiB and {jobs} jobs "
+            f"~{jobs_bytes // 2**20} MiB, but only {available // 2**20} MiB is available"
+        )
+    if os.path.ismount(_TMPFS_BUILD_ROOT):
+        eprint(f"unmounting {_TMPFS_BUILD_ROOT} left by an earlier run")
+        subprocess.run(["umount", _TMPFS_BUILD_ROOT.as_posix()], check=True)
+    _TMPFS_BUILD_ROOT.mkdir(parents=True, exist_ok=True)
+    size = int(needed * 1.25)
+    subprocess.run(
+        [
+            "mount",
+            "-t",
+            "tmpfs",
+            "-o",
+            f"size={size},mode=0755",
+            "compile-kernel",
+            _TMPFS_BUILD_ROOT.as_posix(),
+        ],
+        check=True,
+    )
+    eprint(f"building in tmpfs {_TMPFS_BUILD_ROOT} ({size // 2**20} MiB)")
+    try:
+        for kver in kvers:
+            build_dir = _BUILD_ROOT / kver
+            if build_dir.is_dir():
+                subprocess.run(
+                    ["cp", "-a", build_dir.as_posix(), (_TMPFS_BUILD_ROOT / kver).as_posix()],
+                    check=True,
+                )
+        _BUILD_IN_TMPFS = True
+        try:
+            yield
+        finally:
+            _BUILD_IN_TMPFS = False
+            for kver in kvers:
+                if (_TMPFS_BUILD_ROOT / kver).is_dir():
+                    _persist_build_dir(_TMPFS_BUILD_ROOT / kver, _BUILD_ROOT / kver)
+    finally:
+        _BUILD_IN_TMPFS = False
+        subprocess.run(["umount", _TMPFS_BUILD_ROOT.as_posix()], check=True)
+
+
+# Not read by any build: the docs, and git's objects when the source is a clone.
+_PREWARM_SKIP = frozenset({".git", "Documentation"})
+# Enough reads in flight to keep a spinning disk's queue or a network
+# mount's round trips busy; the work is waiting, not CPU.
+_PREWARM_WORKERS = 16
+
+
+def _warm_file(path: str) -> int:
+    with contextlib.suppress(OSError), open(path, "rb", buffering=0) as f:
+        return sum(iter(lambda: len(f.read(2**20)), 0))
+    return 0
+
+
+def _prewarm_source(sources: list[Path]) -> None:
+    """Read the source trees into the page cache across _PREWARM_WORKERS
+    threads, so the compile's first pass over every header and .c does not
+    wait on the disk one file at a time. Skipped when the trees would take
+    more than half of available memory: they would only evict themselves."""
+    paths = []
+    total = 0
+    for source in sources:
+        for dirpath, dirnames, filenames in os.walk(source.resolve()):
+            dirnames[:] = [d for d in dirnames if d not in _PREWARM_SKIP]
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                with contextlib.suppress(OSError):
+                    st = os.lstat(path)
+                    if stat.S_ISREG(st.st_mode):
+                        paths.append(path)
+                        total += st.st_size
+    if total > _mem_available_mb() * 2**20 // 2:
+        eprint(f"prewarm: skipped, {total // 2**20} MiB of source is over half of available memory")
+        return
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=_PREWARM_WORKERS) as pool:
+        read = sum(pool.map(_warm_file, paths, chunksize=64))
+    eprint(
+        f"prewarm: read {len(paths)} files, {read // 2**20} MiB "
+        f"in {time.monotonic() - start:.1f}s"
+    )
+
+
+def _start_prewarm(sources: list[Path]) -> threading.Thread:
+    """_prewarm_source in the background, to overlap whatever runs before
+    the compiles; join it before they start."""
+    thread = threading.Thread(
+        target=_prewarm_source, args=(sources,), name="prewarm", daemon=True
+    )
+    thread.start()
+    return thread
+
+
+_INITRAMFS_MICROCODE_ARGS = ("--microcode=all", "--microcode-initramfs")
+
+
+def _install_genkernel(
+    *,
+    kver: str,
+    build_dir: Path,
+    variant: str | None,
+    options: BuildOptions,
+    jobs: int,
+) -> None:
+    """Install a kernel compiled by `make all` through genkernel, which
+    reruns the same make targets, finds them up to date, and installs the
+    kernel, its modules and the initramfs; the out-of-tree modules follow,
+    or come before the initramfs when it is assembled from the installed
+    modules."""
+    if _initramfs_needs_installed_modules(options):
+        # The module and firmware selection come from the installed modules,
+        # so the kernel and its modules, zfs included, have to exist before
+        # the initramfs is assembled: split `all` into its two halves with
+        # the zfs rebuild and the selection in between.
+        if _pending("genkernel_kernel"):
+            genkernel_command = _genkernel_command("kernel", build_dir=build_dir, variant=variant)
+            genkernel_command.bake("--symlink")
+            genkernel_command.bake(f"--makeopts={_makeopts(jobs)}")
+            icp(genkernel_command)
+            with _SYSTEM_LOCK, _phase("genkernel_kernel"):
+                genkernel_command(**_hs_output(_fg=True), _env=_make_env(build_dir))
+        if _pending("zfs_module_rebuild"):
+            with _SYSTEM_LOCK, _phase("zfs_module_rebuild"):
+                _emerge_zfs_module_rebuild(build_dir=build_dir, kver=kver)
+        if _pending("postprocess_kernel_modules"):
+            with _phase("postprocess_kernel_modules"):
+                _postprocess_modules(kver=kver, build_dir=build_dir, options=options)
+        if _pending("genkernel_initramfs"):
+            genkernel_command = _genkernel_command("initramfs", build_dir=build_dir, variant=variant)
+            genkernel_command.bake("--symlink")
+            with _phase("initramfs_selection"):
+                genkernel_command.bake(
+                    *_INITRAMFS_MICROCODE_ARGS,
+                    *_initramfs_module_args(kver, build_dir, options),
+                    *_firmware_args(kver, options),
+                )
+            icp(genkernel_command)
+            with _SYSTEM_LOCK, _phase("genkernel_initramfs"):
+                genkernel_command(**_hs_output(_fg=True), _env=_make_env(build_dir))
+        return
+
+    if _pending("genkernel"):
+        genkernel_command = _genkernel_command("all", build_dir=build_dir, variant=variant)
+        genkernel_command.bake("--symlink")
+        genkernel_command.bake(*_INITRAMFS_MICROCODE_ARGS, "--all-ramdisk-modules", "--firmware")
+        genkernel_command.bake(f"--makeopts={_makeopts(jobs)}")
+        icp(genkernel_command)
+        # genkernel `all` installs the modules and the initramfs in the same
+        # run as the /boot symlinks; only the split path holds the lock less
+        with _SYSTEM_LOCK, _phase("genkernel"):
+            genkernel_command(**_hs_output(_fg=True), _env=_make_env(build_dir))
+
+    if _pending("zfs_module_rebuild"):
+        with _SYSTEM_LOCK, _phase("zfs_module_rebuild"):
+            _emerge_zfs_module_rebuild(build_dir=build_dir, kver=kver)
+    if _pending("postprocess_modules"):
+        with _phase("postprocess_modules"):
+            _postprocess_modules(kver=kver, build_dir=build_dir, options=options)
+
+
+def _install_direct(
+    *,
+    kver: str,
+    build_dir: Path,
+    variant: str | None,
+    options: BuildOptions,
+    restored: Path | None = None,
+) -> None:
+    """Install a kernel compiled by `make bzImage modules` without genkernel's
+    kernel half: Kbuild's own modules_install and install, the out-of-tree
+    modules, then genkernel for the initramfs alone. With `restored`, the
+    kernel came from that artifact cache entry, and so do its modules.
+
+    The zfs rebuild runs before the initramfs here, so the initramfs packs
+    the zfs.ko just built for this kernel rather than whatever was installed
+    when genkernel ran.
+    """
+    if _pending("modules_install"):
+        with _phase("modules_install"):
+            if restored is not None:
+                _restore_modules(entry=restored, kver=kver)
+            else:
+                _make("modules_install", build_dir=build_dir)
+    if _pending("install"):
+        # installkernel rewrites the /boot symlinks
+        with _SYSTEM_LOCK, _phase("install"):
+            _make("install", build_dir=build_dir)
+    if _pending("zfs_module_rebuild"):
+        with _SYSTEM_LOCK, _phase("zfs_module_rebuild"):
+            _emerge_zfs_module_rebuild(build_dir=build_dir, kver=kver)
+    if _pending("postprocess_modules"):
+        with _phase("postprocess_modules"):
+            _postprocess_modules(kver=kver, build_dir=build_dir, options=options)
+
+    if not _pending("genkernel_initramfs"):
+        return
+    genkernel_command = _genkernel_command("initramfs", build_dir=build_dir, variant=variant)
+    genkernel_command.bake("--symlink", *_INITRAMFS_MICROCODE_ARGS)
+    if _initramfs_needs_installed_modules(options):
+        with _phase("initramfs_selection"):
+            genkernel_command.bake(
+                *_initramfs_module_args(kver, build_dir, options),
+                *_firmware_args(kver, options),
+            )
+    else:
+        genkernel_command.bake("--all-ramdisk-modules", "--firmware")
+    icp(genkernel_command)
+    with _SYSTEM_LOCK, _phase("genkernel_initramfs"):
+        genkernel_command(**_hs_output(_fg=True), _env=_make_env(build_dir))
+
+
+@dataclass
+class _Step:
+    """One node of the post-configure work graph: `run` starts once every
+    step named in `after` has finished, timed into `record` and
+    checkpointed into `journal`."""
+
+    name: str
+    run: Callable[[], object]
+    after: tuple[str, ...] = ()
+    record: _BuildRecord | None = None
+    journal: _Journal | None = None
+
+
+def _critical_path(
+    steps: dict[str, _Step], started: dict[str, float], finished: dict[str, float]
+) -> list[str]:
+    """The chain of steps that decided the total time: from the last step to
+    finish, back through whichever of its predecessors finished last."""
+    name = max(finished, key=finished.__getitem__)
+    path = [name]
+    while steps[name].after:
+        name = max(steps[name].after, key=finished.__getitem__)
+        path.append(name)
+    return path[::-1]
+
+
+def _run_steps(steps: list[_Step]) -> dict[str, object]:
+    """Run every step as soon as its predecessors are done, then print the
+    critical path. Returns each step's result by name.
+
+    On a failure no further steps start; the ones already running finish,
+    then the first failure is raised.
+    """
+    by_name = {step.name: step for step in steps}
+    for step in steps:
+        unknown = set(step.after) - by_name.keys()
+        if unknown:
+            raise ValueError(f"step {step.name!r} comes after unknown steps {sorted(unknown)}")
+    started: dict[str, float] = {}
+    finished: dict[str, float] = {}
+    results: dict[str, object] = {}
+
+    def _run(step: _Step) -> object:
+        started[step.name] = time.monotonic()
+        try:
+            with _recording(step.record), _journaling(step.journal):
+                return step.run()
+        except BaseException as exc:
+            # a step can fail between its phases; the build failed all the same
+            if step.record is not None:
+                step.record.status = step.record.status or _exit_status(exc)
+            raise
+        finally:
+            finished[step.name] = time.monotonic()
+
+    pending = list(steps)
+    running = {}
+    failure: BaseException | None = None
+    with ThreadPoolExecutor(max_workers=len(steps)) as pool:
+        while pending or running:
+            if failure is None:
+                ready = [s for s in pending if all(d in results for d in s.after)]
+                for step in ready:
+                    pending.remove(step)
+                    running[pool.submit(_run, step)] = step
+                if not running:
+                    raise ValueError(f"steps wait on each other: {[s.name for s in pending]}")
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                try:
+                    results[step.name] = future.result()
+                except BaseException as exc:
+                    failure = failure or exc
+    if failure is not None:
+        raise failure
+
+    path = _critical_path(by_name, started, finished)
+    total = finished[path[-1]] - min(started.values())
+    eprint(f"critical path ({_format_seconds(total)}):")
+    for name in path:
+        eprint(f"  {_format_seconds(finished[name] - started[name]):>8}  {name}")
+    return results
+
+
+def _compile_one(
+    *,
+    build: KernelBuild,
+    build_dir: Path,
+    kver: str,
+    pre_module_rebuild: bool,
+    options: BuildOptions,
+    jobs: int,
+    seed_dir: Path | None = None,
+) -> None:
+    """Compile one configured kernel into its object dir, first replaced by
+    the clone of seed_dir staged for it when the build plan seeds it from
+    there.
+
+    Every artifact is keyed by kver — the object dir, /boot files,
+    /lib/modules tree, initramfs, flags, cmdline, snapshots, grub entry — so
+    two variants of one source share nothing they could contend for, and
+    their compiles run concurrently. What is shared system-wide (emerges,
+    /boot, cfg-layer) runs under _SYSTEM_LOCK.
+
+    A build whose stamp shows nothing changed since its last success is not
+    compiled, and its stamp is left for _install_one to find.
+    """
+    flags = build.flags
+    if not options.force_rebuild:
+        with _phase("stamp_check"):
+            inputs = _build_inputs(build_dir=build_dir, flags=flags, options=options)
+            reason = _unchanged_since_last_build(build_dir=build_dir, kver=kver, inputs=inputs)
+        if reason is not None:
+            eprint(f"=== skipping {kver}: {reason} ===")
+            shutil.rmtree(_seed_path(build_dir), ignore_errors=True)
+            return
+    # a build that stops part way must not leave the previous stamp vouching
+    # for what it half-replaced
+    _build_stamp_path(build_dir).unlink(missing_ok=True)
+    if seed_dir is not None and _pending("seed"):
+        with _phase("seed"):
+            _reseed_build_dir(build_dir)
+    shutil.rmtree(_seed_path(build_dir), ignore_errors=True)
+
+    parallelism = "the shared jobserver" if _JOBSERVER is not None else f"-j{jobs}"
+    eprint(f"=== building {kver} flags={flags.labels()} with {parallelism} ===")
+    if _CCACHE:
+        # per-build stats: start this build's log afresh
+        (build_dir / "ccache-stats.log").unlink(missing_ok=True)
+    if _CC_TIMING:
+        (build_dir / _CC_TIMING_LOG).unlink(missing_ok=True)
+
+    # Prepare before any emerge: an unprepared tree is the only reason the zfs
+    # emerge below could fail for a reason that is not a real error, so doing
+    # this first means every failure past this point is worth crashing on.
+    if _pending("modules_prepare"):
+        with _phase("modules_prepare"):
+            _make("modules_prepare", build_dir=build_dir)
+    _link_module_build_dir(kver, build_dir)
+
+    with _SYSTEM_LOCK:
+        env = _emerge_env(build_dir)
+        if _pending("zfs_emerge"):
+            icp("upgrading sys-fs/zfs before genkernel's own external-module step")
+            with _phase("zfs_emerge"):
+                hs.Command("emerge")(
+                    "sys-fs/zfs", "-u", _env=env, **_hs_output(_out=sys.stdout, _err=sys.stderr)
+                )
+
+        if pre_module_rebuild and _pending("pre_module_rebuild"):
+            with _phase("pre_module_rebuild"):
+                _emerge_zfs_module_rebuild(build_dir=build_dir, kver=kver)
+
+    with _phase("gcc_check"):
+        gcc_check(build_dir=build_dir)
+
+    (build_dir / _RESTORED_MARKER).unlink(missing_ok=True)
+    if not _pending("compile"):
+        return
+    key = _artifact_key(build_dir) if options.artifact_cache else None
+    entry = _cached_artifacts(key) if key is not None else None
+    if entry is not None:
+        eprint(f"=== {kver}: restoring cached artifacts {key[:12]} instead of compiling ===")
+        with _phase("restore_artifacts"):
+            _restore_build_artifacts(entry=entry, build_dir=build_dir)
+        return
+
+    # The compile proper, outside the lock; install and initramfs work that
+    # must be serialised is left to _install_one.
+    with _phase("compile"):
+        if options.direct_kbuild:
+            _make(*_jobs_args(jobs), "bzImage", "modules", build_dir=build_dir)
+        else:
+            _make(*_jobs_args(jobs), "all", build_dir=build_dir)
+    if options.cc_timing:
+        with _phase("heatmap"):
+            _write_heatmap(kver=kver, build_dir=build_dir, flags=flags)
+            record = getattr(_THREAD, "record", None)
+            times = _read_cc_times(build_dir)
+            if record is not None and times:
+                record.job_rss_kb = int(statistics.mean(rss for _obj, _wall, rss in times))
+    # refreshed while the .cmd files are warm in the page cache, so the
+    # first `impact` query does not pay for reading them all
+    with _phase("impact_index"):
+        _impact_index(build_dir)
+    if key is not None:
+        with _phase("store_artifacts"):
+            _store_artifacts(key=key, build_dir=build_dir, kver=kver)
+
+
+def _install_one(
+    *,
+    build: KernelBuild,
+    build_dir: Path,
+    kver: str,
+    options: BuildOptions,
+    jobs: int,
+) -> str:
+    """Install what _compile_one built. Returns its kver.
+
+    A surviving build stamp means _compile_one found nothing changed: the
+    installed artifacts were already checked, so only the flags are
+    recorded again, and grub is left to the caller as for any other build.
+    """
+    flags = build.flags
+    if _build_stamp_path(build_dir).exists():
+        with _SYSTEM_LOCK:
+            _link_module_build_dir(kver, build_dir)
+            _record_build(kver, flags)
+        return kver
+
+    # Only what touches shared state holds _SYSTEM_LOCK: /boot and its
+    # symlinks, emerges and cfg-layer, genkernel. modules_install, depmod,
+    # the module postprocessing and the initramfs selection work in this
+    # kver's own /lib/modules tree, so they overlap other builds' compiles.
+
+    # resuming must not snapshot this build's own half-installed files
+    if _pending("snapshot"):
+        with _SYSTEM_LOCK, _phase("snapshot"):
+            _snapshot_existing_kernel_files(kver)
+
+    if _pending("nvidia_preflight"):
+        with _SYSTEM_LOCK, _phase("nvidia_preflight"):
+            _ensure_nvidia_or_fallback(build_dir=build_dir, kver=kver)
+    # modules_install copies into existing files; see
+    # _break_module_hardlinks
+    _break_module_hardlinks(kver)
+    restored = _restored_entry(build_dir)
+    if restored is not None or options.direct_kbuild:
+        # a restored build dir has the image but no objects for
+        # genkernel's make to find up to date
+        _install_direct(
+            kver=kver,
+            build_dir=build_dir,
+            variant=build.variant,
+            options=options,
+            restored=restored,
+        )
+    else:
+        _install_genkernel(
+            kver=kver, build_dir=build_dir, variant=build.variant, options=options, jobs=jobs
+        )
+
+    with _phase("verify"):
+        if _kernelrelease(build_dir) != kver:
+            raise RuntimeError(f"kernel.release changed during build of {kver}")
+        if not boot_is_correct(kver=kver):
+            raise RuntimeError(f"/boot is missing artifacts for {kver} after install")
+    with _SYSTEM_LOCK:
+        _link_module_build_dir(kver, build_dir)
+        _record_build(kver, flags)
+    # inputs again: the zfs emerge above may have moved a module version
+    _write_build_stamp(
+        build_dir, _build_inputs(build_dir=build_dir, flags=flags, options=options)
+    )
+    eprint(f"=== finished {kver} ===")
+    return kver
+
+
+def _register_zfs_services() -> None:
+    with _SYSTEM_LOCK, _phase("rc_update"):
+        hs.Command("rc-update")("add", "zfs-import", "boot")
+        hs.Command("rc-update")("add", "zfs-share", "default")
+        hs.Command("rc-update")("add", "zfs-zed", "default")
+
+
+def _update_linux_firmware() -> None:
+    # an emerge, so never alongside the builds' own
+    with _SYSTEM_LOCK, _phase("linux_firmware"):
+        hs.Command("emerge")(
+            "sys-kernel/linux-firmware", "-u", **_hs_output(_out=sys.stdout, _err=sys.stderr)
+        )
+
+
+def _dedupe_all_module_trees() -> None:
+    with _SYSTEM_LOCK, _phase("dedupe_modules"):
+        dedupe_module_trees()
+
+
+def _regenerate_grub_step(default_kver: str) -> None:
+    with _SYSTEM_LOCK, _phase("grub"):
+        _regenerate_grub(default_kver=default_kver)
+
+
+def _has_objects(build_dir: Path) -> bool:
+    # auto.conf is what the objects were last built against; .config may
+    # already be newer
+    return (build_dir / "include" / "config" / "auto.conf").exists() and (
+        build_dir / "vmlinux.o"
+    ).exists()
+
+
+def _plan_seeds(
+    configured: list[tuple[KernelBuild, Path, str]], options: BuildOptions
+) -> dict[str, str | None]:
+    """For each kver, the kver of this run whose build dir it should be
+    seeded from once that one has compiled, or None to build in its own.
+
+    Each build can compile on top of its own objects, costing the objects
+    its config change since they were built touches, or on a clone of
+    another build's, costing the objects the two configs' difference
+    touches, estimated with the seeding build's impact index, or any other
+    build's. A build with nothing to go on costs every object. The cheapest
+    seeding tree is grown from the root Prim-style, which is exact for
+    symmetric costs, and these nearly are.
+    """
+    kvers = [kver for _build, _build_dir, kver in configured]
+    build_dirs = {kver: build_dir for _build, build_dir, kver in configured}
+    # objects of one source are no use to a build of another
+    sources = {kver: build.source.resolve() for build, _build_dir, kver in configured}
+    indexes = {
+        kver: _impact_index(build_dirs[kver]) for kver in kvers if _has_objects(build_dirs[kver])
+    }
+    if not indexes:
+        icp("no build dir has objects to estimate from; building in list order")
+        return {kver: None for kver in kvers}
+    reference = max(indexes.values(), key=lambda index: len(_indexed_objects(index)))
+    full = len(_indexed_objects(reference))
+
+    def _own_cost(kver: str) -> int:
+        build_dir = build_dirs[kver]
+        if options.artifact_cache and _cached_artifacts(_artifact_key(build_dir)) is not None:
+            return 0
+        if kver not in indexes:
+            return full
+        auto_conf = build_dir / "include" / "config" / "auto.conf"
+        changed = _changed_symbols(auto_conf, build_dir / ".config")
+        return len(_affected_objects(indexes[kver], changed))
+
+    def _seed_cost(seed: str, kver: str) -> int:
+        changed = _changed_symbols(build_dirs[seed] / ".config", build_dirs[kver] / ".config")
+        return len(_affected_objects(indexes.get(seed, reference), changed))
+
+    own = {kver: _own_cost(kver) for kver in kvers}
+    seeds: dict[str, str | None] = {}
+    costs: dict[str, int] = {}
+    while len(seeds) < len(kvers):
+        candidates = [(own[kver], kvers.index(kver), kver, None) for kver in kvers if kver not in seeds]
+        candidates += [
+            (_seed_cost(seed, kver), kvers.index(kver), kver, seed)
+            for kver in kvers
+            if kver not in seeds
+            for seed in seeds
+            if sources[seed] == sources[kver]
+        ]
+        cost, _position, kver, seed = min(candidates)
+        seeds[kver] = seed
+        costs[kver] = cost
+
+    eprint(f"build plan: ~{sum(costs.values()):,} objects to compile, against ~{sum(own.values()):,} unseeded")
+    for kver in kvers:
+        source = f"seeded from {seeds[kver]}" if seeds[kver] else "in its own build dir"
+        eprint(f"  {kver}: {source}, ~{costs[kver]:,} objects")
+    return {kver: seeds[kver] for kver in kvers}
+
+
+def _seed_path(build_dir: Path) -> Path:
+    """Where build_dir's seed clone waits until its compile swaps it in."""
+    return build_dir.with_name(f".{build_dir.name}.seed")
+
+
+def _stage_seed(source: Path, build_dir: Path) -> None:
+    """Clone source's objects for build_dir to be seeded from. Runs at the
+    end of source's compile step, before its install starts writing into
+    source (genkernel, modules_install, the stamp and artifact store)."""
+    seeded = _seed_path(build_dir)
+    shutil.rmtree(seeded, ignore_errors=True)
+    _clone_build_dir(source, seeded)
+
+
+def _compile_and_stage_seeds(*, seeded: tuple[Path, ...], **compile_args) -> None:
+    """_compile_one, then stage a clone of the result for every build dir
+    the build plan seeds from it."""
+    _compile_one(**compile_args)
+    if seeded:
+        with _phase("stage_seeds"):
+            for build_dir in seeded:
+                _stage_seed(compile_args["build_dir"], build_dir)
+
+
+def _reseed_build_dir(build_dir: Path) -> None:
+    """Replace build_dir's objects with its staged seed clone, keeping its
+    own resolved .config and journal. Kbuild then recompiles only what the
+    configs' difference touches."""
+    seeded = _seed_path(build_dir)
+    if not seeded.is_dir():
+        raise RuntimeError(f"no staged seed for {build_dir} at {seeded}")
+    keep = {
+        name: (build_dir / name).read_bytes()
+        for name in (".config", _journal_path(build_dir).name)
+        if (build_dir / name).exists()
+    }
+    for name, content in keep.items():
+        (seeded / name).write_bytes(content)
+    old = build_dir.with_name(f".{build_dir.name}.old")
+    shutil.rmtree(old, ignore_errors=True)
+    build_dir.rename(old)
+    seeded.rename(build_dir)
+    shutil.rmtree(old)
+
+
+def _install_steps(
+    *,
+    configured: list[tuple[KernelBuild, Path, str]],
+    records: list[_BuildRecord],
+    journals: list[_Journal],
+    pre_module_rebuild: bool,
+    options: BuildOptions,
+    jobs: int,
+    seeds: dict[str, str | None],
+) -> list[_Step]:
+    """The work after configure, as a graph rather than a sequence.
+
+    Each build is a compile step and an install step. Compiles run
+    concurrently (one after another with serial_builds, though each install
+    still overlaps the next compile), except that a build seeded from
+    another compiles after it, from a clone the seed's compile step takes
+    before the seed's install can touch its object dir. The linux-firmware update and the zfs
+    service registrations depend on no kernel, so they start at once; every
+    install waits for the firmware, which its initramfs packs. Module dedupe
+    and grub wait for every install. The shared steps are timed into the boot
+    default's record.
+    """
+    steps = [
+        _Step("rc-update zfs services", _register_zfs_services, record=records[0]),
+        _Step("emerge linux-firmware", _update_linux_firmware, record=records[0]),
+    ]
+    build_dirs = {kver: build_dir for _build, build_dir, kver in configured}
+    # seeds before the builds seeded from them, otherwise in builds order
+    order: list[str] = []
+    while len(order) < len(configured):
+        order.extend(
+            kver
+            for _build, _build_dir, kver in configured
+            if kver not in order and (seeds[kver] is None or seeds[kver] in order)
+        )
+    position = {kver: order.index(kver) for kver in order}
+
+    installs = []
+    for (build, build_dir, kver), record, journal in zip(configured, records, journals):
+        compile_step = f"compile {kver}"
+        after = []
+        if options.serial_builds and position[kver] > 0:
+            after.append(f"compile {order[position[kver] - 1]}")
+        seed = seeds[kver]
+        if seed is not None and f"compile {seed}" not in after:
+            after.append(f"compile {seed}")
+        steps.append(
+            _Step(
+                compile_step,
+                partial(
+                    _compile_and_stage_seeds,
+                    seeded=tuple(
+                        build_dirs[other] for other, other_seed in seeds.items() if other_seed == kver
+                    ),
+                    build=build,
+                    build_dir=build_dir,
+                    kver=kver,
+                    pre_module_rebuild=pre_module_rebuild,
+                    options=options,
+                    jobs=jobs,
+                    seed_dir=build_dirs[seed] if seed is not None else None,
+                ),
+                after=tuple(after),
+                record=record,
+                journal=journal,
+            )
+        )
+        install_step = f"install {kver}"
+        steps.append(
+            _Step(
+                install_step,
+                partial(
+                    _install_one,
+                    build=build,
+                    build_dir=build_dir,
+                    kver=kver,
+                    options=options,
+                    jobs=jobs,
+                ),
+                after=(compile_step, "emerge linux-firmware"),
+                record=record,
+                journal=journal,
+            )
+        )
+        installs.append(install_step)
+
+    if options.dedupe_modules:
+        steps.append(
+            _Step("dedupe modules", _dedupe_all_module_trees, after=tuple(installs), record=records[0])
+        )
+    # grub is regenerated once for all builds, with builds[0] as the default
+    steps.append(
+        _Step(
+            "grub",
+            partial(_regenerate_grub_step, configured[0][2]),
+            after=tuple(installs),
+            record=records[0],
+        )
+    )
+    return steps
+
+
+def compile_and_install_kernel(
+    *,
+    builds: list[KernelBuild],
+    configure: bool,
+    fix: bool,
+    warn_only: bool,
+    no_check_boot: bool,
+    pre_module_rebuild: bool,
+    options: BuildOptions = BuildOptions(),
+):
+    """Build every kernel in `builds`, then regenerate grub once.
+
+    builds[0] is the boot default and gets GRUB_TOP_LEVEL. That is load-bearing
     whenever a variant is present: grub-mkconfig picks its top-level entry with
     sort -V, which ranks vmlinuz-…-x86_64-debug above vmlinuz-…-x86_64, so the
     instrumented kernel would otherwise become the default.
@@ -5687,51 +9309,631 @@ def compile_and_install_kernel(
     icp()
     if not builds:
         raise ValueError("no builds requested")
-    variants = [b.variant for b in builds]
+    # builds of different sources may share a variant: their kvers differ
+    variants = [(b.source.resolve(), b.variant) for b in builds]
     if len(set(variants)) != len(variants):
-        raise ValueError(f"duplicate variants in builds: {variants}")
+        raise ValueError(f"duplicate variants of one source in builds: {variants}")
+    sources = list(dict.fromkeys(b.source for b in builds))
     for build in builds:
         _desired_localversion(build.variant)
 
     if not root_user():
         raise ValueError("you must be root")
 
-    _ensure_pristine_source()
+    with _build_cgroup(options) as cgroup, _phase_logging(options.phase_logs):
+        for source in sources:
+            _ensure_pristine_source(source)
 
-    if no_check_boot:
-        icp("skipped checking if /boot was mounted")
-    else:
-        if not Path("/boot/grub/grub.cfg").exists():
-            raise ValueError("/boot/grub/grub.cfg not found")
-        if not Path("/boot/kernel").exists():
-            raise ValueError("mount /boot first")
+        if no_check_boot:
+            icp("skipped checking if /boot was mounted")
+        else:
+            if not Path("/boot/grub/grub.cfg").exists():
+                raise ValueError("/boot/grub/grub.cfg not found")
+            if not Path("/boot/kernel").exists():
+                raise ValueError("mount /boot first")
 
-    _verify_portage_bashrc()
+        _verify_portage_bashrc()
 
-    hs.Command("emerge")("genkernel", "-u", _out=sys.stdout, _err=sys.stderr)
+        with _SYSTEM_LOCK:
+            hs.Command("emerge")("genkernel", "-u", **_hs_output(_out=sys.stdout, _err=sys.stderr))
 
-    kvers = [
-        _build_one(
-            build=build,
-            fix=fix,
-            warn_only=warn_only,
-            interactive_configure=configure and index == 0,
-            pre_module_rebuild=pre_module_rebuild,
+        concurrent = 1 if options.serial_builds else len(builds)
+        records = [
+            _BuildRecord(
+                kver=_kver_for_variant(b.variant, b.source), flags=b.flags, concurrent=concurrent
+            )
+            for b in builds
+        ]
+        kvers = [record.kver for record in records]
+        if len(set(kvers)) != len(kvers):
+            raise ValueError(f"builds would share a kver, and so a build dir: {kvers}")
+        try:
+            prewarm = _start_prewarm(sources) if options.prewarm_source else None
+            with (
+                _writing_build_dirs(kvers),
+                _tmpfs_build_dirs(
+                    enabled=options.tmpfs_build,
+                    kvers=kvers,
+                    flag_sets=[b.flags for b in builds],
+                    options=options,
+                ),
+            ):
+                # Configure one build at a time: nconfig needs the terminal, and the
+                # spec layers track applied symbols in a module global.
+                configured: list[tuple[KernelBuild, Path, str]] = []
+                journals: list[_Journal] = []
+                for index, build in enumerate(builds):
+                    kver = records[index].kver
+                    journal = (
+                        _Journal.resume(kver=kver, build_dir=_build_dir(kver), flags=build.flags)
+                        if options.resume
+                        else None
+                    )
+                    if journal is not None and journal.done("configure"):
+                        eprint(f"=== resuming {kver}: {', '.join(journal.completed)} already done ===")
+                        build_dir = _build_dir(kver)
+                    else:
+                        eprint(
+                            f"=== configuring {build.source} variant={build.variant!r} "
+                            f"flags={build.flags.labels()} ==="
+                        )
+                        with _recording(records[index]), _phase("configure"):
+                            build_dir = configure_kernel(
+                                fix=fix,
+                                warn_only=warn_only,
+                                interactive=configure and index == 0,
+                                flags=build.flags,
+                                variant=build.variant,
+                                clone_closest=options.clone_build_dir,
+                                source=build.source,
+                            )
+                        journal = _Journal.start(kver=kver, build_dir=build_dir, flags=build.flags)
+                        journal.complete("configure")
+                    configured.append((build, build_dir, _kernelrelease(build_dir)))
+                    journals.append(journal)
+
+                if prewarm is not None:
+                    prewarm.join()
+                budget = _job_budget(options, [b.flags for b in builds])
+                jobs = _build_jobs(budget, concurrent)
+                jobserver = (
+                    _jobserver(budget)
+                    if options.jobserver or os.environ.get(_SHARED_JOBSERVER_ENV)
+                    else contextlib.nullcontext()
+                )
+                seeds = (
+                    _plan_seeds(configured, options)
+                    if options.schedule_builds and len(configured) > 1
+                    else {kver: None for _build, _build_dir, kver in configured}
+                )
+                steps = _install_steps(
+                    configured=configured,
+                    records=records,
+                    journals=journals,
+                    pre_module_rebuild=pre_module_rebuild,
+                    options=options,
+                    jobs=jobs,
+                    seeds=seeds,
+                )
+                with (
+                    _ccache(options.ccache),
+                    _cc_timing(options.cc_timing),
+                    jobserver,
+                    _memory_governor(options.adaptive_jobs),
+                ):
+                    # a failure surfaces once the steps still running have finished
+                    _run_steps(steps)
+                # done: the build stamps speak for these builds from here on
+                for journal in journals:
+                    journal.finish()
+                # in builds order, so kvers[0] stays the boot default
+                kvers = [kver for _build, _build_dir, kver in configured]
+                # read while a tmpfs build dir still holds the stats log
+                if options.ccache:
+                    for _build, build_dir, kver in configured:
+                        stats = _ccache_stats(build_dir)
+                        if stats is None:
+                            continue
+                        hits, misses = stats
+                        rate = 100 * hits / (hits + misses) if hits + misses else 0.0
+                        eprint(f"ccache {kver}: {hits} hits, {misses} misses ({rate:.1f}% hit rate)")
+        finally:
+            if cgroup is not None:
+                # one cgroup for the whole run: every build shares its totals
+                stats = _cgroup_stats(cgroup)
+                for record in records:
+                    record.cgroup = stats
+            _append_history(records)
+
+    for kver in kvers:
+        eprint(f"installed kernel: {kver}")
+    eprint(f"boot default: {kvers[0]}")
+    icp("kernel compile and install completed OK")
+
+
+SERVE_SOCKET = Path("/run/compile-kernel/serve.sock")
+
+
+def _kernel_build_json(build: KernelBuild) -> dict:
+    return {
+        "flags": asdict(build.flags),
+        "variant": build.variant,
+        "source": build.source.as_posix(),
+    }
+
+
+def _kernel_build_from_json(data: dict) -> KernelBuild:
+    return KernelBuild(
+        flags=KernelFlags(**data.get("flags", {})),
+        variant=data.get("variant"),
+        source=Path(data.get("source", _SOURCE_DIR)),
+    )
+
+
+@dataclass
+class _QueuedRequest:
+    """One request waiting for, or in, a batch, with the event queues of
+    every client that asked for it."""
+
+    id: int
+    # "build": compile and install; "install": install an existing build dir
+    action: str
+    builds: list[KernelBuild]
+    options: BuildOptions
+    # compile_and_install_kernel's fix, no_check_boot and pre_module_rebuild
+    params: dict
+    # canonical JSON of everything above but id: equal keys are duplicates
+    key: str
+    # the kvers, so build dirs, it writes: requests sharing one never overlap
+    kvers: frozenset[str] = frozenset()
+    subscribers: list[queue.Queue] = field(default_factory=list)
+
+    def describe(self) -> str:
+        kinds = ", ".join(f"{b.source}:{b.variant or 'plain'}" for b in self.builds)
+        return f"#{self.id} {self.action} {kinds}"
+
+
+def _take_batch(
+    pending: list[_QueuedRequest], *, busy_kvers: set[str], tmpfs_busy: bool
+) -> list[_QueuedRequest]:
+    """The requests to start next, removed from `pending`; empty when
+    none can start beside the batches already running.
+
+    A request waits while a running batch, or an earlier pending request,
+    has a kver of its own: it never overtakes one queued before it for the
+    same build dir. Only one --tmpfs-build batch runs at a time, as they
+    share the one mount. The first request that can start heads the batch.
+    An install runs alone. A build takes every later build request that
+    can share its compile_and_install_kernel call: same options and
+    parameters, and no (source, variant) it already has with other flags
+    (sources arrive resolved from _parse_request).
+    """
+    blocked = set(busy_kvers)
+    batch: list[_QueuedRequest] = []
+    claimed: dict[tuple[Path, str | None], KernelFlags] = {}
+    for request in list(pending):
+        if request.kvers & blocked:
+            blocked |= request.kvers
+            continue
+        wanted = {(b.source, b.variant): b.flags for b in request.builds}
+        if not batch:
+            startable = not (tmpfs_busy and request.options.tmpfs_build)
+        else:
+            head = batch[0]
+            startable = (
+                request.action == "build"
+                and request.options == head.options
+                and request.params == head.params
+                and all(claimed.get(slot, flags) == flags for slot, flags in wanted.items())
+            )
+        if not startable:
+            blocked |= request.kvers
+            continue
+        claimed.update(wanted)
+        batch.append(request)
+        pending.remove(request)
+        if request.action != "build":
+            break
+    return batch
+
+
+class _BuildQueue:
+    """Requests from every client, oldest first, run as batches side by side.
+
+    One batch is one compile_and_install_kernel call, in a worker process
+    of its own (_run_batch), which compiles its builds in parallel; batches
+    whose build dirs differ run at the same time. Every worker's makes draw
+    from the daemon's one jobserver, and the emerges, /boot and grub steps
+    of all of them go one at a time under _SYSTEM_LOCK, which holds across
+    processes. Each batch regenerates grub for its own boot default, so the
+    last to finish sets it.
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._pending: list[_QueuedRequest] = []
+        self._running: list[list[_QueuedRequest]] = []
+        self._next_id = 1
+
+    def submit(
+        self,
+        *,
+        action: str,
+        builds: list[KernelBuild],
+        options: BuildOptions,
+        params: dict,
+    ) -> tuple[_QueuedRequest, bool, queue.Queue]:
+        """Queue a request, or subscribe to an identical pending one; returns
+        it, whether it was merged, and the queue its events arrive on."""
+        key = json.dumps(
+            {
+                "action": action,
+                "builds": [_kernel_build_json(b) for b in builds],
+                "options": asdict(options),
+                "params": params,
+            },
+            sort_keys=True,
         )
-        for index, build in enumerate(builds)
-    ]
+        kvers = frozenset(_kver_for_variant(b.variant, b.source) for b in builds)
+        events: queue.Queue = queue.Queue()
+        with self._cond:
+            for request in self._pending:
+                if request.key == key:
+                    request.subscribers.append(events)
+                    return request, True, events
+            request = _QueuedRequest(
+                id=self._next_id,
+                action=action,
+                builds=builds,
+                options=options,
+                params=params,
+                key=key,
+                kvers=kvers,
+                subscribers=[events],
+            )
+            self._next_id += 1
+            self._pending.append(request)
+            self._cond.notify()
+            return request, False, events
+
+    def unsubscribe(self, request: _QueuedRequest, events: queue.Queue) -> None:
+        """Stop sending to a client that went away. The request still runs:
+        another client, or nobody, may be waiting on the kernel."""
+        with self._cond:
+            if events in request.subscribers:
+                request.subscribers.remove(events)
+
+    def position(self, request: _QueuedRequest) -> int:
+        with self._cond:
+            return self._pending.index(request) + 1 if request in self._pending else 0
+
+    def next_batch(self) -> list[_QueuedRequest]:
+        """Wait for a batch that can start beside the running ones, and
+        count it as running until finish()."""
+        with self._cond:
+            while True:
+                running = [request for batch in self._running for request in batch]
+                batch = _take_batch(
+                    self._pending,
+                    busy_kvers={kver for request in running for kver in request.kvers},
+                    tmpfs_busy=any(request.options.tmpfs_build for request in running),
+                )
+                if batch:
+                    self._running.append(batch)
+                    return batch
+                self._cond.wait()
+
+    def finish(self, batch: list[_QueuedRequest]) -> None:
+        with self._cond:
+            self._running = [running for running in self._running if running is not batch]
+            self._cond.notify_all()
+
+    def broadcast(self, batch: list[_QueuedRequest], event: dict) -> None:
+        with self._cond:
+            subscribers = [events for request in batch for events in request.subscribers]
+        for events in subscribers:
+            events.put(event)
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            return {
+                "running": [
+                    request.describe() for running in self._running for request in running
+                ],
+                "pending": [request.describe() for request in self._pending],
+            }
 
-    hs.Command("rc-update")("add", "zfs-import", "boot")
-    hs.Command("rc-update")("add", "zfs-share", "default")
-    hs.Command("rc-update")("add", "zfs-zed", "default")
 
-    hs.Command("emerge")(
-        "sys-kernel/linux-firmware", "-u", _out=sys.stdout, _err=sys.stderr
+# Starts the line a batch worker reports its failure on; the daemon passes
+# the rest on as the batch's error.
+_WORKER_ERROR = "compile-kernel worker failed: "
+
+
+def _batch_payload(batch: list[_QueuedRequest]) -> str:
+    """The batch as _serve_worker reads it: the head's action, options and
+    parameters, and every request's builds."""
+    head = batch[0]
+    # builds requested by more than one request are built once; the first
+    # request's first build stays the boot default
+    builds = list(dict.fromkeys(b for request in batch for b in request.builds))
+    return json.dumps(
+        {
+            "action": head.action,
+            "builds": [_kernel_build_json(b) for b in builds],
+            "options": asdict(head.options),
+            "params": head.params,
+        }
     )
 
-    _regenerate_grub(default_kver=kvers[0])
 
-    for kver in kvers:
-        eprint(f"installed kernel: {kver}")
-    eprint(f"boot default: {kvers[0]}")
-    icp("kernel compile and install completed OK")
+def _serve_worker(payload: str) -> None:
+    """Run one batch described by _batch_payload, in the worker process
+    _run_batch starts for it. Its globals (the cgroup, the jobserver it
+    joins, tmpfs and phase-log state) are its own, not the daemon's."""
+    data = json.loads(payload)
+    builds = [_kernel_build_from_json(b) for b in data["builds"]]
+    options = BuildOptions(**data["options"])
+    params = data["params"]
+    try:
+        if data["action"] == "install":
+            (build,) = builds
+            install_compiled_kernel(
+                flags=build.flags, variant=build.variant, options=options, source=build.source
+            )
+            return
+        compile_and_install_kernel(
+            builds=builds,
+            configure=False,
+            fix=params["fix"],
+            warn_only=not params["fix"],
+            no_check_boot=params["no_check_boot"],
+            pre_module_rebuild=params["pre_module_rebuild"],
+            options=options,
+        )
+    except Exception as exc:
+        eprint(f"{_WORKER_ERROR}{type(exc).__name__}: {exc}")
+        sys.exit(_exit_status(exc))
+
+
+def _run_batch(
+    build_queue: _BuildQueue, batch: list[_QueuedRequest], jobserver: str | None
+) -> None:
+    """Run a batch in a worker process, passing each line it outputs on to
+    the daemon's stdout and the batch's clients, then report it done."""
+    ids = [request.id for request in batch]
+    eprint(f"=== batch {ids}: {'; '.join(request.describe() for request in batch)} ===")
+    build_queue.broadcast(batch, {"event": "started", "ids": ids})
+    env = dict(os.environ)
+    if jobserver is not None:
+        env[_SHARED_JOBSERVER_ENV] = jobserver
+    status, error = 0, None
+    try:
+        worker = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                f"import sys; from {__name__} import _serve_worker; _serve_worker(sys.argv[1])",
+                _batch_payload(batch),
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env=env,
+        )
+        failures: list[str] = []
+
+        def _pump() -> None:
+            with worker.stdout as lines:
+                for raw in lines:
+                    line = raw.decode("utf8", "replace").rstrip("\n")
+                    sys.stdout.write(f"[batch {ids[0]}] {line}\n")
+                    sys.stdout.flush()
+                    if line.startswith(_WORKER_ERROR):
+                        failures.append(line[len(_WORKER_ERROR):])
+                    build_queue.broadcast(batch, {"event": "output", "line": line})
+
+        pump = threading.Thread(target=_pump, name=f"batch-{ids[0]}-output", daemon=True)
+        pump.start()
+        returncode = worker.wait()
+        # EOF once nothing holds the write end; a daemon some child left
+        # behind may, and is not worth keeping the batch's clients waiting for
+        pump.join(timeout=5)
+        if returncode:
+            status = returncode if returncode > 0 else 128 - returncode
+            error = failures[-1] if failures else f"worker exited with status {status}"
+    except Exception as exc:
+        status, error = _exit_status(exc), f"{type(exc).__name__}: {exc}"
+    finally:
+        if error is not None:
+            eprint(f"batch {ids} failed: {error}")
+        build_queue.finish(batch)
+        build_queue.broadcast(batch, {"event": "done", "status": status, "error": error})
+
+
+def _serve_batches(build_queue: _BuildQueue, jobserver: str | None) -> None:
+    while True:
+        batch = build_queue.next_batch()
+        threading.Thread(
+            target=_run_batch,
+            args=(build_queue, batch, jobserver),
+            name=f"batch-{batch[0].id}",
+            daemon=True,
+        ).start()
+
+
+def _parse_request(data: dict) -> tuple[str, list[KernelBuild], BuildOptions, dict]:
+    """A client's request as submit() takes it; ValueError when malformed."""
+    action = data.get("action")
+    if action not in ("build", "install"):
+        raise ValueError(f"action must be 'build', 'install' or 'status', not {action!r}")
+    try:
+        # resolved once, here: merging, batching and the batch's duplicate
+        # check must all see /usr/src/linux and its target as one tree
+        builds = [
+            replace(build, source=build.source.resolve())
+            for build in map(_kernel_build_from_json, data.get("builds", []))
+        ]
+        options = BuildOptions(**data.get("options", {}))
+    except TypeError as exc:
+        raise ValueError(str(exc)) from exc
+    if not builds:
+        raise ValueError("no builds in request")
+    if action == "install" and len(builds) != 1:
+        raise ValueError("an install request names exactly one build")
+    for build in builds:
+        _desired_localversion(build.variant)
+        if not (build.source / "Makefile").exists():
+            raise ValueError(f"{build.source} is not a kernel source tree")
+    params = {
+        "fix": bool(data.get("fix", True)),
+        "no_check_boot": bool(data.get("no_check_boot", False)),
+        "pre_module_rebuild": bool(data.get("pre_module_rebuild", False)),
+    }
+    return action, builds, options, params
+
+
+class _ServeHandler(socketserver.StreamRequestHandler):
+    """One client: a request line in, JSON event lines out until it is done."""
+
+    def _send(self, event: dict) -> None:
+        self.wfile.write((json.dumps(event) + "\n").encode("utf8"))
+        self.wfile.flush()
+
+    def handle(self) -> None:
+        build_queue: _BuildQueue = self.server.build_queue  # type: ignore[attr-defined]
+        try:
+            data = json.loads(self.rfile.readline())
+            if not isinstance(data, dict):
+                raise ValueError("a request is a JSON object")
+            if data.get("action") == "status":
+                self._send({"event": "status", **build_queue.snapshot()})
+                return
+            action, builds, options, params = _parse_request(data)
+        except ValueError as exc:
+            self._send({"event": "error", "error": str(exc)})
+            return
+        request, merged, events = build_queue.submit(
+            action=action, builds=builds, options=options, params=params
+        )
+        self._send(
+            {
+                "event": "queued",
+                "id": request.id,
+                "merged": merged,
+                "position": build_queue.position(request),
+            }
+        )
+        while True:
+            event = events.get()
+            try:
+                self._send(event)
+            except OSError:
+                build_queue.unsubscribe(request, events)
+                return
+            if event["event"] == "done":
+                return
+
+
+class _ServeServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    build_queue: _BuildQueue
+
+
+def serve_build_queue(*, socket_path: Path = SERVE_SOCKET) -> None:
+    """Accept build and install requests on a Unix socket until interrupted,
+    and run them in batches side by side (see _BuildQueue), streaming each
+    batch's output to every client waiting on it. The batches share one
+    jobserver of cpu_count tokens, governed by memory pressure, in place of
+    each request's own job count. The socket is root-only, like everything
+    a request can do."""
+    if not root_user():
+        raise ValueError("you must be root")
+    with contextlib.suppress(FileNotFoundError, ConnectionRefusedError):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            probe.connect(socket_path.as_posix())
+            raise RuntimeError(f"a compile-kernel serve daemon is already listening on {socket_path}")
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+    socket_path.unlink(missing_ok=True)
+    build_queue = _BuildQueue()
+    with (
+        _jobserver(os.cpu_count() or 1) as jobserver,
+        _memory_governor(True),
+        _ServeServer(socket_path.as_posix(), _ServeHandler) as server,
+    ):
+        try:
+            socket_path.chmod(0o600)
+            server.build_queue = build_queue
+            threading.Thread(
+                target=_serve_batches,
+                args=(build_queue, jobserver.spec() if jobserver is not None else None),
+                name="build-queue",
+                daemon=True,
+            ).start()
+            eprint(f"serving build requests on {socket_path}")
+            server.serve_forever()
+        finally:
+            socket_path.unlink(missing_ok=True)
+
+
+def _request_events(request: dict, socket_path: Path):
+    """Send one request to the serve daemon and yield its events."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path.as_posix())
+        except (FileNotFoundError, ConnectionRefusedError) as exc:
+            raise RuntimeError(
+                f"no compile-kernel serve daemon on {socket_path}; start one with "
+                f"`compile-kernel serve`"
+            ) from exc
+        sock.sendall((json.dumps(request) + "\n").encode("utf8"))
+        with sock.makefile("r", encoding="utf8") as replies:
+            for line in replies:
+                event = json.loads(line)
+                if event["event"] == "error":
+                    raise ValueError(f"daemon refused the request: {event['error']}")
+                yield event
+
+
+def submit_build_request(
+    *,
+    action: str,
+    builds: list[KernelBuild],
+    options: BuildOptions = BuildOptions(),
+    fix: bool = True,
+    no_check_boot: bool = False,
+    pre_module_rebuild: bool = False,
+    socket_path: Path = SERVE_SOCKET,
+) -> int:
+    """Queue a build or install with the serve daemon, print its progress as
+    it comes, and return its exit status."""
+    request = {
+        "action": action,
+        "builds": [_kernel_build_json(b) for b in builds],
+        "options": asdict(options),
+        "fix": fix,
+        "no_check_boot": no_check_boot,
+        "pre_module_rebuild": pre_module_rebuild,
+    }
+    for event in _request_events(request, socket_path):
+        match event["event"]:
+            case "queued":
+                merged = " (merged with an identical pending request)" if event["merged"] else ""
+                eprint(f"request #{event['id']} queued at position {event['position']}{merged}")
+            case "started":
+                eprint(f"started in batch {event['ids']}")
+            case "output":
+                print(event["line"], flush=True)
+            case "done":
+                if event["error"]:
+                    eprint(f"failed: {event['error']}")
+                return event["status"]
+    raise RuntimeError("the serve daemon closed the connection before the request finished")
+
+
+def build_queue_status(*, socket_path: Path = SERVE_SOCKET) -> None:
+    """Print what the serve daemon is running and has queued."""
+    for event in _request_events({"action": "status"}, socket_path):
+        print(f"running: {', '.join(event['running']) or '(idle)'}")
+        print("pending:")
+        for line in event["pending"] or ["(none)"]:
+            print(f"  {line}")